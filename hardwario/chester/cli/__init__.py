@@ -1,5 +1,5 @@
 import click
-from hardwario.chester.cli import app, lte
+from hardwario.chester.cli import app, lte, inventory, provision
 
 
 @click.group(name='chester', help='Commands for CHESTER (configurable IoT gateway).')
@@ -10,3 +10,5 @@ def cli(ctx):
 
 cli.add_command(app.cli)
 cli.add_command(lte.cli)
+cli.add_command(inventory.cli)
+cli.add_command(provision.cli)
@@ -7,12 +7,17 @@ import pylink
 import queue
 from loguru import logger
 from hardwario.chester.firmwareapi import FirmwareApi, DEFAULT_API_URL
-from hardwario.chester.nrfjprog import NRFJProg, DEFAULT_JLINK_SPEED_KHZ
+from hardwario.chester.nrfjprog import NRFJProg, DEFAULT_JLINK_SPEED_KHZ, UICR_WRITE_RESULT_TEXT, VERIFY_STRATEGIES
 from hardwario.chester.pib import PIB
-from hardwario.chester.utils import find_hex
+from hardwario.common.pibgen import generate, write_images, iter_images, select_image, build_image, CLAIM_TOKEN_POLICIES, UICR_PIB_ADDRESS, IMAGE_SIZE
+from hardwario.common import image
+from hardwario.common.allocator import Lease
+from hardwario.chester.utils import find_hex, find_elf
 from hardwario.chester.connector import PyLinkRTTConnector
 from hardwario.chester.cli.validate import *
-from hardwario.device import jlink_setup
+from hardwario.device.speedtune import JLINK_SPEED
+from hardwario.device import jlink_setup, multiprobe, daemon, timing, dump
+from hardwario.device.timing import TIMINGS_FORMATS
 from rttt.connectors import FileLogConnector
 from rttt.console import Console
 from rttt.event import Event, EventType
@@ -23,25 +28,50 @@ default_coredump_file = os.path.expanduser("~/.chester_coredump.bin")
 
 
 @click.group(name='app')
-@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='J-Link serial number')
-@click.option('--jlink-speed', type=int, metavar="SPEED", help='J-Link clock speed in kHz', default=2000, show_default=True)
+@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', multiple=True, help='J-Link serial number (repeat to run on several J-Links in parallel)')
+@click.option('--all-probes', is_flag=True, help='Run on all connected J-Links in parallel')
+@click.option('--jlink-speed', type=JLINK_SPEED, metavar="SPEED", help='J-Link clock speed in kHz or auto', default=2000, show_default=True)
 @click.option('--nrfjprog-log', is_flag=True, help='Enable nrfjprog log.')
 @click.pass_context
-def cli(ctx, jlink_sn, jlink_speed, nrfjprog_log):
+def cli(ctx, jlink_sn, all_probes, jlink_speed, nrfjprog_log):
     '''Application SoC commands.'''
-    ctx.obj['prog'] = NRFJProg('app', log=nrfjprog_log, jlink_sn=jlink_sn, jlink_speed=jlink_speed)
+    ctx.obj['prog'] = NRFJProg('app', log=nrfjprog_log, jlink_speed=jlink_speed)
+    ctx.obj['probes'] = None
+    set_probes(ctx, jlink_sn, all_probes)
+
+
+def set_probes(ctx, jlink_sn, all_probes=False, jlink_speed=None):
+    '''Select J-Link(s) from repeated --jlink-sn or --all-probes, keeps the previous selection when none given.'''
+    probes = multiprobe.select_probes(jlink_sn, all_probes)
+    if probes:
+        ctx.obj['prog'].set_serial_number(probes[0])
+        ctx.obj['probes'] = probes if len(probes) > 1 else None
+    if jlink_speed is not None:
+        ctx.obj['prog'].set_speed(jlink_speed)
 
 
 @cli.command('flash')
 @click.option('--halt', is_flag=True, help='Halt program.')
-@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='J-Link serial number')
-@click.option('--jlink-speed', type=int, metavar="SPEED", help='J-Link clock speed in kHz', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.option('--delta', is_flag=True, help='Erase and program only flash pages that differ from the image.')
+@click.option('--verify', type=click.Choice(VERIFY_STRATEGIES), help='Verify strategy [default: full, fast with --delta].')
+@click.option('--timings', type=click.Choice(TIMINGS_FORMATS), help='Print per-phase timing records to stderr.')
+@click.option('--timings-file', type=click.Path(dir_okay=False, writable=True), help='Append per-phase timing records (JSON lines) to file.')
+@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', multiple=True, help='J-Link serial number (repeat to run on several J-Links in parallel)')
+@click.option('--all-probes', is_flag=True, help='Run on all connected J-Links in parallel')
+@click.option('--jlink-speed', type=JLINK_SPEED, metavar="SPEED", help='J-Link clock speed in kHz or auto', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
 @click.argument('hex_file', metavar='HEX_FILE_OR_ID', callback=validate_hex_file, default=find_hex('.', no_exception=True))
 @click.pass_context
-def command_flash(ctx, halt, jlink_sn, jlink_speed, hex_file):
-    '''Flash application firmware (preserves UICR area).'''
+def command_flash(ctx, halt, delta, verify, timings, timings_file, jlink_sn, all_probes, jlink_speed, hex_file):
+    '''Flash application firmware (preserves UICR area unless the image contains it).'''
     click.echo(f'File: {hex_file}')
 
+    set_probes(ctx, jlink_sn, all_probes, jlink_speed)
+    timing.attach(ctx, timings, timings_file)
+    if ctx.obj['probes']:
+        results = multiprobe.run(ctx.obj['prog'], ctx.obj['probes'], multiprobe.flash, (hex_file, halt, delta, verify))
+        multiprobe.echo_results(results)
+        return
+
     def progress(text, ctx={'len': 0}):
         if ctx['len']:
             click.echo('\r' + (' ' * ctx['len']) + '\r', nl=False)
@@ -50,39 +80,58 @@ def command_flash(ctx, halt, jlink_sn, jlink_speed, hex_file):
         ctx['len'] = len(text)
         click.echo(text, nl=text == 'Successfully completed')
 
-    ctx.obj['prog'].set_serial_number(jlink_sn)
-    ctx.obj['prog'].set_speed(jlink_speed)
-
     with ctx.obj['prog'] as prog:
-        prog.program(hex_file, halt, progress=progress)
+        if delta:
+            result = prog.program_delta(hex_file, halt, progress=progress, verify=verify or 'fast')
+            click.echo(f'Pages written: {result["written"]}, skipped: {result["skipped"]}')
+            click.echo(f'Verify: {result["verify"]}')
+        else:
+            verify = prog.program(hex_file, halt, progress=progress, verify=verify or 'full')
+            click.echo(f'Verify: {verify}')
 
 
 @cli.command('erase')
 @click.option('--all', is_flag=True, help='Erase application firmware incl. UICR area.')
-@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='J-Link serial number')
-@click.option('--jlink-speed', type=int, metavar="SPEED", help='J-Link clock speed in kHz', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.option('--allow-erase-all', is_flag=True, help='Use erase all and rewrite UICR when faster (UICR is lost if interrupted).')
+@click.option('--timings', type=click.Choice(TIMINGS_FORMATS), help='Print per-phase timing records to stderr.')
+@click.option('--timings-file', type=click.Path(dir_okay=False, writable=True), help='Append per-phase timing records (JSON lines) to file.')
+@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', multiple=True, help='J-Link serial number (repeat to run on several J-Links in parallel)')
+@click.option('--all-probes', is_flag=True, help='Run on all connected J-Links in parallel')
+@click.option('--jlink-speed', type=JLINK_SPEED, metavar="SPEED", help='J-Link clock speed in kHz or auto', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.argument('hex_file', metavar='[HEX_FILE]', required=False, type=click.Path(exists=True, dir_okay=False))
 @click.pass_context
-def command_erase(ctx, all, jlink_sn, jlink_speed):
-    '''Erase application firmware w/o UICR area.'''
-    ctx.obj['prog'].set_serial_number(jlink_sn)
-    ctx.obj['prog'].set_speed(jlink_speed)
+def command_erase(ctx, all, allow_erase_all, timings, timings_file, jlink_sn, all_probes, jlink_speed, hex_file):
+    '''Erase application firmware w/o UICR area (only pages used by HEX_FILE when given).'''
+    if all and hex_file:
+        raise click.UsageError('Option --all cannot be used with HEX_FILE.')
+    if allow_erase_all and (all or hex_file):
+        raise click.UsageError('Option --allow-erase-all cannot be used with --all or HEX_FILE.')
+    set_probes(ctx, jlink_sn, all_probes, jlink_speed)
+    timing.attach(ctx, timings, timings_file)
+    if ctx.obj['probes']:
+        multiprobe.echo_results(multiprobe.run(ctx.obj['prog'], ctx.obj['probes'], multiprobe.erase, (all, hex_file, allow_erase_all)))
+        return
     with ctx.obj['prog'] as prog:
         if all:
             prog.erase_all()
         else:
-            prog.erase_flash()
+            plan = prog.erase_flash(image.load(hex_file) if hex_file else None, allow_erase_all)
+            click.echo(f'Erase {plan}')
     click.echo('Successfully completed')
 
 
 @cli.command('reset')
 @click.option('--halt', is_flag=True, help='Halt program.')
-@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='J-Link serial number')
-@click.option('--jlink-speed', type=int, metavar="SPEED", help='J-Link clock speed in kHz', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', multiple=True, help='J-Link serial number (repeat to run on several J-Links in parallel)')
+@click.option('--all-probes', is_flag=True, help='Run on all connected J-Links in parallel')
+@click.option('--jlink-speed', type=JLINK_SPEED, metavar="SPEED", help='J-Link clock speed in kHz or auto', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
 @click.pass_context
-def command_reset(ctx, halt, jlink_sn, jlink_speed):
+def command_reset(ctx, halt, jlink_sn, all_probes, jlink_speed):
     '''Reset application firmware.'''
-    ctx.obj['prog'].set_serial_number(jlink_sn)
-    ctx.obj['prog'].set_speed(jlink_speed)
+    set_probes(ctx, jlink_sn, all_probes, jlink_speed)
+    if ctx.obj['probes']:
+        multiprobe.echo_results(multiprobe.run(ctx.obj['prog'], ctx.obj['probes'], multiprobe.reset, (halt, )))
+        return
     with ctx.obj['prog'] as prog:
         prog.reset()
         if halt:
@@ -90,14 +139,52 @@ def command_reset(ctx, halt, jlink_sn, jlink_speed):
     click.echo('Successfully completed')
 
 
+@cli.command('dump')
+@click.option('--memory', type=click.Choice(list(dump.MEMORY_TYPES)), help='Memory to dump when --address is not given.', default='code', show_default=True)
+@click.option('--address', type=dump.ADDRESS, help='Start address (decimal or 0x hexadecimal).')
+@click.option('--size', type=dump.ADDRESS, help='Number of bytes [default: whole memory].')
+@click.option('--sparse', is_flag=True, help='Write Intel HEX without erased (0xFF) pages.')
+@click.option('--resume', is_flag=True, help='Continue an interrupted dump from its checkpoint.')
+@click.option('--timings', type=click.Choice(TIMINGS_FORMATS), help='Print per-phase timing records to stderr.')
+@click.option('--timings-file', type=click.Path(dir_okay=False, writable=True), help='Append per-phase timing records (JSON lines) to file.')
+@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='J-Link serial number')
+@click.option('--jlink-speed', type=JLINK_SPEED, metavar="SPEED", help='J-Link clock speed in kHz or auto', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.argument('file', type=click.Path(dir_okay=False, writable=True))
+@click.pass_context
+def command_dump(ctx, memory, address, size, sparse, resume, timings, timings_file, jlink_sn, jlink_speed, file):
+    '''Dump memory (whole flash by default) to FILE.'''
+    set_probes(ctx, (jlink_sn, ) if jlink_sn else (), jlink_speed=jlink_speed)
+    multiprobe.require_single_probe(ctx)
+    if address is not None and not size:
+        raise click.UsageError('Option --address requires --size.')
+    timing.attach(ctx, timings, timings_file)
+
+    def progress(text, ctx={'len': 0}):
+        click.echo('\r' + text.ljust(ctx['len']), nl=False)
+        ctx['len'] = len(text)
+
+    with ctx.obj['prog'] as prog:
+        if address is None:
+            address, memory_size = dump.get_memory_range(prog, memory)
+            size = min(size, memory_size) if size else memory_size
+        click.echo(f'Dump: 0x{address:08X} - 0x{address + size:08X} ({size} B) to {file}')
+        start = time.monotonic()
+        read = dump.dump(prog, file, address, size, sparse=sparse, resume=resume, progress=progress)
+        elapsed = time.monotonic() - start
+
+    click.echo()
+    click.echo(f'Read {read} B in {elapsed:.1f}s ({read / max(elapsed, 1e-6) / 1024:.1f} KiB/s)')
+    click.echo('Successfully completed')
+
+
 @cli.command('console')
 @click.option('--reset', is_flag=True, help='Reset application firmware.')
-@click.option('--latency', type=int, help='Latency for RTT readout in ms.', show_default=True, default=50)
+@click.option('--latency', type=int, help='Maximum RTT poll interval when idle in ms.', show_default=True, default=50)
 @click.option('--history-file', type=click.Path(writable=True), show_default=True, default=default_history_file)
 @click.option('--console-file', type=click.Path(writable=True), show_default=True, default=default_console_file)
 @click.option('--coredump-file', type=click.File('wb', 'utf-8', lazy=True), show_default=True, default=default_coredump_file)
 @click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='J-Link serial number')
-@click.option('--jlink-speed', type=int, metavar="SPEED", help='J-Link clock speed in kHz', default=2000, show_default=True)
+@click.option('--jlink-speed', type=JLINK_SPEED, metavar="SPEED", help='J-Link clock speed in kHz or auto', default=2000, show_default=True)
 @click.pass_context
 def command_console(ctx, reset, latency, history_file, console_file, coredump_file, jlink_sn, jlink_speed):
     '''Start interactive console for shell and logging.'''
@@ -105,8 +192,8 @@ def command_console(ctx, reset, latency, history_file, console_file, coredump_fi
     # if coredump_file:
     #     os.makedirs(os.path.dirname(coredump_file), exist_ok=True)
 
-    ctx.obj['prog'].set_serial_number(jlink_sn)
-    ctx.obj['prog'].set_speed(jlink_speed)
+    set_probes(ctx, (jlink_sn, ) if jlink_sn else (), jlink_speed=jlink_speed)
+    multiprobe.require_single_probe(ctx)
     with ctx.obj['prog'] as prog:
         if reset:
             prog.reset()
@@ -118,7 +205,7 @@ def command_console(ctx, reset, latency, history_file, console_file, coredump_fi
 
     jlink = jlink_setup('NRF52840_xxAA', serial_no=prog.get_serial_number(), speed=prog.get_speed())
 
-    connector = PyLinkRTTConnector(jlink, latency=latency)
+    rtt = connector = PyLinkRTTConnector(jlink, latency=latency, elf_path=find_elf('.'))
 
     if console_file:
         text = f'Console: J-Link sn: {prog.get_serial_number()}' if prog.get_serial_number() else 'Console'
@@ -127,18 +214,25 @@ def command_console(ctx, reset, latency, history_file, console_file, coredump_fi
     console = Console(connector, history_file=history_file)
     console.run()
 
+    for stats in rtt.stats.values():
+        if stats.overflows:
+            click.echo(f'RTT {stats}')
+
     click.echo('TIP: After J-Link connection, it is crucial to power cycle the target device; otherwise, the CPU debug mode results in a permanently increased power consumption.')
 
 
 @cli.group(name='pib')
-@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='J-Link serial number')
-@click.option('--jlink-speed', type=int, metavar="SPEED", help='J-Link clock speed in kHz', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', multiple=True, help='J-Link serial number (repeat to run on several J-Links in parallel)')
+@click.option('--all-probes', is_flag=True, help='Run on all connected J-Links in parallel')
+@click.option('--jlink-speed', type=JLINK_SPEED, metavar="SPEED", help='J-Link clock speed in kHz or auto', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.option('--timings', type=click.Choice(TIMINGS_FORMATS), help='Print per-phase timing records to stderr.')
+@click.option('--timings-file', type=click.Path(dir_okay=False, writable=True), help='Append per-phase timing records (JSON lines) to file.')
 @click.pass_context
-def group_pib(ctx, jlink_sn, jlink_speed):
+def group_pib(ctx, jlink_sn, all_probes, jlink_speed, timings, timings_file):
     '''HARDWARIO Product Information Block.'''
     ctx.obj['pib'] = PIB()
-    ctx.obj['prog'].set_serial_number(jlink_sn)
-    ctx.obj['prog'].set_speed(jlink_speed)
+    set_probes(ctx, jlink_sn, all_probes, jlink_speed)
+    timing.attach(ctx, timings, timings_file)
 
 
 @group_pib.command('read')
@@ -147,6 +241,15 @@ def group_pib(ctx, jlink_sn, jlink_speed):
 def command_pib_read(ctx, out_json):
     '''Read HARDWARIO Product Information Block from UICR.'''
 
+    if ctx.obj['probes']:
+        results = multiprobe.run(ctx.obj['prog'], ctx.obj['probes'], multiprobe.read_uicr_pib)
+        for result in results:
+            if result.ok:
+                pib = PIB(result.result)
+                result.result = f'{pib.get_serial_number()} {pib.get_product_name()} {pib.get_hw_revision()}'
+        multiprobe.echo_results(results)
+        return
+
     with ctx.obj['prog'] as prog:
         buffer = prog.read_uicr()
 
@@ -173,8 +276,9 @@ def command_pib_read(ctx, out_json):
 @click.option('--claim-token', type=str, help='Claim token for device self-registration (32 hexadecimal characters).', default='', prompt=True, show_default=True, callback=validate_pib_param)
 @click.option('--ble-passkey', type=str, help='Bluetooth security passkey (max 16 characters).', default='123456', prompt=True, show_default=True, callback=validate_pib_param)
 @click.option('--halt', is_flag=True, help='Halt program.')
+@click.option('--incremental', is_flag=True, help='Read UICR first, skip or avoid erase when possible.')
 @click.pass_context
-def command_pib_write(ctx, vendor_name, product_name, hw_variant, hw_revision, serial_number, claim_token, ble_passkey, halt):
+def command_pib_write(ctx, vendor_name, product_name, hw_variant, hw_revision, serial_number, claim_token, ble_passkey, halt, incremental):
     '''Write HARDWARIO Product Information Block to UICR.'''
     logger.debug('command_pib_write: %s', (serial_number,
                  vendor_name, product_name, hw_revision, hw_variant, claim_token, ble_passkey))
@@ -184,20 +288,96 @@ def command_pib_write(ctx, vendor_name, product_name, hw_variant, hw_revision, s
 
     logger.debug('write uicr: %s', buffer.hex())
 
+    multiprobe.require_single_probe(ctx)
     with ctx.obj['prog'] as prog:
-        prog.write_uicr(buffer, halt=halt)
+        result = prog.write_uicr(buffer, halt=halt, incremental=incremental)
 
+    if incremental:
+        click.echo(UICR_WRITE_RESULT_TEXT[result])
+    click.echo('Successfully completed')
+
+
+@group_pib.command('write-batch')
+@click.option('--offset', type=click.IntRange(min=0), help='Index of the first image to use.', default=0, show_default=True)
+@click.option('--halt', is_flag=True, help='Halt program.')
+@click.option('--incremental', is_flag=True, help='Read UICR first, skip or avoid erase when possible.')
+@click.argument('file', metavar='IMAGES_FILE', type=click.File('rb'))
+@click.pass_context
+def command_pib_write_batch(ctx, offset, halt, incremental, file):
+    '''Write images from \'pib generate --format bin\', one per J-Link in the given order.'''
+    images = file.read()
+    probes = ctx.obj['probes'] or [ctx.obj['prog'].get_serial_number()]
+    buffers = list(iter_images(images))[offset:offset + len(probes)]
+    if len(images) % IMAGE_SIZE or len(buffers) < len(probes):
+        raise click.BadParameter(f'Not enough images for {len(probes)} J-Links.', param_hint='IMAGES_FILE')
+
+    results = multiprobe.run(ctx.obj['prog'], probes, multiprobe.write_uicr_pib,
+                             probe_args=[(bytes(buf), halt, incremental) for buf in buffers])
+    for result, buf in zip(results, buffers):
+        sn = PIB(bytes(buf)).get_serial_number()
+        result.result = f'{sn} {UICR_WRITE_RESULT_TEXT[result.result]}' if result.ok else result.result
+    multiprobe.echo_results(results)
+
+
+@group_pib.command('generate')
+@click.option('--vendor-name', type=str, help='Vendor name (max 16 characters).', default='HARDWARIO', show_default=True, callback=validate_pib_param)
+@click.option('--product-name', type=str, help='Product name (max 16 characters).', default='CHESTER-M', show_default=True, callback=validate_pib_param)
+@click.option('--hw-variant', type=str, help='Hardware variant.', default='', show_default=True, callback=validate_pib_hw_variant)
+@click.option('--hw-revision', type=str, help='Hardware revision in Rx.y format.', default='R3.2', show_default=True, callback=validate_pib_param)
+@click.option('--serial-number', type=str, help='First serial number in decimal format.', callback=validate_pib_param)
+@click.option('--count', type=click.IntRange(min=1), help='Number of images.')
+@click.option('--lease', 'lease_file', type=click.File('r'), help='Lease JSON from \'device ledger lease\' (serial numbers and claim tokens).')
+@click.option('--claim-token-policy', type=click.Choice(CLAIM_TOKEN_POLICIES), help='Claim token policy.', default='random', show_default=True)
+@click.option('--ble-passkey', type=str, help='Bluetooth security passkey (max 16 characters).', default='123456', show_default=True, callback=validate_pib_param)
+@click.option('--format', type=click.Choice(['bin', 'hex', 'jsonl']), help='Specify output format (hex writes one file per device).', required=True)
+@click.option('--workers', type=click.IntRange(min=1), help='Number of worker processes (default: CPU count).')
+@click.argument('output', type=click.Path(writable=True))
+@click.pass_context
+def command_pib_generate(ctx, vendor_name, product_name, hw_variant, hw_revision, serial_number, count, lease_file, claim_token_policy, ble_passkey, format, workers, output):
+    '''Generate Product Information Block images for a batch of devices.'''
+    if lease_file:
+        lease = Lease.from_dict(json.load(lease_file))
+        sn_family, first, count, claim_tokens = lease.family, lease.first, lease.count, lease.claim_tokens
+    elif serial_number and count:
+        sn = int(serial_number)
+        sn_family, first, claim_tokens = (sn >> 20) & 1023, sn & 0xfffff, None
+    else:
+        raise click.UsageError('Use either --serial-number with --count or --lease.')
+
+    start = time.time()
+    images = generate(sn_family, first, count, vendor_name=vendor_name, product_name=product_name,
+                      hw_variant=hw_variant, hw_revision=hw_revision, ble_passkey=ble_passkey,
+                      claim_token=claim_token_policy, workers=workers, claim_tokens=claim_tokens)
+    write_images(images, format, output, address=UICR_PIB_ADDRESS['NRF52'])
+    click.echo(f'Generated {count} images in {time.time() - start:.1f}s')
+    click.echo('Successfully completed')
+
+
+@group_pib.command('build')
+@click.option('--pib', 'pib_file', type=click.File('rb'), help='PIB image or packed batch from \'pib generate --format bin\'.', required=True)
+@click.option('--serial-number', type=str, help='Select the PIB from a packed batch by serial number.')
+@click.option('--extra', type=click.Path(exists=True, dir_okay=False), multiple=True, help='Additional HEX image to merge (repeatable).')
+@click.argument('hex_file', metavar='HEX_FILE_OR_ID', callback=validate_hex_file)
+@click.argument('output', type=click.Path(writable=True, dir_okay=False))
+@click.pass_context
+def command_pib_build(ctx, pib_file, serial_number, extra, hex_file, output):
+    '''Build device image from application firmware and PIB, program it with a single \'app flash\'.'''
+    buffer = select_image(pib_file.read(), serial_number)
+    images = [image.load(path) for path in (hex_file, ) + extra]
+    out = build_image(buffer, UICR_PIB_ADDRESS['NRF52'], *images)
+    out.save_ihex(output)
+    click.echo(f'Image: {output} ({len(out)} B)')
     click.echo('Successfully completed')
 
 
 @cli.group(name='uicr')
 @click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='J-Link serial number')
-@click.option('--jlink-speed', type=int, metavar="SPEED", help='J-Link clock speed in kHz', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.option('--jlink-speed', type=JLINK_SPEED, metavar="SPEED", help='J-Link clock speed in kHz or auto', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
 @click.pass_context
 def group_uicr(ctx, jlink_sn, jlink_speed):
     '''UICR flash area.'''
-    ctx.obj['prog'].set_serial_number(jlink_sn)
-    ctx.obj['prog'].set_speed(jlink_speed)
+    set_probes(ctx, (jlink_sn, ) if jlink_sn else (), jlink_speed=jlink_speed)
+    multiprobe.require_single_probe(ctx)
 
 
 @group_uicr.command('read')
@@ -220,9 +400,10 @@ def command_uicr_read(ctx, format, file):
 @group_uicr.command('write')
 @click.option('--format', type=click.Choice(['hex', 'bin']), help='Specify input format.', required=True)
 @click.option('--halt', is_flag=True, help='Halt program.')
+@click.option('--incremental', is_flag=True, help='Read UICR first, skip or avoid erase when possible.')
 @click.argument('file', type=click.File('rb'))
 @click.pass_context
-def command_uicr_write(ctx, format, halt, file):
+def command_uicr_write(ctx, format, halt, incremental, file):
     '''Write generic UICR flash area from <FILE> or stdout.'''
 
     buffer = file.read()
@@ -239,7 +420,10 @@ def command_uicr_write(ctx, format, halt, file):
     logger.debug('write uicr: %s', buffer.hex())
 
     with ctx.obj['prog'] as prog:
-        prog.write_uicr(buffer, halt=halt)
+        result = prog.write_uicr(buffer, halt=halt, incremental=incremental)
+
+    if incremental:
+        click.echo(UICR_WRITE_RESULT_TEXT[result])
 
 
 @cli.group(name='fw')
@@ -320,8 +504,10 @@ def command_fw_info(ctx, id, show_all):
 def command_pokus(ctx, reset, timeout, console_file, command):
     '''Send command to the device and print response.'''
 
+    multiprobe.require_single_probe(ctx)
     prog = ctx.obj['prog']
 
+    daemon.release(prog.get_serial_number())
     jlink = pylink.JLink()
     jlink.open(serial_no=prog.get_serial_number())
     jlink.set_speed(prog.get_speed())
@@ -332,7 +518,7 @@ def command_pokus(ctx, reset, timeout, console_file, command):
         jlink.reset(halt=False)
         time.sleep(1)
 
-    connector = PyLinkRTTConnector(jlink, latency=50)
+    connector = PyLinkRTTConnector(jlink, latency=50, elf_path=find_elf('.'))
 
     if console_file:
         connector = FileLogConnector(connector, console_file, text="Command")
@@ -0,0 +1,52 @@
+import json
+import time
+import click
+from hardwario.common.pibindex import PIBIndex, DEFAULT_INDEX_PATH
+
+
+@click.group(name='inventory')
+@click.option('--index-file', type=click.Path(dir_okay=False, writable=True), help='Index database file.', default=DEFAULT_INDEX_PATH, show_default=True)
+@click.pass_context
+def cli(ctx, index_file):
+    '''Offline inventory of archived UICR dumps.'''
+    ctx.obj['index'] = PIBIndex(index_file)
+
+
+@cli.command('index')
+@click.argument('paths', metavar='PATH', nargs=-1, required=True, type=click.Path(exists=True))
+@click.pass_context
+def command_index(ctx, paths):
+    '''Index UICR dumps (uicr read --format bin) from files or directories.'''
+    start = time.time()
+    with ctx.obj['index'] as index:
+        for path in paths:
+            indexed, invalid = index.add_path(path)
+            click.echo(f'{path}: indexed {indexed} records, {invalid} invalid')
+        total = index.count()
+        duplicates = index.duplicates()
+    click.echo(f'Total records: {total} ({time.time() - start:.1f}s)')
+    for serial_number, count in duplicates.items():
+        click.echo(f'Duplicate serial number: {serial_number} ({count} records)')
+
+
+@cli.command('query')
+@click.option('--serial-number', type=int, help='Serial number in decimal format.')
+@click.option('--family', type=int, help='Product family.')
+@click.option('--product-name', type=str, help='Product name.')
+@click.option('--hw-variant', type=str, help='Hardware variant.')
+@click.option('--hw-revision', type=str, help='Hardware revision in Rx.y format.')
+@click.option('--claim-token', type=str, help='Claim token.')
+@click.option('--limit', type=click.IntRange(min=1), help='Maximum number of records.')
+@click.option('--json', 'out_json', is_flag=True, help='Output in JSON lines format.')
+@click.pass_context
+def command_query(ctx, serial_number, family, product_name, hw_variant, hw_revision, claim_token, limit, out_json):
+    '''Query indexed records, all given filters must match.'''
+    with ctx.obj['index'] as index:
+        records = index.query(limit=limit, serial_number=serial_number, family=family, product_name=product_name,
+                              hw_variant=hw_variant, hw_revision=hw_revision, claim_token=claim_token)
+
+    for r in records:
+        if out_json:
+            click.echo(json.dumps(r))
+        else:
+            click.echo(f'{r["serial_number"]} {r["product_name"]} {r["hw_revision"]} {r["hw_variant"]} {r["claim_token"]}')
@@ -6,14 +6,15 @@ import socket
 import time
 import sys
 from loguru import logger
-import pylink
-from hardwario.chester.nrfjprog import NRFJProg, DEFAULT_JLINK_SPEED_KHZ
+from hardwario.chester.nrfjprog import NRFJProg, DEFAULT_JLINK_SPEED_KHZ, VERIFY_STRATEGIES
+from hardwario.chester.connector import ChannelStats, drain, start_rtt
+from hardwario.device.speedtune import JLINK_SPEED
 from hardwario.device import jlink_setup
 
 
 @click.group(name='lte')
 @click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='Specify J-Link serial number.')
-@click.option('--jlink-speed', type=int, metavar="SPEED", help='Specify J-Link clock speed in kHz.', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.option('--jlink-speed', type=JLINK_SPEED, metavar="SPEED", help='Specify J-Link clock speed in kHz or auto.', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
 @click.option('--nrfjprog-log', is_flag=True, help='Enable nrfjprog logging.')
 @click.pass_context
 def cli(ctx, jlink_sn, jlink_speed, nrfjprog_log):
@@ -25,9 +26,10 @@ def cli(ctx, jlink_sn, jlink_speed, nrfjprog_log):
 @cli.command('flash')
 @click.argument('file', metavar='FILE', type=click.Path(exists=True))
 @click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='Specify J-Link serial number.')
-@click.option('--jlink-speed', type=int, metavar="SPEED", help='Specify J-Link clock speed in kHz.', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.option('--jlink-speed', type=JLINK_SPEED, metavar="SPEED", help='Specify J-Link clock speed in kHz or auto.', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.option('--verify', type=click.Choice(VERIFY_STRATEGIES), help='Verify strategy.', default='full', show_default=True)
 @click.pass_context
-def command_flash(ctx, jlink_sn, jlink_speed, file):
+def command_flash(ctx, jlink_sn, jlink_speed, verify, file):
     '''Flash modem firmware.'''
 
     if jlink_sn:
@@ -57,15 +59,15 @@ def command_flash(ctx, jlink_sn, jlink_speed, file):
                 with ctx.obj['prog'] as prog:
                     click.echo(f'Flash: modem.zip')
                     prog.program(os.path.join(
-                        temp_dir, 'modem.zip'), progress=progress)
+                        temp_dir, 'modem.zip'), progress=progress, verify=verify)
                     progress(None)
                     click.echo(f'Flash: application.hex')
                     prog.program(os.path.join(
-                        temp_dir, 'application.hex'), progress=progress)
+                        temp_dir, 'application.hex'), progress=progress, verify=verify)
     else:
         with ctx.obj['prog'] as prog:
             click.echo(f'Flash: {file}')
-            prog.program(file, progress=progress)
+            prog.program(file, progress=progress, verify=verify)
 
     progress(None)
     click.echo('Successfully completed')
@@ -73,7 +75,7 @@ def command_flash(ctx, jlink_sn, jlink_speed, file):
 
 @cli.command('erase')
 @click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='Specify J-Link serial number.')
-@click.option('--jlink-speed', type=int, metavar="SPEED", help='Specify J-Link clock speed in kHz.', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.option('--jlink-speed', type=JLINK_SPEED, metavar="SPEED", help='Specify J-Link clock speed in kHz or auto.', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
 @click.pass_context
 def command_erase(ctx, jlink_sn, jlink_speed):
     '''Erase modem firmware.'''
@@ -90,7 +92,7 @@ def command_erase(ctx, jlink_sn, jlink_speed):
 
 @cli.command('reset')
 @click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='Specify J-Link serial number.')
-@click.option('--jlink-speed', type=int, metavar="SPEED", help='Specify J-Link clock speed in kHz.', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.option('--jlink-speed', type=JLINK_SPEED, metavar="SPEED", help='Specify J-Link clock speed in kHz or auto.', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
 @click.pass_context
 def command_reset(ctx, jlink_sn, jlink_speed):
     '''Reset modem firmware.'''
@@ -107,7 +109,7 @@ def command_reset(ctx, jlink_sn, jlink_speed):
 
 @cli.command('trace')
 @click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='Specify J-Link serial number.')
-@click.option('--jlink-speed', type=int, metavar="SPEED", help='Specify J-Link clock speed in kHz.', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+@click.option('--jlink-speed', type=JLINK_SPEED, metavar="SPEED", help='Specify J-Link clock speed in kHz or auto.', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
 @click.option('--file', '-f', 'filename', metavar='FILE', type=click.Path(writable=True))
 @click.option('--tcp', 'tcpconnect', metavar='TCP', type=str, help='TCP connect to server, format: <host>:<port>')
 @click.option('--duration', '-d', 'duration', metavar='DURATION', type=int, help='Duration in seconds, after which the trace will be stopped.')
@@ -154,37 +156,23 @@ def command_trace(ctx, jlink_sn, jlink_speed, filename, tcpconnect, duration):
 
         text_len = 0
         last_text = ''
-        num_up = 0
         buffer_index = 0
-        num_bytes = 1000
+        sizes = {}
 
         try:
-            logger.info('Opening RTT')
-            jlink.rtt_start()
+            layout = start_rtt(jlink)
             running = True
 
-            for _ in range(100):
-                try:
-                    num_up = jlink.rtt_get_num_up_buffers()
-                    num_down = jlink.rtt_get_num_down_buffers()
-                    logger.info(f'RTT started, {num_up} up bufs, {num_down} down bufs.')
-                    break
-                except pylink.errors.JLinkRTTException:
-                    time.sleep(0.1)
-            else:
-                raise Exception('Failed to find RTT block')
-
-            for i in range(num_up):
-                desc = jlink.rtt_get_buf_descriptor(i, 1)
-                logger.info(f'Up buffer {i}: {desc}, "{desc.acName}"')
-                if desc.acName == b'modem_trace':
+            sizes = {i: size for i, (_, size) in enumerate(layout['up'])}
+            for i, (name, _) in enumerate(layout['up']):
+                if name == 'modem_trace':
                     buffer_index = i
-                    num_bytes = min(desc.SizeOfBuffer, 1000)
                     break
             else:
                 raise Exception('Not found modem trace channel in RTT.')
 
             logger.info(f'Modem trace buffer index: {buffer_index}')
+            stats = ChannelStats('modem_trace', sizes[buffer_index])
 
             print('Started modem trace')
             if not start_time:
@@ -202,14 +190,14 @@ def command_trace(ctx, jlink_sn, jlink_speed, filename, tcpconnect, duration):
                     raise ResetException()
 
                 try:
-                    t = jlink.rtt_read(0, num_bytes)
+                    t = b''.join(drain(jlink, 0, sizes.get(0) or 1000)) if buffer_index != 0 else b''
                     if t:
                         if text_len:
                             print()
                             text_len = 0
-                        txt = bytes(t).decode('utf-8', errors="backslashreplace")
+                        txt = t.decode('utf-8', errors="backslashreplace")
                         print(txt)
-                    data = jlink.rtt_read(buffer_index, num_bytes)
+                    data = b''.join(drain(jlink, buffer_index, stats.size))
                 except KeyboardInterrupt:
                     raise
                 except Exception as e:
@@ -219,8 +207,9 @@ def command_trace(ctx, jlink_sn, jlink_speed, filename, tcpconnect, duration):
                     continue
 
                 if data:
-                    data = bytes(data)
                     recv_len += len(data)
+                    if stats.update(len(data)):
+                        logger.warning(f'RTT {stats}')
 
                     if fd:
                         fd.write(data)
@@ -240,7 +229,9 @@ def command_trace(ctx, jlink_sn, jlink_speed, filename, tcpconnect, duration):
                 if text_len:
                     print(f"\r{' ' * text_len}\r", end='')
                 running = (time.time() - start_time)
-                last_text = f'Receive: {recv_len} B ({running:.1f}s)'
+                last_text = f'Receive: {recv_len} B ({running:.1f}s), high-water {stats.high_water}/{stats.size} B'
+                if stats.overflows:
+                    last_text += f', suspected overflows {stats.overflows}'
                 text_len = len(last_text)
                 print(last_text, end='')
                 sys.stdout.flush()
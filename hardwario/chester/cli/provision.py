@@ -0,0 +1,31 @@
+import time
+import click
+from hardwario.chester.recipe import Recipe
+from hardwario.device.speedtune import JLINK_SPEED
+
+
+@click.command(name='provision')
+@click.option('--serial-number', type=str, help='Serial number for PIB steps (overrides the recipe).')
+@click.option('--claim-token', type=str, help='Claim token for PIB steps (overrides the recipe).')
+@click.option('--app-jlink-sn', type=int, metavar='SERIAL_NUMBER', help='J-Link serial number for the app core.')
+@click.option('--lte-jlink-sn', type=int, metavar='SERIAL_NUMBER', help='J-Link serial number for the lte core.')
+@click.option('--jlink-speed', type=JLINK_SPEED, metavar='SPEED', help='J-Link clock speed in kHz or auto (overrides the recipe).')
+@click.option('--nrfjprog-log', is_flag=True, help='Enable nrfjprog log.')
+@click.option('--check', is_flag=True, help='Only validate the recipe and its inputs.')
+@click.argument('recipe_file', metavar='RECIPE', type=click.Path(exists=True, dir_okay=False))
+def cli(serial_number, claim_token, app_jlink_sn, lte_jlink_sn, jlink_speed, nrfjprog_log, check, recipe_file):
+    '''Provision CHESTER by RECIPE (JSON) in one session per core.'''
+    start = time.monotonic()
+    with Recipe(recipe_file, serial_number=serial_number, claim_token=claim_token) as recipe:
+        recipe.validate()
+        click.echo(f'Recipe: {len(recipe.steps)} steps validated ({time.monotonic() - start:.1f}s)')
+        if check:
+            return
+
+        report = recipe.run(jlink_sn={'app': app_jlink_sn, 'lte': lte_jlink_sn}, jlink_speed=jlink_speed,
+                            log=nrfjprog_log, progress=lambda text: click.echo(f'  {text}'))
+
+    for name, duration, detail in report:
+        click.echo(f'{name:30} {duration:6.1f}s  {detail}'.rstrip())
+    click.echo(f'Total: {time.monotonic() - start:.1f}s')
+    click.echo('Successfully completed')
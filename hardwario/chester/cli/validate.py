@@ -24,6 +24,8 @@ def validate_hex_file(ctx, param, value):
 
 def validate_pib_param(ctx, param, value):
     # print('validate_pib_param', ctx.obj, param.name, value)
+    if value is None:
+        return value
     try:
         getattr(ctx.obj['pib'], f'set_{param.name}')(value)
     except PIBException as e:
@@ -1,65 +1,328 @@
 
 from typing import Callable
+import codecs
 import pylink
 import time
+import queue
 import threading
 from loguru import logger
 from rttt.connectors.base import Connector
 from rttt.event import Event, EventType
+from hardwario.device import rttcache
+
+
+class AdaptivePoller:
+    '''Poll scheduler, polls again right away while data arrives, backs off exponentially when idle.
+
+    The interval starts at min_interval after the first empty pass and doubles up to max_interval,
+    wake() ends the current wait (e.g. input sent, echo expected). The read rate (bytes/s)
+    is updated every rate_window seconds.
+    '''
+
+    def __init__(self, min_interval=0.001, max_interval=0.05, rate_window=1.0):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.rate_window = rate_window
+        self.interval = 0.0
+        self.rate = 0.0
+        self._bytes = 0
+        self._rate_start = time.monotonic()
+        self._wake = threading.Event()
+
+    def update(self, received):
+        '''Account bytes received in the last pass, returns seconds to sleep before the next one.'''
+        if received:
+            self.interval = 0.0
+        else:
+            self.interval = min(self.max_interval, max(self.interval * 2, self.min_interval))
+
+        self._bytes += received
+        now = time.monotonic()
+        if now - self._rate_start >= self.rate_window:
+            self.rate = self._bytes / (now - self._rate_start)
+            self._bytes = 0
+            self._rate_start = now
+
+        return self.interval
+
+    def wait(self, received):
+        interval = self.update(received)
+        if interval:
+            self._wake.wait(interval)
+            self._wake.clear()
+        else:
+            # Still yield to the other threads while spinning
+            time.sleep(0)
+
+    def wake(self):
+        self.interval = 0.0
+        self._wake.set()
+
+
+class LineFramer:
+    '''Splits a byte stream into text lines, linear in the number of bytes.
+
+    Only complete lines are decoded, with an incremental UTF-8 decoder so multi-byte sequences
+    split between reads stay intact. A line longer than max_line_length is returned in parts
+    of that length, so the pending data never exceeds it (w/o a trailing CR).
+    '''
+
+    def __init__(self, max_line_length=4096):
+        self.max_line_length = max_line_length
+        self._buffer = bytearray()
+        self._scanned = 0
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='backslashreplace')
+
+    def feed(self, data):
+        '''Return list of lines (w/o line endings) completed by data.'''
+        buf = self._buffer
+        buf += data
+        lines = []
+        start = 0
+        with memoryview(buf) as view:
+            while True:
+                end = buf.find(b'\n', max(start, self._scanned))
+                if end < 0:
+                    break
+                stop = end - 1 if end > start and buf[end - 1] == 0x0d else end
+                start = self._flush_partial(view, start, stop, lines)
+                lines.append(self._decoder.decode(view[start:stop], True))
+                start = end + 1
+
+            # A trailing CR stays pending, it may be the one of a CRLF
+            start = self._flush_partial(view, start, len(buf) - 1 if buf.endswith(b'\r') else len(buf), lines)
+
+        del buf[:start]
+        self._scanned = len(buf)
+        return lines
+
+    def _flush_partial(self, view, start, stop, lines):
+        # Parts of max_line_length while more than that is left before stop, returns the new start
+        while stop - start > self.max_line_length:
+            logger.debug('RTT line longer than {} B, flushed as partial', self.max_line_length)
+            lines.append(self._decoder.decode(view[start:start + self.max_line_length], False))
+            start += self.max_line_length
+        return start
+
+
+class ChannelStats:
+    '''Per-channel RTT read statistics.
+
+    The high-water mark is the most bytes drained from the channel in one pass. A pass that
+    drains the whole buffer (SizeOfBuffer - 1 usable bytes) means the target buffer was full,
+    so the firmware may have dropped or blocked output: counted as a suspected overflow.
+    '''
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.bytes = 0
+        self.high_water = 0
+        self.overflows = 0
+
+    def update(self, pending):
+        '''Account bytes drained in one pass, returns True on suspected overflow.'''
+        self.bytes += pending
+        self.high_water = max(self.high_water, pending)
+        if pending >= self.size - 1:
+            self.overflows += 1
+            return True
+        return False
+
+    def __str__(self):
+        return f'{self.name}: {self.bytes} B, high-water {self.high_water}/{self.size} B, suspected overflows {self.overflows}'
+
+
+def drain(jlink, idx, size):
+    '''Read channel until a read returns less than size (buffer empty), yields the chunks.'''
+    while True:
+        data = jlink.rtt_read(idx, size)
+        if not data:
+            return
+        yield bytes(data)
+        if len(data) < size:
+            return
+
+
+class RTTWriter:
+    '''Writes to an RTT down buffer from a background thread.
+
+    A partial write (down buffer full) is retried from the remaining offset with a growing
+    delay, data not accepted within stall_timeout seconds is dropped. write() blocks while
+    more than max_pending bytes wait, and raises after timeout seconds (backpressure).
+    '''
+
+    def __init__(self, jlink, idx, chunk_size, max_pending=0x10000, timeout=5.0, stall_timeout=5.0, on_written=None):
+        self.jlink = jlink
+        self.idx = idx
+        self.chunk_size = max(chunk_size, 1)
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.on_written = on_written
+        self.dropped = 0
+        self._queue = queue.Queue()
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        data = bytes(data)
+        with self._cond:
+            # A single write larger than max_pending is accepted once the queue is empty
+            if not self._cond.wait_for(lambda: not self._pending or self._pending + len(data) <= self.max_pending, self.timeout):
+                raise Exception('RTT write timeout (target does not read input)')
+            self._pending += len(data)
+        self._queue.put(data)
+
+    def flush(self, timeout=None):
+        '''Wait until all queued data is written, returns False on timeout.'''
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending, timeout)
+
+    def close(self, timeout=1.0):
+        self.flush(timeout)
+        self._queue.put(None)
+        self._thread.join()
+
+    def _write(self, data):
+        view = memoryview(data)
+        offset = 0
+        delay = 0.001
+        stalled = None
+        while offset < len(view):
+            n = self.jlink.rtt_write(self.idx, view[offset:offset + self.chunk_size])
+            if n:
+                offset += n
+                delay = 0.001
+                stalled = None
+                continue
+            now = time.monotonic()
+            if stalled is None:
+                stalled = now
+            elif now - stalled > self.stall_timeout:
+                self.dropped += len(view) - offset
+                logger.warning(f'RTT down buffer {self.idx} full, dropped {len(view) - offset} B')
+                return
+            time.sleep(delay)
+            delay = min(delay * 2, 0.02)
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            try:
+                self._write(data)
+            except Exception as e:
+                logger.error(f'RTT write failed: {e}')
+            with self._cond:
+                self._pending -= len(data)
+                self._cond.notify_all()
+            if self.on_written:
+                self.on_written()
+
+
+def _wait_rtt(jlink, timeout, interval=0.01):
+    '''Poll until the J-Link finds the control block, returns (num_up, num_down) or None.'''
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return jlink.rtt_get_num_up_buffers(), jlink.rtt_get_num_down_buffers()
+        except pylink.errors.JLinkRTTException:
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(interval)
+
+
+def start_rtt(jlink, block_address=None, elf_path=None, timeout=10.0):
+    '''Start RTT and return the channel layout (see rttcache.lookup).
+
+    The control block address is taken from block_address, the layout cached for the firmware
+    or the _SEGGER_RTT symbol of elf_path (see rttcache.resolve), with a known address the J-Link
+    does not scan RAM. Channel names and sizes come from the cache when the buffer descriptors
+    read from the control block match it.
+    '''
+    def read(address, size):
+        return bytes(jlink.memory_read8(address, size))
+
+    firmware_hash, layout, address, descriptors = rttcache.resolve(read, block_address, elf_path)
+
+    logger.info(f"Opening RTT{' control block at 0x{:08X}'.format(address) if address else ''}")
+    jlink.rtt_start(address)
+    counts = _wait_rtt(jlink, timeout)
+    if counts is None:
+        raise Exception('Failed to find RTT block')
+
+    logger.info(f'RTT started, {counts[0]} up bufs, {counts[1]} down bufs.')
+
+    if address is None and firmware_hash:
+        # One time search, next attach with this firmware skips the J-Link RAM scan
+        address = rttcache.find_control_block(read)
+        descriptors = rttcache.read_control_block(read, address) if address else None
+
+    if rttcache.is_valid(layout, address, descriptors):
+        logger.info('Using cached RTT channel layout')
+        return layout
+
+    layout = {'address': address, 'up': [], 'down': [], 'descriptors': descriptors}
+    for direction, key, count in ((1, 'up', counts[0]), (0, 'down', counts[1])):
+        for i in range(count):
+            desc = jlink.rtt_get_buf_descriptor(i, direction)
+            logger.info(f'{key.capitalize()} buffer {i}: {desc}')
+            layout[key].append([desc.name, desc.SizeOfBuffer])
+
+    if firmware_hash and descriptors is not None:
+        rttcache.store(firmware_hash, layout)
+
+    return layout
 
 
 class PyLinkRTTConnector(Connector):
 
-    def __init__(self, jlink: pylink.JLink, block_address=None, latency=50) -> None:
+    # Minimal seconds between two overflow reports of one channel
+    OVERFLOW_REPORT_INTERVAL = 5
+
+    def __init__(self, jlink: pylink.JLink, block_address=None, latency=50, elf_path=None) -> None:
         super().__init__()
         self.jlink = jlink
         self.block_address = block_address
-        self.rtt_read_delay = latency / 1000.0
+        self.elf_path = elf_path
+        # latency is the poll interval ceiling when idle
+        self.poller = AdaptivePoller(max_interval=latency / 1000.0)
         self.is_running = False
         self.terminal_buffer = 0
         self.terminal_buffer_up_size = 0
         self.terminal_buffer_down_size = 0
         self.logger_buffer = None
         self.logger_buffer_up_size = 0
+        self.stats = {}
+        self._host_overflows = 0
+        self._overflow_reported = {}
 
     def open(self):
-        self._cache = {0: '', 1: ''}
+        self._framers = {}
 
-        logger.info(f"Opening RTT{' control block found at 0x{:08X}'.format(self.block_address) if self.block_address else ''}")
-        self.jlink.rtt_start(self.block_address)
+        layout = start_rtt(self.jlink, self.block_address, self.elf_path)
 
-        for _ in range(100):
-            try:
-                num_up = self.jlink.rtt_get_num_up_buffers()
-                num_down = self.jlink.rtt_get_num_down_buffers()
-                logger.info(f'RTT started, {num_up} up bufs, {num_down} down bufs.')
-                break
-            except pylink.errors.JLinkRTTException:
-                time.sleep(0.1)
-        else:
-            raise Exception('Failed to find RTT block')
-
-        if num_up == 0:
+        if not layout['up']:
             raise Exception('No RTT down buffers found')
 
         self.is_running = True
 
-        for i in range(num_up):
-            desc = self.jlink.rtt_get_buf_descriptor(i, 1)
-            logger.info(f'Up buffer {i}: {desc}')
-            if desc.name == 'Terminal':
+        for i, (name, size) in enumerate(layout['up']):
+            if name == 'Terminal':
                 self.terminal_buffer = i
-                self.terminal_buffer_up_size = desc.SizeOfBuffer
-            elif desc.name == 'Logger':
+                self.terminal_buffer_up_size = size
+            elif name == 'Logger':
                 self.logger_buffer = i
-                self.logger_buffer_up_size = desc.SizeOfBuffer
+                self.logger_buffer_up_size = size
 
-        for i in range(num_down):
-            desc = self.jlink.rtt_get_buf_descriptor(i, 0)
-            logger.info(f'Down buffer {i}: {desc}')
-            if desc.name == 'Terminal':
+        for i, (name, size) in enumerate(layout['down']):
+            if name == 'Terminal':
                 self.terminal_buffer = i
-                self.terminal_buffer_down_size = desc.SizeOfBuffer
+                self.terminal_buffer_down_size = size
                 break
 
         self.old_format = True
@@ -67,6 +330,8 @@ class PyLinkRTTConnector(Connector):
             self.old_format = True
             logger.info('Using old RTT implementation')
 
+        self.writer = RTTWriter(self.jlink, self.terminal_buffer, self.terminal_buffer_down_size, on_written=self.poller.wake)
+
         self.thread = threading.Thread(target=self._read_task, daemon=True)
         self.thread.start()
 
@@ -77,9 +342,13 @@ class PyLinkRTTConnector(Connector):
         logger.info('Closing RTT')
         if not self.is_running:
             return
+        self.writer.close()
         self.is_running = False
+        self.poller.wake()
         self.thread.join()
         self.jlink.rtt_stop()
+        for stats in self.stats.values():
+            logger.info(f'RTT {stats}')
         self._emit(Event(EventType.CLOSE, ''))
         logger.info('RTT closed')
 
@@ -87,43 +356,68 @@ class PyLinkRTTConnector(Connector):
         logger.info(f'handle: {event.type} {event.data}')
         if event.type == EventType.IN:
             logger.info(f'RTT write shell buffer {self.terminal_buffer} bufer size {self.terminal_buffer_down_size}')
-            data = bytearray(f'{event.data}\n', "utf-8")
-            for i in range(0, len(data), self.terminal_buffer_down_size):
-                chunk = data[i:i + self.terminal_buffer_down_size]
-                self.jlink.rtt_write(self.terminal_buffer, list(chunk))
+            self.writer.write(f'{event.data}\n'.encode('utf-8'))
         self._emit(event)
 
+    @property
+    def poll_interval(self):
+        '''Current poll interval in seconds.'''
+        return self.poller.interval
+
+    @property
+    def read_rate(self):
+        '''Read rate in bytes/s over the last rate window.'''
+        return self.poller.rate
+
+    def _report_overflow(self, text, key):
+        logger.warning(text)
+        now = time.monotonic()
+        if now - self._overflow_reported.get(key, -self.OVERFLOW_REPORT_INTERVAL) >= self.OVERFLOW_REPORT_INTERVAL:
+            self._overflow_reported[key] = now
+            self._emit(Event(EventType.LOG, text))
+
+    def _check_host_overflow(self):
+        try:
+            count = self.jlink.rtt_get_status().HostOverflowCount
+        except Exception as e:
+            logger.debug(f'RTT status not available: {e}')
+            return
+        if count > self._host_overflows:
+            self._host_overflows = count
+            self._report_overflow(f'RTT host buffer overflow (count {count})', None)
+
     def _read_task(self):
+        channels = []
+        for idx, size, event_type, name in (
+            (self.terminal_buffer, self.terminal_buffer_up_size, EventType.OUT, 'Terminal'),
+            (self.logger_buffer, self.logger_buffer_up_size, EventType.LOG, 'Logger')
+        ):
+            if idx is None or size < 1:
+                continue
+            self.stats[idx] = ChannelStats(name, size)
+            channels.append((idx, event_type))
+
         while self.is_running:
-            channels = [
-                (self.terminal_buffer, min(1000, self.terminal_buffer_up_size), EventType.OUT),
-                (self.logger_buffer, min(1000, self.logger_buffer_up_size), EventType.LOG)
-            ]
-            for idx, num_bytes, event_type in channels:
-                if idx is None:
-                    continue
-
-                data = self.jlink.rtt_read(idx, num_bytes)
-                if data:
-                    lines = bytes(data).decode('utf-8', errors="backslashreplace")
-                    if lines:
-                        lines = self._cache[idx] + lines
-
-                        while True:
-                            end = lines.find('\n')
-                            if end < 0:
-                                self._cache[idx] = lines
-                                break
-
-                            line = lines[:end]
-                            lines = lines[end + 1:]
-
-                            if line.endswith('\r'):
-                                line = line[:-1]
-
-                            if self.old_format and line.startswith('#'):
-                                self._emit(Event(EventType.LOG, line))
-                            else:
-                                self._emit(Event(event_type, line))
-
-            time.sleep(self.rtt_read_delay)
+            received = 0
+            for idx, event_type in channels:
+                stats = self.stats[idx]
+                pending = 0
+                for data in drain(self.jlink, idx, stats.size):
+                    pending += len(data)
+                    framer = self._framers.get(idx)
+                    if framer is None:
+                        framer = self._framers[idx] = LineFramer()
+
+                    for line in framer.feed(data):
+                        if self.old_format and line.startswith('#'):
+                            self._emit(Event(EventType.LOG, line))
+                        else:
+                            self._emit(Event(event_type, line))
+
+                if pending and stats.update(pending):
+                    self._report_overflow(f'RTT {stats.name} buffer overflow suspected ({pending} B pending, buffer {stats.size} B)', idx)
+                received += pending
+
+            if received:
+                self._check_host_overflow()
+            self.poller.wait(received)
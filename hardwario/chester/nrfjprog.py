@@ -2,13 +2,16 @@ import time
 from loguru import logger
 from pynrfjprog import APIError
 from pynrfjprog.Parameters import RTTChannelDirection
+from hardwario.device import rttcache
 from hardwario.device.nrfjprog import (
     NRFJProg as NRFJProgBase,
     NRFJProgException,
     NRFJProgOpenException,
     NRFJProgDeviceFamilyException,
     NRFJProgRTTNoChannels,
-    DEFAULT_JLINK_SPEED_KHZ
+    DEFAULT_JLINK_SPEED_KHZ,
+    UICR_WRITE_RESULT_TEXT,
+    VERIFY_STRATEGIES
 )
 
 
@@ -20,51 +23,57 @@ class NRFJProg(NRFJProgBase):
 
         super().__init__(mcu, jlink_sn, jlink_speed, log)
 
-    def write_uicr(self, buffer: bytes, halt=False):
+    def write_uicr(self, buffer: bytes, halt=False, incremental=False, reset=True):
         if self.device_family != 'app':
             raise NRFJProgException('Invalid MCU support only for app')
 
-        self.reset()
-        self.halt()
-
-        self.erase_uicr()
-        self.write(self.get_uicr_address() + 0x80, buffer, True)
-
-        self.reset()
-        if halt:
-            self.halt()
-        else:
-            self.go()
+        return self.write_uicr_pib(buffer, halt=halt, incremental=incremental, reset=reset)
 
     def read_uicr(self):
         if self.device_family != 'app':
             raise NRFJProgException('Invalid MCU support only for app')
         return bytes(self.read(self.get_uicr_address() + 0x80, 128))
 
-    def rtt_start(self):  # type: ignore
+    def rtt_start(self, block_address=None, elf_path=None):  # type: ignore
         if self._rtt_channels is not None:
             return self._rtt_channels
 
+        def read(address, size):
+            return bytes(self.read(address, size))
+
+        firmware_hash, layout, address, descriptors = rttcache.resolve(read, block_address, elf_path)
+
         logger.debug('RTT Start')
         super().rtt_start()
 
-        self.rtt_set_control_block_address(0x20002650)
+        # Only addresses with a control block are set, restarting RTT to rescan needs a target reset
+        if address:
+            self.rtt_set_control_block_address(address)
 
-        for _ in range(100):
-            is_found, address = self.rtt_get_control_block_info()
-            if is_found:
-                logger.debug('RTT control block found at 0x{:08X}', address)
-                break
-            time.sleep(0.1)
-        else:
+        found = self._rtt_wait_control_block(10)
+        if found is None:
             raise NRFJProgException('Failed to find RTT block')
 
         channel_count = self.rtt_read_channel_count()
         logger.debug(f'RTT channel count {channel_count}')
 
+        if found != address:
+            descriptors = rttcache.read_control_block(read, found)
+
+        if rttcache.is_valid(layout, found, descriptors):
+            logger.debug('Using cached RTT channel layout')
+        else:
+            layout = {
+                'address': found,
+                'down': [list(self.rtt_read_channel_info(index, RTTChannelDirection.DOWN_DIRECTION)) for index in range(channel_count[0])],
+                'up': [list(self.rtt_read_channel_info(index, RTTChannelDirection.UP_DIRECTION)) for index in range(channel_count[1])],
+                'descriptors': descriptors,
+            }
+            if firmware_hash and descriptors is not None:
+                rttcache.store(firmware_hash, layout)
+
         channels = {}
-        for index in range(channel_count[0]):
-            name, size = self.rtt_read_channel_info(index, RTTChannelDirection.DOWN_DIRECTION)
+        for index, (name, size) in enumerate(layout['down']):
             if size < 1:
                 continue
             channels[name] = {
@@ -73,8 +82,7 @@ class NRFJProg(NRFJProgBase):
                     'size': size
                 }
             }
-        for index in range(channel_count[1]):
-            name, size = self.rtt_read_channel_info(index, RTTChannelDirection.UP_DIRECTION)
+        for index, (name, size) in enumerate(layout['up']):
             if size < 1:
                 continue
             if name not in channels:
@@ -87,6 +95,18 @@ class NRFJProg(NRFJProgBase):
         self._rtt_channels = channels
         return self._rtt_channels
 
+    def _rtt_wait_control_block(self, timeout, interval=0.01):
+        '''Poll until the control block is found, returns its address or None on timeout.'''
+        deadline = time.monotonic() + timeout
+        while True:
+            is_found, address = self.rtt_get_control_block_info()
+            if is_found:
+                logger.debug('RTT control block found at 0x{:08X}', address)
+                return address
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(interval)
+
     def rtt_stop(self):
         if self._rtt_channels is None:
             return
@@ -0,0 +1,247 @@
+import os
+import json
+import time
+import shutil
+import zipfile
+import tempfile
+from loguru import logger
+from hardwario.common import image
+from hardwario.common.pibgen import select_image
+from hardwario.common.pib import PIBException
+from hardwario.chester.pib import PIB
+from hardwario.chester.nrfjprog import NRFJProg, VERIFY_STRATEGIES, UICR_WRITE_RESULT_TEXT
+
+TARGETS = ('app', 'lte')
+
+ACTIONS = {
+    'app': ('flash', 'erase', 'pib', 'uicr'),
+    'lte': ('flash', 'erase'),
+}
+
+# Same defaults as 'chester app pib write'
+PIB_DEFAULTS = {
+    'vendor_name': 'HARDWARIO',
+    'product_name': 'CHESTER-M',
+    'hw_variant': '',
+    'hw_revision': 'R3.2',
+    'claim_token': '',
+    'ble_passkey': '123456',
+}
+
+
+class RecipeException(Exception):
+    pass
+
+
+class Step:
+
+    def __init__(self, index, target, action, params):
+        self.index = index
+        self.target = target
+        self.action = action
+        self.params = params
+
+    def __str__(self):
+        return f'{self.index + 1}. {self.target} {self.action}'
+
+
+class Recipe:
+    '''CHESTER provisioning recipe, a JSON file with the steps for the app and lte cores.
+
+    Example:
+        {
+          "app": {"jlink_sn": 123456},
+          "steps": [
+            {"target": "app", "action": "flash", "file": "app.hex", "verify": "fast"},
+            {"target": "app", "action": "pib", "images": "batch.bin"},
+            {"target": "lte", "action": "flash", "file": "mfw_nrf9160.zip"}
+          ]
+        }
+
+    Relative paths are resolved against the recipe directory. Steps run grouped per core
+    (their order within a core is kept) in one session per core, the core is reset and halted
+    once at the start and reset once at the end.
+    '''
+
+    def __init__(self, path, serial_number=None, claim_token=None):
+        self.path = path
+        self.base_dir = os.path.dirname(os.path.abspath(path))
+        self.serial_number = serial_number
+        self.claim_token = claim_token
+        self._temp_dir = None
+
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except ValueError as e:
+            raise RecipeException(f'Invalid recipe {path}: {e}')
+
+        if not isinstance(data, dict) or not isinstance(data.get('steps'), list) or not data['steps']:
+            raise RecipeException('Recipe must contain a non-empty list of steps')
+
+        self.targets = {target: dict(data.get(target) or {}) for target in TARGETS}
+        self.halt = bool(data.get('halt', False))
+
+        self.steps = []
+        for index, params in enumerate(data['steps']):
+            params = dict(params)
+            target = params.pop('target', None)
+            action = params.pop('action', None)
+            if target not in TARGETS:
+                raise RecipeException(f'Step {index + 1}: unknown target {target!r}')
+            if action not in ACTIONS[target]:
+                raise RecipeException(f'Step {index + 1}: unknown action {action!r} for {target}')
+            self.steps.append(Step(index, target, action, params))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self._temp_dir:
+            shutil.rmtree(self._temp_dir, ignore_errors=True)
+            self._temp_dir = None
+
+    def _file(self, step, key='file'):
+        value = step.params.get(key)
+        if not value:
+            raise RecipeException(f'missing {key}')
+        path = os.path.join(self.base_dir, os.path.expanduser(value))
+        if not os.path.isfile(path):
+            raise RecipeException(f'file {value} does not exist')
+        return path
+
+    def _verify(self, step, default):
+        verify = step.params.get('verify', default)
+        if verify not in VERIFY_STRATEGIES:
+            raise RecipeException(f'unknown verify strategy {verify!r}')
+        return verify
+
+    def validate(self):
+        '''Check every step and prepare its inputs (parse images, build PIB, extract archives).'''
+        for step in self.steps:
+            try:
+                getattr(self, f'_prepare_{step.action}')(step)
+            # ValueError from invalid hex or PIB values, OSError from unreadable files
+            except (RecipeException, PIBException, image.ImageException, zipfile.BadZipFile, ValueError, OSError) as e:
+                raise RecipeException(f'Step {step}: {e}')
+
+    def _prepare_flash(self, step):
+        path = self._file(step)
+
+        if step.target == 'lte' and path.lower().endswith('.zip'):
+            zf = zipfile.ZipFile(path)
+            namelist = zf.namelist()
+            if len(namelist) == 2 and 'modem.zip' in namelist and 'application.hex' in namelist:
+                if self._temp_dir is None:
+                    self._temp_dir = tempfile.mkdtemp(prefix='hardwario-recipe-')
+                out = os.path.join(self._temp_dir, str(step.index))
+                zf.extractall(out)
+                step.files = [os.path.join(out, 'modem.zip'), os.path.join(out, 'application.hex')]
+            else:
+                step.files = [path]
+        else:
+            step.files = [path]
+
+        for file_path in step.files:
+            if file_path.lower().endswith('.hex'):
+                image.load(file_path)
+
+        step.delta = bool(step.params.get('delta', False))
+        if step.delta and (step.target != 'app' or not path.lower().endswith('.hex')):
+            raise RecipeException('delta is supported only for app HEX files')
+        step.verify = self._verify(step, 'fast' if step.delta else 'full')
+
+    def _prepare_erase(self, step):
+        step.image = image.load(self._file(step)) if step.params.get('file') else None
+        step.all = bool(step.params.get('all', False)) or step.target == 'lte'
+
+    def _prepare_pib(self, step):
+        serial_number = self.serial_number or step.params.get('serial_number')
+        if step.params.get('images'):
+            buffer = select_image(open(self._file(step, 'images'), 'rb').read(), serial_number)
+            pib = PIB(buffer)
+        else:
+            if not serial_number:
+                raise RecipeException('missing serial number')
+            fields = dict(PIB_DEFAULTS)
+            fields.update((k, v) for k, v in step.params.items() if k in PIB_DEFAULTS)
+            fields['serial_number'] = serial_number
+            if self.claim_token is not None:
+                fields['claim_token'] = self.claim_token
+            pib = PIB()
+            for name, value in fields.items():
+                getattr(pib, f'set_{name}')(str(value))
+        step.buffer = pib.get_buffer()
+        step.serial_number = pib.get_serial_number()
+        step.incremental = bool(step.params.get('incremental', True))
+
+    def _prepare_uicr(self, step):
+        path = self._file(step)
+        with open(path, 'rb') as f:
+            buffer = f.read()
+        if step.params.get('format', 'bin') == 'hex':
+            buffer = bytes.fromhex(buffer.decode().strip())
+        if not buffer or len(buffer) > 128:
+            raise RecipeException('UICR buffer must have 1 to 128 B')
+        step.buffer = buffer
+        step.incremental = bool(step.params.get('incremental', True))
+
+    def run(self, jlink_sn=None, jlink_speed=None, log=False, progress=lambda x: None):
+        '''Run validated steps, returns list of (name, duration in seconds, detail).'''
+        report = []
+        for target in TARGETS:
+            steps = [step for step in self.steps if step.target == target]
+            if not steps:
+                continue
+
+            options = self.targets[target]
+            sn = (jlink_sn or {}).get(target) or options.get('jlink_sn')
+            speed = jlink_speed or options.get('jlink_speed')
+            prog = NRFJProg(target, jlink_sn=sn, jlink_speed=speed, log=log)
+
+            start = time.monotonic()
+            progress(f'{target}: connect')
+            with prog as p:
+                p.reset()
+                p.halt()
+                report.append((f'{target} connect', time.monotonic() - start, ''))
+
+                for step in steps:
+                    progress(str(step))
+                    step_start = time.monotonic()
+                    detail = getattr(self, f'_run_{step.action}')(p, step)
+                    report.append((str(step), time.monotonic() - step_start, detail))
+                    logger.debug('Recipe step {}: {}', step, detail)
+
+                reset_start = time.monotonic()
+                p.reset()
+                if self.halt:
+                    p.halt()
+                else:
+                    p.go()
+                report.append((f'{target} reset', time.monotonic() - reset_start, 'halt' if self.halt else 'go'))
+
+        return report
+
+    def _run_flash(self, p, step):
+        if step.delta:
+            result = p.program_delta(step.files[0], verify=step.verify, reset=False)
+            return f'pages written: {result["written"]}, skipped: {result["skipped"]}, verify: {result["verify"]}'
+        verify = [p.program(file_path, verify=step.verify, reset=False) for file_path in step.files]
+        return f'{", ".join(os.path.basename(f) for f in step.files)}, verify: {verify[-1]}'
+
+    def _run_erase(self, p, step):
+        if step.all:
+            p.erase_all()
+            return 'all'
+        return str(p.erase_flash(step.image))
+
+    def _run_pib(self, p, step):
+        result = p.write_uicr(step.buffer, incremental=step.incremental, reset=False)
+        return f'{step.serial_number} {UICR_WRITE_RESULT_TEXT[result]}'
+
+    def _run_uicr(self, p, step):
+        return UICR_WRITE_RESULT_TEXT[p.write_uicr(step.buffer, incremental=step.incremental, reset=False)]
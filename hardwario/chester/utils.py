@@ -21,3 +21,7 @@ def find_hex(app_path, no_exception=False):
         return None
 
     raise Exception('No firmware found.')
+
+
+def find_elf(app_path):
+    return test_file(app_path, 'build', 'zephyr', 'zephyr.elf')
@@ -4,7 +4,7 @@ import click
 from loguru import logger
 import hardwario
 from hardwario.chester.cli import cli as chester
-from hardwario.device.cli import cli as device
+from hardwario.device.cli import cli as device, cli_daemon as daemon
 
 DEFAULT_LOG_LEVEL = 'DEBUG'
 DEFAULT_LOG_FILE = os.path.expanduser("~/.hardwario/cli.log")
@@ -23,6 +23,7 @@ def cli(log_level):
 
 cli.add_command(chester)
 cli.add_command(device)
+cli.add_command(daemon)
 
 
 def main():
@@ -0,0 +1,180 @@
+import os
+import time
+import secrets
+import sqlite3
+from loguru import logger
+from hardwario.common.pib import make_sn
+
+DEFAULT_LEDGER_PATH = os.path.expanduser("~/.hardwario/ledger.db")
+
+MAX_SN = 1048575
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS family (
+    family INTEGER PRIMARY KEY,
+    next INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS lease (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    family INTEGER NOT NULL,
+    first INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    station TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS claim_token (
+    token BLOB PRIMARY KEY,
+    lease_id INTEGER
+) WITHOUT ROWID;
+'''
+
+
+class AllocatorException(Exception):
+    pass
+
+
+class Lease:
+
+    def __init__(self, id, family, first, count, station, claim_tokens=None):
+        self.id = id
+        self.family = family
+        self.first = first
+        self.count = count
+        self.station = station
+        self.claim_tokens = claim_tokens or []
+
+    def serial_numbers(self):
+        return [make_sn(self.family, n) for n in range(self.first, self.first + self.count)]
+
+    def get_dict(self):
+        return {
+            'id': self.id,
+            'family': self.family,
+            'first': self.first,
+            'count': self.count,
+            'station': self.station,
+            'serial_numbers': [str(sn) for sn in self.serial_numbers()],
+            'claim_tokens': self.claim_tokens,
+        }
+
+    @classmethod
+    def from_dict(cls, payload):
+        lease = cls(payload['id'], payload['family'], payload['first'], payload['count'],
+                    payload['station'], payload.get('claim_tokens'))
+        if lease.claim_tokens and len(lease.claim_tokens) != lease.count:
+            raise AllocatorException('Lease claim token count does not match')
+        return lease
+
+
+class Ledger:
+    '''Shared ledger of leased serial number blocks and issued claim tokens.
+
+    Stored in SQLite, each lease is one write transaction under the database file lock,
+    so parallel stations only touch the ledger once per block.
+    '''
+
+    def __init__(self, path=DEFAULT_LEDGER_PATH, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self._db = None
+
+    def open(self):
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _transaction(self, func, *args):
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(*args)
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+        return result
+
+    def get_next(self, family):
+        row = self._db.execute('SELECT next FROM family WHERE family = ?', (family,)).fetchone()
+        return row[0] if row else None
+
+    def set_next(self, family, next):
+        '''Set the first serial number (lower 20 bits) handed out by the next lease of the family.'''
+        make_sn(family, next)
+
+        def update():
+            current = self.get_next(family)
+            if current is not None and next < current:
+                raise AllocatorException(f'Family {family} already leased up to {current - 1}')
+            self._db.execute('INSERT OR REPLACE INTO family VALUES (?, ?)', (family, next))
+
+        self._transaction(update)
+
+    def lease(self, family, count, station='', claim_tokens=True):
+        '''Lease a block of count serial numbers, optionally with the same number of unique claim tokens.'''
+        if count < 1:
+            raise AllocatorException('Bad count')
+        make_sn(family, 0)
+
+        def allocate():
+            first = self.get_next(family)
+            if first is None:
+                raise AllocatorException(f'Family {family} is not initialized in ledger')
+            if first + count - 1 > MAX_SN:
+                raise AllocatorException(f'Family {family} has only {MAX_SN - first + 1} serial numbers left')
+
+            self._db.execute('UPDATE family SET next = ? WHERE family = ?', (first + count, family))
+            cursor = self._db.execute('INSERT INTO lease (family, first, count, station, created_at) VALUES (?, ?, ?, ?, ?)',
+                                      (family, first, count, station, time.time()))
+            lease = Lease(cursor.lastrowid, family, first, count, station)
+
+            if claim_tokens:
+                lease.claim_tokens = [self._issue_claim_token(lease.id) for _ in range(count)]
+
+            return lease
+
+        lease = self._transaction(allocate)
+        logger.debug('Leased {} serial numbers of family {} from {} to {}', count, family, lease.first, station)
+        return lease
+
+    def _issue_claim_token(self, lease_id):
+        while True:
+            token = secrets.token_bytes(16)
+            cursor = self._db.execute('INSERT OR IGNORE INTO claim_token VALUES (?, ?)', (token, lease_id))
+            if cursor.rowcount == 1:
+                return token.hex()
+            logger.warning('Claim token collision, generating a new one')
+
+    def is_claim_token_issued(self, token):
+        row = self._db.execute('SELECT 1 FROM claim_token WHERE token = ?', (bytes.fromhex(token),)).fetchone()
+        return row is not None
+
+    def add_claim_tokens(self, tokens):
+        '''Register claim tokens issued outside of the ledger, returns number of new ones.'''
+        def insert():
+            cursor = self._db.executemany('INSERT OR IGNORE INTO claim_token VALUES (?, NULL)',
+                                          ((bytes.fromhex(t),) for t in tokens))
+            return cursor.rowcount
+
+        return self._transaction(insert)
+
+    def leases(self, family=None):
+        sql = 'SELECT id, family, first, count, station FROM lease'
+        params = ()
+        if family is not None:
+            sql += ' WHERE family = ?'
+            params = (family,)
+        return [Lease(*row) for row in self._db.execute(sql + ' ORDER BY id', params)]
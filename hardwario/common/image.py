@@ -0,0 +1,303 @@
+import os
+import struct
+from collections import OrderedDict
+from bisect import bisect_right
+from loguru import logger
+from hardwario.common.utils import get_file_hash
+
+DEFAULT_CACHE_PATH = os.path.expanduser("~/.hardwario/cache/image")
+
+CACHE_MAGIC = b'HWIMG\x00\x00\x01'
+
+# Parsed images kept in memory, the least recently used are dropped
+MEMORY_CACHE_SIZE = 8
+
+# Equal blocks, then equal words, are skipped as a whole when diffing
+DIFF_BLOCK_SIZE = 256
+
+_memory_cache = OrderedDict()
+
+
+class ImageException(Exception):
+    pass
+
+
+class Image:
+    '''Sparse memory image, address-sorted non-overlapping segments backed by bytearray.'''
+
+    def __init__(self):
+        self._starts = []
+        self._data = []
+        self.sha256 = None
+
+    def __len__(self):
+        return sum(len(d) for d in self._data)
+
+    def __bool__(self):
+        return bool(self._data)
+
+    def __eq__(self, other):
+        return isinstance(other, Image) and self._starts == other._starts and self._data == other._data
+
+    @property
+    def start(self):
+        return self._starts[0] if self._starts else None
+
+    @property
+    def end(self):
+        return self._starts[-1] + len(self._data[-1]) if self._starts else None
+
+    def segments(self):
+        '''Return list of (address, memoryview) tuples in address order.'''
+        return [(start, memoryview(data)) for start, data in zip(self._starts, self._data)]
+
+    def add(self, address, data):
+        '''Add data at address, overwrites overlapping bytes and joins adjacent segments.'''
+        if not data:
+            return self
+        end = address + len(data)
+
+        i = bisect_right(self._starts, address) - 1
+        if i < 0 or self._starts[i] + len(self._data[i]) < address:
+            i += 1
+        j = bisect_right(self._starts, end) - 1
+
+        if i > j:
+            self._starts.insert(i, address)
+            self._data.insert(i, bytearray(data))
+            return self
+
+        start = min(self._starts[i], address)
+        stop = max(self._starts[j] + len(self._data[j]), end)
+        if i == j and start == self._starts[i] and stop == self._starts[i] + len(self._data[i]):
+            buf = self._data[i]
+        else:
+            buf = bytearray(stop - start)
+            for k in range(i, j + 1):
+                offset = self._starts[k] - start
+                buf[offset:offset + len(self._data[k])] = self._data[k]
+        buf[address - start:end - start] = data
+
+        self._starts[i:j + 1] = [start]
+        self._data[i:j + 1] = [buf]
+        return self
+
+    def copy(self):
+        image = Image()
+        image._starts = list(self._starts)
+        image._data = [bytearray(d) for d in self._data]
+        return image
+
+    def merge(self, other):
+        '''Add all segments of other image, other wins on overlap.'''
+        for address, data in other.segments():
+            self.add(address, data)
+        return self
+
+    def read(self, address, size, fill=0xff):
+        '''Return bytes of range, bytes not covered by any segment are set to fill.'''
+        out = bytearray([fill]) * size
+        end = address + size
+        i = max(bisect_right(self._starts, address) - 1, 0)
+        for k in range(i, len(self._starts)):
+            start = self._starts[k]
+            if start >= end:
+                break
+            data = self._data[k]
+            lo = max(start, address)
+            hi = min(start + len(data), end)
+            if lo < hi:
+                out[lo - address:hi - address] = memoryview(data)[lo - start:hi - start]
+        return bytes(out)
+
+    def overlaps(self, address, size):
+        end = address + size
+        i = max(bisect_right(self._starts, address) - 1, 0)
+        for k in range(i, len(self._starts)):
+            if self._starts[k] >= end:
+                break
+            if self._starts[k] + len(self._data[k]) > address:
+                return True
+        return False
+
+    def contains(self, address):
+        i = bisect_right(self._starts, address) - 1
+        return i >= 0 and address < self._starts[i] + len(self._data[i])
+
+    def diff(self, other, fill=0xff):
+        '''Return list of (address, size) ranges of this image whose content differs in other.'''
+        ranges = []
+        for start, data in zip(self._starts, self._data):
+            ours = memoryview(data)
+            theirs = memoryview(other.read(start, len(data), fill))
+            if ours == theirs:
+                continue
+            run = None
+            offset = 0
+            while offset < len(data):
+                for step in (DIFF_BLOCK_SIZE, 4, 1):
+                    end = min(offset + step, len(data))
+                    if ours[offset:end] == theirs[offset:end]:
+                        break
+                else:
+                    if run is None:
+                        run = offset
+                    offset += 1
+                    continue
+                if run is not None:
+                    ranges.append((start + run, offset - run))
+                    run = None
+                offset = end
+            if run is not None:
+                ranges.append((start + run, len(data) - run))
+        return ranges
+
+    def to_ihex(self, record_size=16):
+        lines = []
+        upper = None
+        for start, data in zip(self._starts, self._data):
+            offset = 0
+            while offset < len(data):
+                addr = start + offset
+                size = min(record_size, len(data) - offset, 0x10000 - (addr & 0xffff))
+                if addr >> 16 != upper:
+                    upper = addr >> 16
+                    lines.append(_ihex_record(0, 0x04, upper.to_bytes(2, 'big')))
+                lines.append(_ihex_record(addr & 0xffff, 0x00, data[offset:offset + size]))
+                offset += size
+        lines.append(_ihex_record(0, 0x01, b''))
+        return '\n'.join(lines) + '\n'
+
+    def save_ihex(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_ihex())
+
+    def to_cache(self):
+        out = bytearray(CACHE_MAGIC)
+        out += struct.pack('<I', len(self._starts))
+        for start, data in zip(self._starts, self._data):
+            out += struct.pack('<II', start, len(data))
+            out += data
+        return bytes(out)
+
+    @classmethod
+    def from_cache(cls, buf):
+        view = memoryview(buf)
+        if bytes(view[:8]) != CACHE_MAGIC:
+            raise ImageException('Invalid image cache file')
+        image = cls()
+        count, = struct.unpack_from('<I', view, 8)
+        offset = 12
+        for _ in range(count):
+            start, size = struct.unpack_from('<II', view, offset)
+            offset += 8
+            image._starts.append(start)
+            image._data.append(bytearray(view[offset:offset + size]))
+            offset += size
+        return image
+
+    @classmethod
+    def from_ihex(cls, text):
+        image = cls()
+        base = 0
+        run_start = None
+        run = bytearray()
+
+        for lineno, line in enumerate(text.splitlines(), 1):
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] != ':':
+                raise ImageException(f'Invalid Intel HEX record on line {lineno}')
+            try:
+                record = bytes.fromhex(line[1:])
+            except ValueError:
+                raise ImageException(f'Invalid Intel HEX record on line {lineno}')
+            if len(record) < 5 or len(record) != record[0] + 5 or sum(record) & 0xff:
+                raise ImageException(f'Invalid Intel HEX checksum on line {lineno}')
+
+            type = record[3]
+            data = record[4:-1]
+
+            if type == 0x00:
+                address = base + ((record[1] << 8) | record[2])
+                if run_start is not None and run_start + len(run) == address:
+                    run += data
+                else:
+                    if run_start is not None:
+                        image.add(run_start, run)
+                    run_start = address
+                    run = bytearray(data)
+            elif type == 0x01:
+                break
+            elif type == 0x02:
+                base = int.from_bytes(data, 'big') << 4
+            elif type == 0x04:
+                base = int.from_bytes(data, 'big') << 16
+            elif type in (0x03, 0x05):
+                pass  # start address is not used for flashing
+            else:
+                raise ImageException(f'Unknown Intel HEX record type {type} on line {lineno}')
+
+        if run_start is not None:
+            image.add(run_start, run)
+        return image
+
+    @classmethod
+    def from_bin(cls, buf, address=0):
+        return cls().add(address, buf)
+
+
+def _ihex_record(address, type, data):
+    record = bytes((len(data), address >> 8, address & 0xff, type)) + bytes(data)
+    checksum = (-sum(record)) & 0xff
+    return ':' + record.hex().upper() + f'{checksum:02X}'
+
+
+def load(path, address=0, cache_path=DEFAULT_CACHE_PATH):
+    '''Load Intel HEX (.hex) or raw binary file at address.
+
+    Parsed images are cached in memory and on disk keyed by the file sha256,
+    the returned image is shared, use copy() before modifying it.
+    '''
+    sha256 = get_file_hash(path)
+    key = (sha256, address)
+
+    image = _memory_cache.get(key)
+    if image is not None:
+        _memory_cache.move_to_end(key)
+        return image
+
+    is_hex = path.lower().endswith(('.hex', '.ihex'))
+    cache_file = os.path.join(cache_path, f'{sha256}.img') if cache_path and is_hex else None
+
+    image = None
+    if cache_file and os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                image = Image.from_cache(f.read())
+            logger.debug('Image {} loaded from cache {}', path, cache_file)
+        except Exception as e:
+            logger.warning('Invalid image cache {}: {}', cache_file, e)
+            image = None
+
+    if image is None:
+        if is_hex:
+            with open(path, 'r') as f:
+                image = Image.from_ihex(f.read())
+        else:
+            with open(path, 'rb') as f:
+                image = Image.from_bin(f.read(), address)
+
+        if cache_file:
+            os.makedirs(cache_path, exist_ok=True)
+            tmp = cache_file + f'.{os.getpid()}'
+            with open(tmp, 'wb') as f:
+                f.write(image.to_cache())
+            os.replace(tmp, cache_file)
+
+    image.sha256 = sha256
+    _memory_cache[key] = image
+    while len(_memory_cache) > MEMORY_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+    return image
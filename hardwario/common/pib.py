@@ -1,64 +1,223 @@
 import struct
-import array
 import re
 import secrets
+import zlib
 
 
 class PIBException(Exception):
     pass
 
 
-class PIB:
+SIGNATURE = 0xbabecafe
+
+LAYOUT = {
+    1: {
+        'signature': (0x00, '<L'),
+        'version': (0x04, 'B'),
+        'size': (0x08, '<H'),
+        'serial_number': (0x0c, '<L'),
+        'hw_revision': (0x10, '<H'),
+        'hw_variant': (0x14, '<L'),
+        'vendor_name': (0x18, '<32s'),
+        'product_name': (0x38, '<32s'),
+        'rf_offset': (0x58, '<h'),
+        'rf_correction': (0x58, '<L'),
+        'crc': (None, '<L'),
+    },
+    2: {
+        'signature': (0x00, '>L'),
+        'version': (0x04, 'B'),
+        'size': (0x05, '>B'),
+        'vendor_name': (0x06, '17s'),
+        'product_name': (0x17, '17s'),
+        'hw_variant': (0x28, '11s'),
+        'hw_revision': (0x33, '7s'),
+        'serial_number': (0x3a, '11s'),
+        'claim_token': (0x45, '33s'),
+        'ble_passkey': (0x66, '17s'),
+        'crc': (None, '>L'),
+    }
+}
 
-    VERSION_1 = 1
-    VERSION_2 = 2
+# Fields covered by the v1 CRC, in order (v2 covers the whole block)
+CRC_FIELDS_V1 = ('signature', 'version', 'size', 'serial_number', 'hw_revision',
+                 'hw_variant', 'vendor_name', 'product_name')
 
-    SIGNATURE = {
-        1: (0, '<L'),
-        2: (0, '>L')
-    }
-    VERSION = (4, 'B')
-    SIZE = {
-        1: (0x08, '<H'),
-        2: (0x05, '>B')
-    }
-    VENDOR_NAME = {
-        1: (0x18, '<32s'),
-        2: (0x06, '17s')
-    }
-    PRODUCT_NAME = {
-        1: (0x38, '<32s'),
-        2: (0x17, '17s')
-    }
-    HW_VARIANT = {
-        1: (0x14, '<L'),
-        2: (0x28, '11s')
-    }
-    HW_REVISION = {
-        1: (0x10, '<H'),
-        2: (0x33, '7s')
-    }
-    SERIAL_NUMBER = {
-        1: (0x0c, '<L'),
-        2: (0x3a, '11s')
-    }
 
-    RF_OFFSET = {
-        1: (88, 2, '<h')
-    }
-    RF_CORRECTION = {
-        1: (88, 4, '<L')
-    }
+class Field:
+    __slots__ = ('name', 'offset', 'size', 'is_str', '_struct')
 
-    CLAIM_TOKEN = {
-        2: (0x45, '33s')
-    }
-    BLE_PASSKEY = {
-        2: (0x66, '17s')
-    }
+    def __init__(self, name, offset, fmt):
+        self.name = name
+        self.offset = offset
+        self.is_str = fmt[-1] == 's'
+        self._struct = struct.Struct(fmt)
+        self.size = self._struct.size
+
+    def unpack(self, buf, offset=None):
+        value = self._struct.unpack_from(buf, self.offset if offset is None else offset)[0]
+        if self.is_str:
+            return value.decode('ascii').rstrip('\0')
+        return value
+
+    def pack(self, buf, value, offset=None):
+        if self.is_str:
+            value = value.encode()
+        self._struct.pack_into(buf, self.offset if offset is None else offset, value)
+
+
+def compile_layout(layout):
+    return {name: Field(name, offset, fmt) for name, (offset, fmt) in layout.items()}
+
+
+FIELDS = {version: compile_layout(layout) for version, layout in LAYOUT.items()}
+
+
+class PIBBase:
+    '''Field getters shared by PIB and PIBView, both operate on self._buf.'''
+
+    def _init_layout(self, version):
+        # Keep the current layout when the version is unknown
+        fields = FIELDS.get(version)
+        if fields is None:
+            raise Exception('Integrity check for PIB failed version')
+        self._fields = fields
+
+    def _calc_layout_size(self):
+        self._is_core_module = False
+        self._has_rf_correction = False
+
+        if self._is_nrf:
+            return self._default_size + 33 + 17
+
+        family = self.get_family()
+        if family in (0x101, 0x102, 0x103, 0x104):
+            self._is_core_module = True
+            return self._default_size + 4
+        elif family == 0x0009:  # STICKER
+            self._has_rf_correction = True
+            return self._default_size + 4
+        return self._default_size
+
+    def _check(self):
+        if self.get_signature() != SIGNATURE:
+            raise Exception('Integrity check for PIB failed signature')
+        if self.get_size() != self._size:
+            raise Exception('Integrity check for PIB failed size')
+        if self.get_crc() != self.calc_crc():
+            raise Exception('Integrity check for PIB failed crc')
+
+    def _unpack(self, name):
+        return self._fields[name].unpack(self._buf)
+
+    def get_signature(self):
+        return self._unpack('signature')
+
+    def get_version(self):
+        return self._buf[4]
+
+    def get_size(self):
+        return self._unpack('size')
+
+    def get_vendor_name(self):
+        return self._unpack('vendor_name')
+
+    def get_product_name(self):
+        return self._unpack('product_name')
+
+    def get_hw_variant(self):
+        return self._unpack('hw_variant')
+
+    def get_hw_revision(self):
+        return self._unpack('hw_revision')
+
+    def get_serial_number(self):
+        return self._unpack('serial_number')
+
+    def get_rf_offset(self):
+        if not self._is_core_module:
+            raise PIBException('Only CORE module')
+        return self._unpack('rf_offset')
+
+    def get_rf_correction(self):
+        if not self._has_rf_correction:
+            raise PIBException('This device has no RF correction')
+        return self._unpack('rf_correction')
+
+    def get_claim_token(self):
+        return self._unpack('claim_token')
+
+    def get_ble_passkey(self):
+        return self._unpack('ble_passkey')
+
+    def get_crc(self):
+        return self._fields['crc'].unpack(self._buf, self._size - 4)
+
+    def get_family(self):
+        sn = int(self.get_serial_number())
+        if (sn & 0xc0000000) != 0x80000000:
+            raise PIBException('Bad serial number format')
+        return (sn >> 20) & 1023
+
+    def get_dict(self):
+        payload = {
+            'signature': '0x%08x' % self.get_signature(),
+            'version': '0x%02x' % self.get_version(),
+            'size': '0x%02x' % self.get_size(),
+            'crc': '0x%08x' % self.get_crc(),
+            'vendor_name': self.get_vendor_name(),
+            'product_name': self.get_product_name(),
+        }
+
+        if self.get_version() == 1:
+            payload['serial_number'] = '0x%08x' % self.get_serial_number()
+            payload['hw_revision'] = '0x%04x' % self.get_hw_revision()
+            payload['hw_variant'] = '0x%08x' % self.get_hw_variant()
+        else:
+            payload['serial_number'] = self.get_serial_number()
+            payload['hw_revision'] = self.get_hw_revision()
+            payload['hw_variant'] = self.get_hw_variant()
+
+        if self._is_core_module:
+            payload['rf_offset'] = self.get_rf_offset()
+        if self._has_rf_correction:
+            payload['rf_correction'] = self.get_rf_correction()
+
+        if self._is_nrf:
+            payload['claim_token'] = self.get_claim_token()
+            payload['ble_passkey'] = self.get_ble_passkey()
+
+        return payload
+
+    def calc_crc(self):
+        if self.get_version() == 1:
+            crc = 0xffffffff
+            for name in CRC_FIELDS_V1:
+                crc = self._calc_crc_item(crc, name)
+            if self._is_core_module:
+                crc = self._calc_crc_item(crc, 'rf_offset')
+            if self._has_rf_correction:
+                crc = self._calc_crc_item(crc, 'rf_correction')
+            return crc
+        else:
+            return self._calc_crc(0xffffffff, 0, self._size - 4)
+
+    def _calc_crc_item(self, crc, name):
+        field = self._fields[name]
+        return self._calc_crc(crc, field.offset, field.size)
+
+    def _calc_crc(self, crc, offset, size):
+        # Same polynomial as zlib, the running value is kept finalized between items
+        return zlib.crc32(memoryview(self._buf)[offset:offset + size], crc ^ 0xffffffff)
+
+
+class PIB(PIBBase):
+
+    VERSION_1 = 1
+    VERSION_2 = 2
 
     def __init__(self, version=1, buf=None, nrf=False):
-        self._buf = array.array('B', [0xff] * 128)
+        self._buf = bytearray(b'\xff' * 128)
         self._default_version = version
         if version == 1:
             self._default_size = 0x58 + 4
@@ -68,6 +227,7 @@ class PIB:
             raise Exception('PIB failed version')
 
         self._buf[4] = self._default_version & 0xff
+        self._init_layout(version)
 
         self._is_core_module = False
         self._has_rf_correction = False
@@ -79,87 +239,49 @@ class PIB:
             self.reset()
 
     def load(self, buf):
-        for i, v in enumerate(buf):
-            self._buf[i] = v
+        if len(buf) > 128:
+            raise Exception('Integrity check for PIB failed length')
+        self._buf[:len(buf)] = buf
 
-        self._update_family()
-
-        if self.get_version() not in (1, 2):
-            raise Exception('Integrity check for PIB failed version')
-        if self.get_signature() != 0xbabecafe:
-            raise Exception('Integrity check for PIB failed signature')
-        if self.get_size() != self._size:
-            raise Exception('Integrity check for PIB failed size')
-        if self.get_crc() != self.calc_crc():
-            raise Exception('Integrity check for PIB failed crc')
+        self._init_layout(self.get_version())
+        self._size = self._calc_layout_size()
+        self._check()
 
     def reset(self):
         self._size = self._default_size
-        for i in range(128):
-            self._buf[i] = 0xff
+        self._buf[:] = b'\xff' * 128
         self._buf[4] = self._default_version & 0xff
-        self._pack(self.SIGNATURE, 0xbabecafe)
+        self._init_layout(self._default_version)
+        self._pack('signature', SIGNATURE)
         self.set_vendor_name('')
         self.set_product_name('')
         self._is_core_module = False
         self._has_rf_correction = False
-        self._pack(self.SIZE, self._size)
+        self._pack('size', self._size)
 
     def _update_family(self):
-        if self._is_nrf:
-            self._size = self._default_size + 33 + 17
-            return
-
-        self._size = self._default_size
-        self._is_core_module = False
-
-        family = self.get_family()
-        if family in (0x101, 0x102, 0x103, 0x104):
-            self._size += 4
-            self._is_core_module = True
+        self._size = self._calc_layout_size()
+        if self._is_core_module:
             self.set_rf_offset(-32768)  # default invalid value
-        elif family == 0x0009:  # STICKER
-            self._size += 4
-            self._has_rf_correction = True
+        elif self._has_rf_correction:
             self.set_rf_correction(0xffffffff)
 
-    def get_signature(self):
-        return self._unpack(self.SIGNATURE)
-
-    def get_version(self):
-        return self._buf[4]
-
-    def get_size(self):
-        return self._unpack(self.SIZE)
-
-    def get_vendor_name(self):
-        return self._unpack(self.VENDOR_NAME)
-
     def set_vendor_name(self, value):
         max_len = 31 if self.get_version() == 1 else 16
         if len(value) > max_len:
             raise PIBException(f'Bad Vendor name (max {max_len} characters)')
-        self._pack(self.VENDOR_NAME, value)
-
-    def get_product_name(self):
-        return self._unpack(self.PRODUCT_NAME)
+        self._pack('vendor_name', value)
 
     def set_product_name(self, value):
         max_len = 31 if self.get_version() == 1 else 16
         if len(value) > max_len:
             raise PIBException(f'Bad Product name (max {max_len} characters)')
-        self._pack(self.PRODUCT_NAME, value)
-
-    def get_hw_variant(self):
-        return self._unpack(self.HW_VARIANT)
+        self._pack('product_name', value)
 
     def set_hw_variant(self, value):
         if self.get_version() == 2 and len(value) > 10:
             raise PIBException('Bad Hardware variant (max 10 characters)')
-        self._pack(self.HW_VARIANT, value)
-
-    def get_hw_revision(self):
-        return self._unpack(self.HW_REVISION)
+        self._pack('hw_variant', value)
 
     def set_hw_revision(self, value):
         if self.get_version() == 2:
@@ -170,10 +292,7 @@ class PIB:
                 raise PIBException(
                     'Bad Hardware version format, expect: Rx.y .')
 
-        self._pack(self.HW_REVISION, value)
-
-    def get_serial_number(self):
-        return self._unpack(self.SERIAL_NUMBER)
+        self._pack('hw_revision', value)
 
     def set_serial_number(self, value):
         if self.get_version() == 2:
@@ -190,148 +309,91 @@ class PIB:
         if (sn & 0xc0000000) != 0x80000000:
             raise PIBException('Bad serial number format')
 
-        self._pack(self.SERIAL_NUMBER, value)
+        self._pack('serial_number', value)
         self._update_family()
-        self._pack(self.SIZE, self._size)
-
-    def get_rf_offset(self):
-        if not self._is_core_module:
-            raise PIBException('Only CORE module')
-        return self._unpack(self.RF_OFFSET)
+        self._pack('size', self._size)
 
     def set_rf_offset(self, value):
         if not self._is_core_module:
             raise PIBException('Only CORE module')
-        self._pack(self.RF_OFFSET, value)
-
-    def get_rf_correction(self):
-        if not self._has_rf_correction:
-            raise PIBException('This device has no RF correction')
-        return self._unpack(self.RF_CORRECTION)
+        self._pack('rf_offset', value)
 
     def set_rf_correction(self, value):
         if not self._has_rf_correction:
             raise PIBException('This device has no RF correction')
-        self._pack(self.RF_CORRECTION, value)
-
-    def get_claim_token(self):
-        return self._unpack(self.CLAIM_TOKEN)
+        self._pack('rf_correction', value)
 
     def set_claim_token(self, value):
         if not re.match(r'^[\dabcdef]{32}$', value) and value != '':
             raise PIBException('Bad Claim token (32 hexadecimal characters).')
-        self._pack(self.CLAIM_TOKEN, value)
+        self._pack('claim_token', value)
 
     def gen_claim_token(self):
         token = secrets.token_hex(16)
         self.set_claim_token(token)
         return token
 
-    def get_ble_passkey(self):
-        return self._unpack(self.BLE_PASSKEY)
-
     def set_ble_passkey(self, value):
         if not re.match(r'^[a-zA-Z0-9]{0,16}$', value):
             raise PIBException('Bad BLE passkey (max 16 characters).')
 
-        self._pack(self.BLE_PASSKEY, value)
-
-    def get_crc(self):
-        fmt = '<L' if self.get_version() == 1 else '>L'
-        return struct.unpack_from(fmt, self._buf, self._size - 4)[0]
+        self._pack('ble_passkey', value)
 
     def get_buffer(self):
-        crc = self.calc_crc()
-        fmt = '<L' if self.get_version() == 1 else '>L'
-        struct.pack_into(fmt, self._buf, self._size - 4, crc)
-        return self._buf.tobytes()
-
-    def get_family(self):
-        sn = int(self.get_serial_number())
-        if (sn & 0xc0000000) != 0x80000000:
-            raise PIBException('Bad serial number format')
-        return (sn >> 20) & 1023
-
-    def get_dict(self):
-        payload = {
-            'signature': '0x%08x' % self.get_signature(),
-            'version': '0x%02x' % self.get_version(),
-            'size': '0x%02x' % self.get_size(),
-            'crc': '0x%08x' % self.get_crc(),
-            'vendor_name': self.get_vendor_name(),
-            'product_name': self.get_product_name(),
-        }
-
-        if self.get_version() == 1:
-            payload['serial_number'] = '0x%08x' % self.get_serial_number()
-            payload['hw_revision'] = '0x%04x' % self.get_hw_revision()
-            payload['hw_variant'] = '0x%08x' % self.get_hw_variant()
-        else:
-            payload['serial_number'] = self.get_serial_number()
-            payload['hw_revision'] = self.get_hw_revision()
-            payload['hw_variant'] = self.get_hw_variant()
-
-        if self._is_core_module:
-            payload['rf_offset'] = self.get_rf_offset()
-        if self._has_rf_correction:
-            payload['rf_correction'] = self.get_rf_correction()
+        self._fields['crc'].pack(self._buf, self.calc_crc(), self._size - 4)
+        return bytes(self._buf)
+
+    def _pack(self, name, value):
+        self._fields[name].pack(self._buf, value)
+
+    @classmethod
+    def verify_many(cls, buffers, **kwargs):
+        '''Check signature, size and CRC of each image.
+
+        Accepts an iterable of buffers or one concatenated buffer of 128 B records.
+        Returns a list with None for a valid image or the error message otherwise.
+        '''
+        if isinstance(buffers, (bytes, bytearray, memoryview)):
+            view = memoryview(buffers)
+            buffers = [view[i:i + 128] for i in range(0, len(view), 128)]
+
+        pib = cls(**kwargs)
+        results = []
+        for buf in buffers:
+            if len(buf) != 128:
+                results.append('Integrity check for PIB failed length')
+                continue
+            try:
+                pib.load(buf)
+                results.append(None)
+            except Exception as e:
+                results.append(str(e))
+        return results
 
-        if self._is_nrf:
-            payload['claim_token'] = self.get_claim_token()
-            payload['ble_passkey'] = self.get_ble_passkey()
 
-        return payload
+class PIBView(PIBBase):
+    '''Read-only PIB over any buffer, fields are decoded on access without copying.'''
 
-    def calc_crc(self):
-        if self.get_version() == 1:
-            crc = 0xffffffff
-            crc = self._calc_crc_item(crc, self.SIGNATURE)
-            crc = self._calc_crc_item(crc, self.VERSION)
-            crc = self._calc_crc_item(crc, self.SIZE)
-            crc = self._calc_crc_item(crc, self.SERIAL_NUMBER)
-            crc = self._calc_crc_item(crc, self.HW_REVISION)
-            crc = self._calc_crc_item(crc, self.HW_VARIANT)
-            crc = self._calc_crc_item(crc, self.VENDOR_NAME)
-            crc = self._calc_crc_item(crc, self.PRODUCT_NAME)
-            if self._is_core_module:
-                crc = self._calc_crc_item(crc, self.RF_OFFSET)
-            if self._has_rf_correction:
-                crc = self._calc_crc_item(crc, self.RF_CORRECTION)
-            return crc
-        else:
-            return self._calc_crc(0xffffffff, 0, self._size - 4)
+    def __init__(self, buf, nrf=False, check=True):
+        self._buf = memoryview(buf)
+        if len(self._buf) < 128:
+            raise Exception('Integrity check for PIB failed length')
+        self._is_nrf = nrf
 
-    def _pack(self, mem, value):
-        if isinstance(mem, dict):
-            mem = mem[self.get_version()]
-        offset, fmt = mem
-        if fmt[-1] == 's':
-            value = value.encode()
-        struct.pack_into(fmt, self._buf, offset, value)
-
-    def _unpack(self, mem):
-        if isinstance(mem, dict):
-            mem = mem[self.get_version()]
-        offset, fmt = mem
-        value = struct.unpack_from(fmt, self._buf, offset)[0]
-        if fmt[-1] == 's':
-            return value.decode('ascii').rstrip('\0')
-        return value
+        version = self.get_version()
+        self._init_layout(version)
+        self._default_size = 0x58 + 4 if version == 1 else 0x45 + 4
+        self._size = self._calc_layout_size()
 
-    def _calc_crc_item(self, crc, mem):
-        if isinstance(mem, dict):
-            mem = mem[self.get_version()]
-        offset, fmt = mem
-        size = struct.calcsize(fmt)
-        return self._calc_crc(crc, offset, size)
+        if check:
+            self._check()
 
-    def _calc_crc(self, crc, offset, size):
-        for i in range(offset, offset + size):
-            n = self._buf[i]
-            crc ^= n
-            for _ in range(8):
-                crc = (crc >> 1) ^ (0xedb88320 & ~((crc & 1) - 1))
-        return crc ^ 0xffffffff
+    @classmethod
+    def iter_records(cls, buf, nrf=False, check=True):
+        '''Yield a view for each 128 B record of a concatenated dump.'''
+        view = memoryview(buf)
+        for offset in range(0, len(view) - 127, 128):
+            yield cls(view[offset:offset + 128], nrf=nrf, check=check)
 
 
 def make_sn(family, sn):
@@ -0,0 +1,139 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+from hardwario.common.pib import PIB, PIBView, PIBException, make_sn
+from hardwario.common.image import Image
+
+UICR_PIB_ADDRESS = {
+    'NRF52': 0x10001000 + 0x80,
+    'NRF91': 0x00FF8000 + 0x108,
+}
+
+CLAIM_TOKEN_POLICIES = ('random', 'empty')
+
+CHUNK_SIZE = 2000
+
+IMAGE_SIZE = 128
+
+
+def _generate_chunk(family, first, count, fields, claim_token, claim_tokens=None):
+    pib = PIB(2, nrf=True)
+    for name, value in fields.items():
+        getattr(pib, f'set_{name}')(value)
+
+    out = bytearray()
+    for i, n in enumerate(range(first, first + count)):
+        pib.set_serial_number(str(make_sn(family, n)))
+        if claim_tokens:
+            pib.set_claim_token(claim_tokens[i])
+        elif claim_token == 'random':
+            pib.gen_claim_token()
+        else:
+            pib.set_claim_token('')
+        out += pib.get_buffer()
+
+    for i, error in enumerate(PIB.verify_many(out, version=2, nrf=True)):
+        if error:
+            raise PIBException(f'Image for serial number {make_sn(family, first + i)} is invalid: {error}')
+
+    return bytes(out)
+
+
+def generate(family, first, count, vendor_name='HARDWARIO', product_name='CHESTER-M', hw_variant='',
+             hw_revision='R3.2', ble_passkey='123456', claim_token='random', workers=None, claim_tokens=None):
+    '''Generate validated version 2 PIB images for serial numbers make_sn(family, first ... first + count - 1).
+
+    Explicit claim_tokens (one per device, e.g. from a ledger lease) take precedence over the claim_token policy.
+    Returns one buffer with the images packed as 128 B records. Runs larger batches in a process pool.
+    '''
+    if count < 1:
+        raise PIBException('Bad count')
+    if claim_token not in CLAIM_TOKEN_POLICIES:
+        raise PIBException(f'Bad claim token policy: {claim_token}')
+    if claim_tokens and len(claim_tokens) != count:
+        raise PIBException('Number of claim tokens does not match count')
+
+    make_sn(family, first)
+    make_sn(family, first + count - 1)
+
+    fields = {
+        'vendor_name': vendor_name,
+        'product_name': product_name,
+        'hw_variant': hw_variant,
+        'hw_revision': hw_revision,
+        'ble_passkey': ble_passkey,
+    }
+
+    # Validate the fields once up front, before any worker is started
+    pib = PIB(2, nrf=True)
+    for name, value in fields.items():
+        getattr(pib, f'set_{name}')(value)
+
+    chunks = []
+    for i in range(0, count, CHUNK_SIZE):
+        n = min(CHUNK_SIZE, count - i)
+        chunks.append((first + i, n, claim_tokens[i:i + n] if claim_tokens else None))
+
+    if workers == 1 or len(chunks) == 1:
+        return b''.join(_generate_chunk(family, f, c, fields, claim_token, t) for f, c, t in chunks)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_generate_chunk, family, f, c, fields, claim_token, t) for f, c, t in chunks]
+        return b''.join(future.result() for future in futures)
+
+
+def iter_images(images):
+    view = memoryview(images)
+    for offset in range(0, len(view), IMAGE_SIZE):
+        yield view[offset:offset + IMAGE_SIZE]
+
+
+def select_image(images, serial_number=None):
+    '''Return a single image, selected by serial number from packed images when given.'''
+    if serial_number is None:
+        if len(images) != IMAGE_SIZE:
+            raise PIBException('Serial number is required to select image from a batch')
+        return bytes(images)
+    for buf in iter_images(images):
+        if PIBView(buf, nrf=True, check=False).get_serial_number() == str(serial_number):
+            return bytes(buf)
+    raise PIBException(f'Serial number {serial_number} not found in batch')
+
+
+def build_image(pib_buffer, pib_address, *images):
+    '''Merge firmware images and the PIB at pib_address into one image, later images win on overlap.'''
+    PIB(2, pib_buffer, nrf=True)
+
+    out = Image()
+    for image in images:
+        out.merge(image)
+    if out.overlaps(pib_address, len(pib_buffer)):
+        raise PIBException(f'Firmware image overlaps PIB area at 0x{pib_address:08X}')
+    out.add(pib_address, pib_buffer)
+    return out
+
+
+def write_images(images, format, output, address=None):
+    '''Write packed images as 'bin' file, 'jsonl' file or a directory of per-device 'hex' files.'''
+    if format == 'bin':
+        with open(output, 'wb') as f:
+            f.write(images)
+
+    elif format == 'jsonl':
+        with open(output, 'w') as f:
+            for buf in iter_images(images):
+                payload = PIBView(buf, nrf=True, check=False).get_dict()
+                payload['buffer'] = buf.hex()
+                f.write(json.dumps(payload) + '\n')
+
+    elif format == 'hex':
+        if address is None:
+            raise PIBException('PIB address is required for hex format')
+        os.makedirs(output, exist_ok=True)
+        for buf in iter_images(images):
+            sn = PIBView(buf, nrf=True, check=False).get_serial_number()
+            with open(os.path.join(output, f'{sn}.hex'), 'w') as f:
+                f.write(Image.from_bin(buf, address).to_ihex())
+
+    else:
+        raise PIBException(f'Unknown format: {format}')
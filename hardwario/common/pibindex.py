@@ -0,0 +1,181 @@
+import os
+import sqlite3
+from loguru import logger
+from hardwario.common.pib import PIBView
+
+DEFAULT_INDEX_PATH = os.path.expanduser("~/.hardwario/pib_index.db")
+
+RECORD_SIZE = 128
+
+# Stored in PRAGMA user_version, older indexes are rebuilt from their dumps
+SCHEMA_VERSION = 2
+
+COLUMNS = ('serial_number', 'family', 'vendor_name', 'product_name', 'hw_variant', 'hw_revision',
+           'claim_token', 'ble_passkey', 'source', 'offset')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS source (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pib (
+    serial_number INTEGER NOT NULL,
+    family INTEGER NOT NULL,
+    vendor_name TEXT NOT NULL,
+    product_name TEXT NOT NULL,
+    hw_variant TEXT NOT NULL,
+    hw_revision TEXT NOT NULL,
+    claim_token TEXT NOT NULL,
+    ble_passkey TEXT NOT NULL,
+    source TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    buffer BLOB NOT NULL,
+    PRIMARY KEY (source, offset)
+);
+CREATE INDEX IF NOT EXISTS pib_serial_number ON pib (serial_number);
+CREATE INDEX IF NOT EXISTS pib_family ON pib (family);
+CREATE INDEX IF NOT EXISTS pib_product ON pib (product_name, hw_revision);
+CREATE INDEX IF NOT EXISTS pib_claim_token ON pib (claim_token);
+'''
+
+
+class PIBIndexException(Exception):
+    pass
+
+
+class PIBIndex:
+    '''Persistent index of archived UICR PIB dumps (version 2, nRF).
+
+    Backed by SQLite with memory-mapped I/O, records are decoded once when indexed.
+    '''
+
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        self.path = path
+        self._db = None
+
+    def open(self):
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self._db = sqlite3.connect(self.path)
+        self._db.execute('PRAGMA mmap_size = 268435456')
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            if version:
+                logger.warning('Index {} has schema version {}, dumps must be indexed again', self.path, version)
+            with self._db:
+                self._db.execute('DROP TABLE IF EXISTS pib')
+                self._db.execute('DROP TABLE IF EXISTS source')
+                self._db.executescript(SCHEMA)
+                self._db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def add_path(self, path):
+        '''Index a dump file or every file in a directory tree, unchanged files are skipped.
+
+        Returns tuple (number of indexed records, number of invalid records).
+        '''
+        if os.path.isdir(path):
+            files = []
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        elif os.path.isfile(path):
+            files = [path]
+        else:
+            raise PIBIndexException(f'Path \'{path}\' does not exist.')
+
+        indexed = invalid = 0
+        with self._db:
+            self._prune()
+            for file_path in files:
+                n, e = self._add_file(os.path.abspath(file_path))
+                indexed += n
+                invalid += e
+        return indexed, invalid
+
+    def _prune(self):
+        # Files removed since they were indexed, their records must not resolve anymore
+        for path, in self._db.execute('SELECT path FROM source').fetchall():
+            if not os.path.isfile(path):
+                logger.debug('Pruning {}', path)
+                self._db.execute('DELETE FROM pib WHERE source = ?', (path,))
+                self._db.execute('DELETE FROM source WHERE path = ?', (path,))
+
+    def _add_file(self, path):
+        st = os.stat(path)
+        if st.st_size == 0 or st.st_size % RECORD_SIZE:
+            logger.debug('Skipping {} (size {} is not a multiple of {})', path, st.st_size, RECORD_SIZE)
+            return 0, 0
+
+        row = self._db.execute('SELECT size, mtime FROM source WHERE path = ?', (path,)).fetchone()
+        if row == (st.st_size, st.st_mtime_ns):
+            return 0, 0
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        rows = []
+        invalid = 0
+        view = memoryview(data)
+        for offset in range(0, len(view), RECORD_SIZE):
+            buf = view[offset:offset + RECORD_SIZE]
+            try:
+                pib = PIBView(buf, nrf=True)
+                rows.append((int(pib.get_serial_number()), pib.get_family(), pib.get_vendor_name(),
+                             pib.get_product_name(), pib.get_hw_variant(), pib.get_hw_revision(),
+                             pib.get_claim_token(), pib.get_ble_passkey(), path, offset, bytes(buf)))
+            except Exception as e:
+                logger.debug('Invalid record in {} at offset {}: {}', path, offset, e)
+                invalid += 1
+
+        # Records no longer in the file must not resolve to it, same transaction as the insert
+        self._db.execute('DELETE FROM pib WHERE source = ?', (path,))
+        self._db.executemany('INSERT OR REPLACE INTO pib VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self._db.execute('INSERT OR REPLACE INTO source VALUES (?, ?, ?)', (path, st.st_size, st.st_mtime_ns))
+        return len(rows), invalid
+
+    def query(self, limit=None, **filters):
+        '''Return list of dicts for records matching all given column=value filters.'''
+        where = []
+        params = []
+        for name, value in filters.items():
+            if value is None:
+                continue
+            if name not in COLUMNS:
+                raise PIBIndexException(f'Unknown field: {name}')
+            where.append(f'{name} = ?')
+            params.append(value)
+
+        sql = f'SELECT {", ".join(COLUMNS)} FROM pib'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY serial_number, source, offset'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        return [dict(zip(COLUMNS, row)) for row in self._db.execute(sql, params)]
+
+    def get_buffer(self, serial_number):
+        row = self._db.execute('SELECT buffer FROM pib WHERE serial_number = ? ORDER BY source, offset', (serial_number,)).fetchone()
+        return row[0] if row else None
+
+    def duplicates(self):
+        '''Return dict of serial number to number of records, for serial numbers found more than once.'''
+        sql = 'SELECT serial_number, COUNT(*) FROM pib GROUP BY serial_number HAVING COUNT(*) > 1 ORDER BY serial_number'
+        return dict(self._db.execute(sql))
+
+    def count(self):
+        return self._db.execute('SELECT COUNT(*) FROM pib').fetchone()[0]
@@ -1,13 +1,20 @@
 from loguru import logger
 import pylink
 import click
+from hardwario.device import daemon
 
 
 def jlink_setup(device, serial_no=None, speed=2000):
 
+    # The probe cannot be opened by pylink while a daemon session holds it
+    daemon.release(serial_no)
+
     jlink = pylink.JLink()
     jlink.open(serial_no=serial_no)
-    jlink.set_speed(speed)
+    if speed == 'auto':
+        jlink.set_speed(auto=True)
+    else:
+        jlink.set_speed(speed)
     jlink.set_tif(pylink.enums.JLinkInterfaces.SWD)
 
     logger.info(f'J-Link dll version: {jlink.version}')
@@ -9,10 +9,15 @@ from rttt.connectors import PyLinkRTTConnector, FileLogConnector
 from rttt.console import Console
 from hardwario.common.utils import download_url
 from hardwario.common.pib import PIB, PIBException
+from hardwario.common import image
+from hardwario.common.pibgen import generate, write_images, iter_images, CLAIM_TOKEN_POLICIES, UICR_PIB_ADDRESS, IMAGE_SIZE
+from hardwario.common.allocator import Ledger, Lease, DEFAULT_LEDGER_PATH
 from hardwario.chester.utils import find_hex
-from hardwario.device.nrfjprog import NRFJProg, DEFAULT_JLINK_SPEED_KHZ
+from hardwario.device.nrfjprog import NRFJProg, DEFAULT_JLINK_SPEED_KHZ, UICR_WRITE_RESULT_TEXT, VERIFY_STRATEGIES, CORES, MULTI_CORE_FAMILIES
 from hardwario.resources import get_resource_path
-from hardwario.device import jlink_setup
+from hardwario.device.speedtune import JLINK_SPEED
+from hardwario.device import jlink_setup, multiprobe, daemon, timing, dump
+from hardwario.device.timing import TIMINGS_FORMATS
 
 
 def validate_hex_file(ctx, param, value):
@@ -29,12 +34,22 @@ def validate_hex_file(ctx, param, value):
 def make_command_flash(cli: click.Group):
     @cli.command('flash')
     @click.option('--halt', is_flag=True, help='Halt program.')
+    @click.option('--delta', is_flag=True, help='Erase and program only flash pages that differ from the image.')
+    @click.option('--verify', type=click.Choice(VERIFY_STRATEGIES), help='Verify strategy [default: full, fast with --delta].')
+    @click.option('--timings', type=click.Choice(TIMINGS_FORMATS), help='Print per-phase timing records to stderr.')
+    @click.option('--timings-file', type=click.Path(dir_okay=False, writable=True), help='Append per-phase timing records (JSON lines) to file.')
     @click.argument('hex_file', metavar='HEX_FILE_OR_ID', callback=validate_hex_file, default=find_hex('.', no_exception=True))
     @click.pass_context
-    def command_flash(ctx, halt, hex_file):
+    def command_flash(ctx, halt, delta, verify, timings, timings_file, hex_file):
         '''Flash application firmware (preserves UICR area).'''
+        timing.attach(ctx, timings, timings_file)
         click.echo(f'File: {hex_file}')
 
+        if ctx.obj['probes']:
+            results = multiprobe.run(ctx.obj['prog'], ctx.obj['probes'], multiprobe.flash, (hex_file, halt, delta, verify))
+            multiprobe.echo_results(results)
+            return
+
         def progress(text, ctx={'len': 0}):
             if ctx['len']:
                 click.echo('\r' + (' ' * ctx['len']) + '\r', nl=False)
@@ -44,22 +59,76 @@ def make_command_flash(cli: click.Group):
             click.echo(text, nl=text == 'Successfully completed')
 
         with ctx.obj['prog'] as prog:
-            prog.program(hex_file, halt, progress=progress)
+            if delta:
+                result = prog.program_delta(hex_file, halt, progress=progress, verify=verify or 'fast')
+                click.echo(f'Pages written: {result["written"]}, skipped: {result["skipped"]}')
+                click.echo(f'Verify: {result["verify"]}')
+            else:
+                verify = prog.program(hex_file, halt, progress=progress, verify=verify or 'full')
+                click.echo(f'Verify: {verify}')
 
     return command_flash
 
 
+def validate_core_images(ctx, param, value):
+    images = []
+    for item in value:
+        core, sep, path = item.rpartition('=')
+        if sep and core not in CORES:
+            raise click.BadParameter(f'Unknown core \'{core}\' (use {", ".join(CORES)}).')
+        if not path.lower().endswith('.hex') or not os.path.exists(path):
+            raise click.BadParameter(f'HEX file \'{path}\' does not exist.')
+        images.append((core or None, path))
+    return images
+
+
+def make_command_flash_multi(cli: click.Group):
+    @cli.command('flash-multi')
+    @click.option('--halt', is_flag=True, help='Halt program.')
+    @click.option('--verify', type=click.Choice(VERIFY_STRATEGIES), help='Verify strategy.', default='full', show_default=True)
+    @click.option('--timings', type=click.Choice(TIMINGS_FORMATS), help='Print per-phase timing records to stderr.')
+    @click.option('--timings-file', type=click.Path(dir_okay=False, writable=True), help='Append per-phase timing records (JSON lines) to file.')
+    @click.argument('images', metavar='[CORE=]HEX_FILE...', nargs=-1, required=True, callback=validate_core_images)
+    @click.pass_context
+    def command_flash_multi(ctx, halt, verify, timings, timings_file, images):
+        '''Flash images of several cores in one session (core detected from image address when not given).'''
+        multiprobe.require_single_probe(ctx)
+        timing.attach(ctx, timings, timings_file)
+
+        with ctx.obj['prog'] as prog:
+            report = prog.program_cores(images, halt, progress=click.echo, verify=verify)
+
+        for item in report:
+            click.echo(f'{item["core"]:4} {item["file"]}  {item["bytes"]} B  verify: {item["verify"]}  {item["duration"]:.1f}s')
+
+    return command_flash_multi
+
+
 def make_command_erase(cli: click.Group):
     @cli.command('erase')
     @click.option('--all', is_flag=True, help='Erase application firmware incl. UICR area.')
+    @click.option('--allow-erase-all', is_flag=True, help='Use erase all and rewrite UICR when faster (UICR is lost if interrupted).')
+    @click.option('--timings', type=click.Choice(TIMINGS_FORMATS), help='Print per-phase timing records to stderr.')
+    @click.option('--timings-file', type=click.Path(dir_okay=False, writable=True), help='Append per-phase timing records (JSON lines) to file.')
+    @click.argument('hex_file', metavar='[HEX_FILE]', required=False, type=click.Path(exists=True, dir_okay=False))
     @click.pass_context
-    def command_erase(ctx, all):
-        '''Erase application firmware w/o UICR area.'''
+    def command_erase(ctx, all, allow_erase_all, timings, timings_file, hex_file):
+        '''Erase application firmware w/o UICR area (only pages used by HEX_FILE when given).'''
+        timing.attach(ctx, timings, timings_file)
+        if all and hex_file:
+            raise click.UsageError('Option --all cannot be used with HEX_FILE.')
+        if allow_erase_all and (all or hex_file):
+            raise click.UsageError('Option --allow-erase-all cannot be used with --all or HEX_FILE.')
+        if ctx.obj['probes']:
+            results = multiprobe.run(ctx.obj['prog'], ctx.obj['probes'], multiprobe.erase, (all, hex_file, allow_erase_all))
+            multiprobe.echo_results(results)
+            return
         with ctx.obj['prog'] as prog:
             if all:
                 prog.erase_all()
             else:
-                prog.erase_flash()
+                plan = prog.erase_flash(image.load(hex_file) if hex_file else None, allow_erase_all)
+                click.echo(f'Erase {plan}')
         click.echo('Successfully completed')
 
     return command_erase
@@ -71,6 +140,9 @@ def make_command_reset(cli: click.Group):
     @click.pass_context
     def command_reset(ctx, halt):
         '''Reset application firmware.'''
+        if ctx.obj['probes']:
+            multiprobe.echo_results(multiprobe.run(ctx.obj['prog'], ctx.obj['probes'], multiprobe.reset, (halt, )))
+            return
         with ctx.obj['prog'] as prog:
             prog.reset()
             if halt:
@@ -80,6 +152,44 @@ def make_command_reset(cli: click.Group):
     return command_reset
 
 
+def make_command_dump(cli: click.Group):
+    @cli.command('dump')
+    @click.option('--memory', type=click.Choice(list(dump.MEMORY_TYPES)), help='Memory to dump when --address is not given.', default='code', show_default=True)
+    @click.option('--address', type=dump.ADDRESS, help='Start address (decimal or 0x hexadecimal).')
+    @click.option('--size', type=dump.ADDRESS, help='Number of bytes [default: whole memory].')
+    @click.option('--sparse', is_flag=True, help='Write Intel HEX without erased (0xFF) pages.')
+    @click.option('--resume', is_flag=True, help='Continue an interrupted dump from its checkpoint.')
+    @click.option('--timings', type=click.Choice(TIMINGS_FORMATS), help='Print per-phase timing records to stderr.')
+    @click.option('--timings-file', type=click.Path(dir_okay=False, writable=True), help='Append per-phase timing records (JSON lines) to file.')
+    @click.argument('file', type=click.Path(dir_okay=False, writable=True))
+    @click.pass_context
+    def command_dump(ctx, memory, address, size, sparse, resume, timings, timings_file, file):
+        '''Dump memory (whole flash by default) to FILE.'''
+        multiprobe.require_single_probe(ctx)
+        if address is not None and not size:
+            raise click.UsageError('Option --address requires --size.')
+        timing.attach(ctx, timings, timings_file)
+
+        def progress(text, ctx={'len': 0}):
+            click.echo('\r' + text.ljust(ctx['len']), nl=False)
+            ctx['len'] = len(text)
+
+        with ctx.obj['prog'] as prog:
+            if address is None:
+                address, memory_size = dump.get_memory_range(prog, memory)
+                size = min(size, memory_size) if size else memory_size
+            click.echo(f'Dump: 0x{address:08X} - 0x{address + size:08X} ({size} B) to {file}')
+            start = time.monotonic()
+            read = dump.dump(prog, file, address, size, sparse=sparse, resume=resume, progress=progress)
+            elapsed = time.monotonic() - start
+
+        click.echo()
+        click.echo(f'Read {read} B in {elapsed:.1f}s ({read / max(elapsed, 1e-6) / 1024:.1f} KiB/s)')
+        click.echo('Successfully completed')
+
+    return command_dump
+
+
 def make_command_console(cli: click.Group, family):
 
     default_history_file = os.path.expanduser(f"~/.hio_history")
@@ -94,6 +204,7 @@ def make_command_console(cli: click.Group, family):
     @click.pass_context
     def command_console(ctx, reset, latency, history_file, console_file, device):
         '''Start interactive console for shell and logging.'''
+        multiprobe.require_single_probe(ctx)
 
         with ctx.obj['prog'] as prog:
             if reset:
@@ -129,6 +240,7 @@ def make_command_modem_flash(cli: click.Group):
         # https://www.nordicsemi.com/Products/Development-hardware/nRF9160-DK/Download
         if not file.endswith('.zip'):
             raise click.ClickException('File must be a ZIP archive')
+        multiprobe.require_single_probe(ctx)
 
         with ctx.obj['prog'] as prog:
             click.echo(f'Flash: {file}')
@@ -140,6 +252,8 @@ def make_command_modem_flash(cli: click.Group):
 
 def validate_pib_param(ctx, param, value):
     # print('validate_pib_param', ctx.obj, param.name, value)
+    if value is None:
+        return value
     try:
         getattr(ctx.obj['pib'], f'set_{param.name}')(value)
     except PIBException as e:
@@ -150,10 +264,13 @@ def validate_pib_param(ctx, param, value):
 def make_group_pib(cli: click.Group, family):
 
     @cli.group(name='pib')
+    @click.option('--timings', type=click.Choice(TIMINGS_FORMATS), help='Print per-phase timing records to stderr.')
+    @click.option('--timings-file', type=click.Path(dir_okay=False, writable=True), help='Append per-phase timing records (JSON lines) to file.')
     @click.pass_context
-    def group_pib(ctx):
+    def group_pib(ctx, timings, timings_file):
         '''HARDWARIO Product Information Block.'''
         ctx.obj['pib'] = PIB(2, nrf=True)
+        timing.attach(ctx, timings, timings_file)
 
     @group_pib.command('read')
     @click.option('--json', 'out_json', is_flag=True, help='Output in JSON format.')
@@ -161,6 +278,15 @@ def make_group_pib(cli: click.Group, family):
     def command_pib_read(ctx, out_json):
         '''Read HARDWARIO Product Information Block from UICR.'''
 
+        if ctx.obj['probes']:
+            results = multiprobe.run(ctx.obj['prog'], ctx.obj['probes'], multiprobe.read_uicr_pib)
+            for result in results:
+                if result.ok:
+                    pib = PIB(2, result.result, nrf=True)
+                    result.result = f'{pib.get_serial_number()} {pib.get_product_name()} {pib.get_hw_revision()}'
+            multiprobe.echo_results(results)
+            return
+
         buffer = None
         with ctx.obj['prog'] as prog:
             buffer = prog.read_uicr_pib()
@@ -189,8 +315,10 @@ def make_group_pib(cli: click.Group, family):
     @click.option('--claim-token', type=str, help='Claim token for device self-registration (32 hexadecimal characters).', default='', prompt=True, show_default=True, callback=validate_pib_param)
     @click.option('--ble-passkey', type=str, help='Bluetooth security passkey (max 16 characters).', default='123456', prompt=True, show_default=True, callback=validate_pib_param)
     @click.option('--halt', is_flag=True, help='Halt program.')
+    @click.option('--incremental', is_flag=True, help='Read UICR first, skip or avoid erase when possible.')
+    @click.option('--force-recover', is_flag=True, help='Recover device even when AP-protect is already disabled and the PIB is writable without erase.')
     @click.pass_context
-    def command_pib_write(ctx, vendor_name, product_name, hw_variant, hw_revision, serial_number, claim_token, ble_passkey, halt):
+    def command_pib_write(ctx, vendor_name, product_name, hw_variant, hw_revision, serial_number, claim_token, ble_passkey, halt, incremental, force_recover):
         '''Write HARDWARIO Product Information Block to UICR.'''
 
         logger.info(f'write pib: {vendor_name}, {product_name}, {hw_variant}, {hw_revision}, {serial_number}, {claim_token}, {ble_passkey}')
@@ -204,16 +332,76 @@ def make_group_pib(cli: click.Group, family):
 
         logger.info(f'buffer: {buffer.hex()}')
 
+        multiprobe.require_single_probe(ctx)
+
         with ctx.obj['prog'] as prog:
             if family == 'nRF91':
-                click.echo('Recovering device (This operation might take 30s.)')
-                prog.recover()
-                click.echo('Writing image to disable ap protect.')
-                prog.program_file(get_resource_path('nrf91_disable_ap_protect.hex'))
+                if not prog.disable_ap_protect(get_resource_path('nrf91_disable_ap_protect.hex'), buffer, force=force_recover, progress=click.echo):
+                    click.echo('AP-protect already disabled and PIB writable without erase, recover skipped')
 
             click.echo('Writing Product Information Block')
-            prog.write_uicr_pib(buffer, halt=halt)
+            result = prog.write_uicr_pib(buffer, halt=halt, incremental=incremental)
+            prog.verify_uicr_pib(buffer)
 
+        if incremental:
+            click.echo(UICR_WRITE_RESULT_TEXT[result])
+        click.echo('Successfully completed')
+
+    @group_pib.command('write-batch')
+    @click.option('--offset', type=click.IntRange(min=0), help='Index of the first image to use.', default=0, show_default=True)
+    @click.option('--halt', is_flag=True, help='Halt program.')
+    @click.option('--incremental', is_flag=True, help='Read UICR first, skip or avoid erase when possible.')
+    @click.option('--force-recover', is_flag=True, help='Recover device even when AP-protect is already disabled and the PIB is writable without erase.')
+    @click.argument('file', metavar='IMAGES_FILE', type=click.File('rb'))
+    @click.pass_context
+    def command_pib_write_batch(ctx, offset, halt, incremental, force_recover, file):
+        '''Write images from \'pib generate --format bin\', one per J-Link in the given order.'''
+        images = file.read()
+        probes = ctx.obj['probes'] or [ctx.obj['prog'].get_serial_number()]
+        buffers = list(iter_images(images))[offset:offset + len(probes)]
+        if len(images) % IMAGE_SIZE or len(buffers) < len(probes):
+            raise click.BadParameter(f'Not enough images for {len(probes)} J-Links.', param_hint='IMAGES_FILE')
+
+        disable_ap_protect_file = get_resource_path('nrf91_disable_ap_protect.hex') if family == 'nRF91' else None
+        args = (halt, incremental, disable_ap_protect_file, force_recover)
+        results = multiprobe.run(ctx.obj['prog'], probes, multiprobe.write_uicr_pib,
+                                 probe_args=[(bytes(buf), ) + args for buf in buffers])
+        for result, buf in zip(results, buffers):
+            sn = PIB(2, bytes(buf), nrf=True).get_serial_number()
+            result.result = f'{sn} {UICR_WRITE_RESULT_TEXT[result.result]}' if result.ok else result.result
+        multiprobe.echo_results(results)
+
+    @group_pib.command('generate')
+    @click.option('--vendor-name', type=str, help='Vendor name (max 16 characters).', default='HARDWARIO', show_default=True, callback=validate_pib_param)
+    @click.option('--product-name', type=str, help='Product name (max 16 characters).', default=family.upper(), show_default=True, callback=validate_pib_param)
+    @click.option('--hw-variant', type=str, help='Hardware variant.', default='', show_default=True, callback=validate_pib_param)
+    @click.option('--hw-revision', type=str, help='Hardware revision in Rx.y format.', default='R0.1', show_default=True, callback=validate_pib_param)
+    @click.option('--serial-number', type=str, help='First serial number in decimal format.', callback=validate_pib_param)
+    @click.option('--count', type=click.IntRange(min=1), help='Number of images.')
+    @click.option('--lease', 'lease_file', type=click.File('r'), help='Lease JSON from \'device ledger lease\' (serial numbers and claim tokens).')
+    @click.option('--claim-token-policy', type=click.Choice(CLAIM_TOKEN_POLICIES), help='Claim token policy.', default='random', show_default=True)
+    @click.option('--ble-passkey', type=str, help='Bluetooth security passkey (max 16 characters).', default='123456', show_default=True, callback=validate_pib_param)
+    @click.option('--format', type=click.Choice(['bin', 'hex', 'jsonl']), help='Specify output format (hex writes one file per device).', required=True)
+    @click.option('--workers', type=click.IntRange(min=1), help='Number of worker processes (default: CPU count).')
+    @click.argument('output', type=click.Path(writable=True))
+    @click.pass_context
+    def command_pib_generate(ctx, vendor_name, product_name, hw_variant, hw_revision, serial_number, count, lease_file, claim_token_policy, ble_passkey, format, workers, output):
+        '''Generate Product Information Block images for a batch of devices.'''
+        if lease_file:
+            lease = Lease.from_dict(json.load(lease_file))
+            sn_family, first, count, claim_tokens = lease.family, lease.first, lease.count, lease.claim_tokens
+        elif serial_number and count:
+            sn = int(serial_number)
+            sn_family, first, claim_tokens = (sn >> 20) & 1023, sn & 0xfffff, None
+        else:
+            raise click.UsageError('Use either --serial-number with --count or --lease.')
+
+        start = time.time()
+        images = generate(sn_family, first, count, vendor_name=vendor_name, product_name=product_name,
+                          hw_variant=hw_variant, hw_revision=hw_revision, ble_passkey=ble_passkey,
+                          claim_token=claim_token_policy, workers=workers, claim_tokens=claim_tokens)
+        write_images(images, format, output, address=UICR_PIB_ADDRESS[family.upper()])
+        click.echo(f'Generated {count} images in {time.time() - start:.1f}s')
         click.echo('Successfully completed')
 
 
@@ -223,18 +411,112 @@ def cli(ctx):
     pass
 
 
+@cli.group(name='ledger')
+@click.option('--ledger-file', type=click.Path(dir_okay=False, writable=True), help='Ledger database file (can be shared between stations).', default=DEFAULT_LEDGER_PATH, show_default=True)
+@click.pass_context
+def group_ledger(ctx, ledger_file):
+    '''Serial number and claim token allocation.'''
+    ctx.obj['ledger'] = Ledger(ledger_file)
+
+
+@group_ledger.command('init')
+@click.option('--family', type=click.IntRange(0, 1023), help='Product family.', required=True)
+@click.option('--next', 'next_sn', type=click.IntRange(0, 1048575), help='Next serial number within the family (lower 20 bits).', required=True)
+@click.pass_context
+def command_ledger_init(ctx, family, next_sn):
+    '''Set the next serial number handed out for a family.'''
+    with ctx.obj['ledger'] as ledger:
+        ledger.set_next(family, next_sn)
+    click.echo('Successfully completed')
+
+
+@group_ledger.command('lease')
+@click.option('--family', type=click.IntRange(0, 1023), help='Product family.', required=True)
+@click.option('--count', type=click.IntRange(min=1), help='Number of serial numbers.', required=True)
+@click.option('--station', type=str, help='Station name recorded with the lease.', default='', show_default=True)
+@click.option('--no-claim-tokens', is_flag=True, help='Do not issue claim tokens.')
+@click.argument('file', type=click.File('w'), default='-')
+@click.pass_context
+def command_ledger_lease(ctx, family, count, station, no_claim_tokens, file):
+    '''Lease a block of serial numbers with unique claim tokens to <FILE> or stdout (JSON).'''
+    with ctx.obj['ledger'] as ledger:
+        lease = ledger.lease(family, count, station=station, claim_tokens=not no_claim_tokens)
+    file.write(json.dumps(lease.get_dict(), indent=2) + '\n')
+
+
+@group_ledger.command('list')
+@click.option('--family', type=click.IntRange(0, 1023), help='Product family.')
+@click.pass_context
+def command_ledger_list(ctx, family):
+    '''List leases.'''
+    with ctx.obj['ledger'] as ledger:
+        for lease in ledger.leases(family):
+            sn = lease.serial_numbers()
+            click.echo(f'{lease.id:5} family {lease.family:4} {sn[0]}-{sn[-1]} ({lease.count}) {lease.station}')
+
+
+@click.group(name='daemon')
+@click.option('--socket', 'socket_path', type=click.Path(dir_okay=False), help='Unix socket path.', default=daemon.DEFAULT_SOCKET_PATH, show_default=True)
+@click.pass_context
+def cli_daemon(ctx, socket_path):
+    '''Probe session daemon (keeps J-Link connections open between commands).'''
+    ctx.obj['socket'] = socket_path
+
+
+@cli_daemon.command('start')
+@click.option('--idle-timeout', type=click.IntRange(min=0), help='Close sessions idle for seconds (0 never).', default=daemon.DEFAULT_IDLE_TIMEOUT, show_default=True)
+@click.pass_context
+def command_daemon_start(ctx, idle_timeout):
+    '''Start daemon in background.'''
+    daemon.start(ctx.obj['socket'], idle_timeout)
+    click.echo('Successfully completed')
+
+
+@cli_daemon.command('run')
+@click.option('--idle-timeout', type=click.IntRange(min=0), help='Close sessions idle for seconds (0 never).', default=daemon.DEFAULT_IDLE_TIMEOUT, show_default=True)
+@click.pass_context
+def command_daemon_run(ctx, idle_timeout):
+    '''Run daemon in foreground.'''
+    daemon.Daemon(ctx.obj['socket'], idle_timeout).run()
+
+
+@cli_daemon.command('stop')
+@click.pass_context
+def command_daemon_stop(ctx):
+    '''Stop daemon and close all sessions.'''
+    daemon.request('stop', ctx.obj['socket'])
+    click.echo('Successfully completed')
+
+
+@cli_daemon.command('status')
+@click.pass_context
+def command_daemon_status(ctx):
+    '''List open sessions.'''
+    sessions = daemon.request('status', ctx.obj['socket'])
+    click.echo(f'Sessions: {len(sessions)}')
+    for s in sessions:
+        state = 'busy' if s['busy'] else f'idle {s["idle"]:.0f}s'
+        click.echo(f'{s["jlink_sn"] or "-":>12}  {s["device_family"] or "-":8} {s["jlink_speed"]} kHz  calls {s["calls"]}  {state}')
+
+
 def make_group(family: str):
     @cli.group(name=family.lower(), help=f'Commands for {family} devices.')
-    @click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', help='J-Link serial number')
-    @click.option('--jlink-speed', type=int, metavar="SPEED", help='J-Link clock speed in kHz', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
+    @click.option('--jlink-sn', '-n', type=int, metavar='SERIAL_NUMBER', multiple=True, help='J-Link serial number (repeat to run on several J-Links in parallel)')
+    @click.option('--all-probes', is_flag=True, help='Run on all connected J-Links in parallel')
+    @click.option('--jlink-speed', type=JLINK_SPEED, metavar="SPEED", help='J-Link clock speed in kHz or auto', default=DEFAULT_JLINK_SPEED_KHZ, show_default=True)
     @click.pass_context
-    def group(ctx, jlink_sn, jlink_speed):
-        ctx.obj['prog'] = NRFJProg(family, jlink_sn=jlink_sn, jlink_speed=jlink_speed)
+    def group(ctx, jlink_sn, all_probes, jlink_speed):
+        probes = multiprobe.select_probes(jlink_sn, all_probes)
+        ctx.obj['prog'] = NRFJProg(family, jlink_sn=probes[0] if probes else None, jlink_speed=jlink_speed)
+        ctx.obj['probes'] = probes if len(probes) > 1 else None
         ctx.obj['family'] = family
 
     make_command_flash(group)
+    if family in MULTI_CORE_FAMILIES:
+        make_command_flash_multi(group)
     make_command_erase(group)
     make_command_reset(group)
+    make_command_dump(group)
     make_command_console(group, family)
 
     if family in ['nRF91']:
@@ -0,0 +1,525 @@
+import os
+import sys
+import time
+import socket
+import json
+import struct
+import importlib
+import threading
+import subprocess
+import socketserver
+from loguru import logger
+from pynrfjprog import APIError
+from pynrfjprog.Parameters import MemoryDescription
+from hardwario.device import devicecache, nrfjprog
+
+DEFAULT_SOCKET_PATH = os.path.expanduser("~/.hardwario/daemon.sock")
+
+DEFAULT_IDLE_TIMEOUT = 300
+
+# Programmer classes the daemon is allowed to instantiate
+CLASSES = (
+    'hardwario.device.nrfjprog.NRFJProg',
+    'hardwario.chester.nrfjprog.NRFJProg',
+)
+
+# Methods forwarded to the daemon, everything else is served by the local (unopened) object
+METHODS = frozenset((
+    'program', 'program_delta', 'program_cores', 'program_file', 'verify', 'verify_image', 'select_coprocessor',
+    'erase_all', 'erase_flash', 'erase_uicr', 'erase_page', 'plan_erase', 'execute_erase', 'recover',
+    'is_ap_protected', 'disable_ap_protect',
+    'reset', 'halt', 'go', 'sys_reset',
+    'read', 'write', 'read_ranges', 'read_memory_descriptors', 'read_device_family', 'get_chip_name',
+    'get_uicr_address', 'get_uicr_pib_address', 'get_uicr_descriptor',
+    'read_uicr', 'write_uicr', 'read_uicr_pib', 'write_uicr_pib', 'verify_uicr_pib',
+    'rtt_start', 'rtt_stop', 'rtt_is_running', 'rtt_read', 'rtt_write',
+))
+
+
+# Exceptions re-raised by class on the client side, matched by the nearest listed base class,
+# anything else arrives as DaemonException with the message
+EXCEPTIONS = (
+    'pynrfjprog.APIError.APIError',
+    'hardwario.device.daemon.DaemonException',
+    'hardwario.device.nrfjprog.NRFJProgException',
+    'hardwario.device.nrfjprog.NRFJProgOpenException',
+    'hardwario.device.nrfjprog.NRFJProgDeviceFamilyException',
+    'hardwario.device.nrfjprog.NRFJProgRTTNoChannels',
+    'hardwario.common.pib.PIBException',
+    'hardwario.common.image.ImageException',
+    'builtins.ValueError',
+    'builtins.TimeoutError',
+    'builtins.FileNotFoundError',
+    'builtins.OSError',
+)
+
+
+class DaemonException(Exception):
+    pass
+
+
+def _import(name):
+    module, name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)
+
+
+def _encode(value):
+    # JSON with tagged objects for the types passed to and returned from METHODS
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': bytes(value).hex()}
+    if isinstance(value, tuple):
+        return {'__tuple__': [_encode(v) for v in value]}
+    if isinstance(value, list):
+        return [_encode(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _encode(v) for k, v in value.items()}
+    if isinstance(value, nrfjprog.ErasePlan):
+        return {'__erase_plan__': [value.strategy, _encode(value.pages), value.estimated_time, value.actual_time]}
+    if isinstance(value, (MemoryDescription, devicecache.Descriptor)):
+        return {'__descriptor__': [value.start, value.size, value.num_pages, int(value.type), value.access_flags, value.label]}
+    raise DaemonException(f'Unsupported value type: {type(value).__name__}')
+
+
+def _decode(value):
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if '__bytes__' in value:
+        return bytes.fromhex(value['__bytes__'])
+    if '__tuple__' in value:
+        return tuple(_decode(v) for v in value['__tuple__'])
+    if '__erase_plan__' in value:
+        strategy, pages, estimated_time, actual_time = value['__erase_plan__']
+        plan = nrfjprog.ErasePlan(strategy, _decode(pages), estimated_time)
+        plan.actual_time = actual_time
+        return plan
+    if '__descriptor__' in value:
+        return devicecache.Descriptor(*value['__descriptor__'])
+    return {k: _decode(v) for k, v in value.items()}
+
+
+def _encode_exception(e):
+    for cls in type(e).__mro__:
+        name = f'{cls.__module__}.{cls.__qualname__}'
+        if name in EXCEPTIONS:
+            break
+    else:
+        return {'class': 'hardwario.device.daemon.DaemonException', 'message': f'{e.__class__.__name__}: {e}'}
+    error = {'class': name, 'message': str(e)}
+    if isinstance(e, APIError.APIError):
+        error.update(err_code=e.err_code, err_msg=e.err_msg)
+    return error
+
+
+def _decode_exception(error):
+    if error.get('class') not in EXCEPTIONS:
+        return DaemonException(error.get('message'))
+    cls = _import(error['class'])
+    if issubclass(cls, APIError.APIError):
+        return cls(error['err_code'], error['err_msg'])
+    return cls(error['message'])
+
+
+def _pack(obj):
+    data = json.dumps(_encode(obj)).encode()
+    return struct.pack('<I', len(data)) + data
+
+
+def _send(sock, obj):
+    sock.sendall(_pack(obj))
+
+
+def _recv_exact(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+
+def _recv(sock):
+    header = _recv_exact(sock, 4)
+    if header is None:
+        return None
+    size, = struct.unpack('<I', header)
+    data = _recv_exact(sock, size)
+    if data is None:
+        return None
+    return _decode(json.loads(data))
+
+
+def _abspath(value):
+    # The daemon has its own working directory, resolve relative file arguments on the client side
+    if isinstance(value, str) and value and not os.path.isabs(value) and os.path.exists(value):
+        return os.path.abspath(value)
+    return value
+
+
+def is_enabled(path=DEFAULT_SOCKET_PATH):
+    return hasattr(socket, 'AF_UNIX') and not os.environ.get('HARDWARIO_NO_DAEMON') and os.path.exists(path)
+
+
+def _connect_socket(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as e:
+        sock.close()
+        logger.debug('Daemon socket {} not available: {}', path, e)
+        return None
+    return sock
+
+
+class Session:
+    '''Client side of a daemon session, forwards NRFJProg method calls over the socket.'''
+
+    def __init__(self, prog, sock):
+        self._prog = prog
+        self._sock = sock
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in METHODS:
+            return getattr(self._prog, name)
+
+        def call(*args, **kwargs):
+            return self._call(name, args, kwargs)
+        return call
+
+    def _request(self, request, progress=None):
+        _send(self._sock, request)
+        while True:
+            reply = _recv(self._sock)
+            if reply is None:
+                raise DaemonException('Daemon closed connection')
+            if 'progress' in reply:
+                if progress:
+                    progress(reply['progress'])
+                continue
+            if 'event' in reply:
+                if self._prog.on_event is not None:
+                    self._prog.on_event(reply['event'])
+                continue
+            if 'error' in reply:
+                raise _decode_exception(reply['error'])
+            return reply['result']
+
+    def _call(self, method, args, kwargs):
+        progress = kwargs.pop('progress', None)
+        request = {
+            'op': 'call',
+            'method': method,
+            'args': tuple(_abspath(a) for a in args),
+            'kwargs': {k: _abspath(v) for k, v in kwargs.items()},
+            'progress': progress is not None,
+        }
+        return self._request(request, progress)
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+def connect(prog, path=DEFAULT_SOCKET_PATH):
+    '''Return Session for prog when the daemon is running, None otherwise.'''
+    name = f'{type(prog).__module__}.{type(prog).__qualname__}'
+    if name not in CLASSES or prog._jlink_ip or not is_enabled(path):
+        return None
+
+    sock = _connect_socket(path)
+    if sock is None:
+        return None
+
+    session = Session(prog, sock)
+    try:
+        session._request({
+            'op': 'open',
+            'class': name,
+            'device_family': prog.device_family,
+            'jlink_sn': prog.get_serial_number(),
+            'jlink_speed': prog.get_speed(),
+            'log': prog._log,
+            'events': prog.on_event is not None,
+        })
+    except BaseException:
+        session.close()
+        raise
+    logger.debug('Using daemon session for J-Link {}', prog.get_serial_number())
+    return session
+
+
+def request(op, path=DEFAULT_SOCKET_PATH):
+    '''Send a control request ('status' or 'stop') to the daemon.'''
+    sock = _connect_socket(path) if hasattr(socket, 'AF_UNIX') and os.path.exists(path) else None
+    if sock is None:
+        raise DaemonException('Daemon is not running')
+    try:
+        return Session(None, sock)._request({'op': op})
+    finally:
+        sock.close()
+
+
+def release(jlink_sn=None, path=DEFAULT_SOCKET_PATH):
+    '''Close daemon sessions of the J-Link (of all J-Links for None) before another library (pylink) opens it.'''
+    sock = _connect_socket(path) if is_enabled(path) else None
+    if sock is None:
+        return 0
+    try:
+        return Session(None, sock)._request({'op': 'release', 'jlink_sn': jlink_sn})
+    finally:
+        sock.close()
+
+
+def start(path=DEFAULT_SOCKET_PATH, idle_timeout=DEFAULT_IDLE_TIMEOUT, timeout=10):
+    '''Start daemon in a detached process and wait until it accepts connections.'''
+    if not hasattr(socket, 'AF_UNIX'):
+        raise DaemonException('Daemon requires Unix domain socket support')
+    sock = _connect_socket(path) if os.path.exists(path) else None
+    if sock is not None:
+        sock.close()
+        raise DaemonException('Daemon is already running')
+
+    subprocess.Popen([sys.executable, '-m', 'hardwario', 'daemon', '--socket', path, 'run', '--idle-timeout', str(idle_timeout)],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        sock = _connect_socket(path) if os.path.exists(path) else None
+        if sock is not None:
+            sock.close()
+            return
+        time.sleep(0.1)
+    raise DaemonException('Daemon did not start')
+
+
+class _Entry:
+
+    def __init__(self, key, prog):
+        self.key = key
+        self.prog = prog
+        self.lock = threading.Lock()
+        self.closed = False
+        self.calls = 0
+        self.last_used = time.monotonic()
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        self.server.daemon.handle(self.request)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon:
+    '''Keeps opened NRFJProg sessions per J-Link and serves them over a Unix socket.
+
+    A session is used by one client connection at a time, sessions idle for longer
+    than idle_timeout seconds are closed to release the J-Link.
+    '''
+
+    def __init__(self, path=DEFAULT_SOCKET_PATH, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def run(self):
+        # Sessions opened by the daemon itself must not be forwarded back to it
+        os.environ['HARDWARIO_NO_DAEMON'] = '1'
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+        umask = os.umask(0o177)
+        try:
+            self._server = _Server(self.path, _Handler)
+        finally:
+            os.umask(umask)
+        self._server.daemon = self
+
+        threading.Thread(target=self._housekeeping, daemon=True).start()
+
+        logger.info('Daemon listening on {}', self.path)
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            with self._lock:
+                for entry in list(self._entries.values()):
+                    self._close(entry)
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            logger.info('Daemon stopped')
+
+    def stop(self):
+        threading.Thread(target=self._server.shutdown, daemon=True).start()
+
+    def status(self):
+        now = time.monotonic()
+        with self._lock:
+            return [{
+                'class': entry.key[0],
+                'device_family': entry.key[1],
+                'jlink_sn': entry.key[2],
+                'jlink_speed': entry.key[3],
+                'busy': entry.lock.locked(),
+                'calls': entry.calls,
+                'idle': now - entry.last_used,
+            } for entry in self._entries.values()]
+
+    def _housekeeping(self):
+        while True:
+            time.sleep(5)
+            if not self.idle_timeout:
+                continue
+            now = time.monotonic()
+            with self._lock:
+                for entry in list(self._entries.values()):
+                    if now - entry.last_used > self.idle_timeout and entry.lock.acquire(blocking=False):
+                        logger.debug('Closing idle session {}', entry.key)
+                        self._close(entry)
+                        entry.lock.release()
+
+    def release(self, jlink_sn):
+        with self._lock:
+            entries = [entry for entry in self._entries.values() if jlink_sn is None or entry.key[2] in (None, jlink_sn)]
+        for entry in entries:
+            # Waits for the client using the session
+            with entry.lock:
+                with self._lock:
+                    if not entry.closed:
+                        logger.debug('Releasing session {}', entry.key)
+                        self._close(entry)
+        return len(entries)
+
+    def _close(self, entry):
+        # Called with self._lock held, clients waiting for entry.lock look the session up again
+        entry.closed = True
+        if self._entries.get(entry.key) is entry:
+            del self._entries[entry.key]
+        if entry.prog.is_opened:
+            try:
+                entry.prog.close()
+            except Exception as e:
+                logger.warning('Closing session {} failed: {}', entry.key, e)
+
+    def _acquire(self, request, sock):
+        if request['class'] not in CLASSES:
+            raise DaemonException(f'Unsupported class: {request["class"]}')
+        key = (request['class'], request['device_family'], request['jlink_sn'], request['jlink_speed'], request['log'])
+
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    cls = _import(request['class'])
+                    prog = cls(request['device_family'], jlink_sn=request['jlink_sn'], jlink_speed=request['jlink_speed'], log=request['log'])
+                    entry = self._entries[key] = _Entry(key, prog)
+
+            entry.lock.acquire()
+            if not entry.closed:
+                break
+            # Closed while waiting (idle timeout, probe error), its J-Link is released
+            entry.lock.release()
+
+        # Phase events are streamed to the client holding the session
+        entry.prog.on_event = (lambda event: _send(sock, {'event': event})) if request.get('events') else None
+        try:
+            if entry.prog.is_opened and not self._is_same_device(entry):
+                # Device swapped on the probe, cached family and descriptors are stale
+                logger.debug('Device changed, reopening session {}', key)
+                entry.prog.close()
+            if not entry.prog.is_opened:
+                logger.debug('Opening session {}', key)
+                entry.prog.open()
+                entry.prog.is_same_device()
+        except BaseException:
+            with self._lock:
+                self._close(entry)
+            entry.lock.release()
+            raise
+        return entry
+
+    def _is_same_device(self, entry):
+        try:
+            return entry.prog.is_same_device()
+        except APIError.APIError as e:
+            logger.debug('Reading device ID of session {} failed: {}', entry.key, e)
+            return False
+
+    def _call(self, entry, request, sock):
+        if entry is None:
+            raise DaemonException('Session is not open')
+        if entry.closed:
+            raise DaemonException('Session was closed after a probe error')
+        method = request['method']
+        if method not in METHODS:
+            raise DaemonException(f'Unsupported method: {method}')
+
+        kwargs = request['kwargs']
+        if request['progress']:
+            kwargs['progress'] = lambda text: _send(sock, {'progress': text})
+
+        entry.calls += 1
+        try:
+            return getattr(entry.prog, method)(*request['args'], **kwargs)
+        except APIError.APIError:
+            # Connection state is unknown, reconnect on next use
+            with self._lock:
+                self._close(entry)
+            raise
+        finally:
+            entry.last_used = time.monotonic()
+
+    def handle(self, sock):
+        entry = None
+        try:
+            while True:
+                request = _recv(sock)
+                if request is None:
+                    break
+                op = request.get('op') if isinstance(request, dict) else None
+                try:
+                    if op == 'open':
+                        if entry is not None:
+                            raise DaemonException('Session is already open')
+                        entry = self._acquire(request, sock)
+                        result = True
+                    elif op == 'call':
+                        result = self._call(entry, request, sock)
+                    elif op == 'release':
+                        if entry is not None:
+                            raise DaemonException('Session is open')
+                        result = self.release(request.get('jlink_sn'))
+                    elif op == 'status':
+                        result = self.status()
+                    elif op == 'stop':
+                        self.stop()
+                        result = True
+                    else:
+                        raise DaemonException(f'Unknown request: {op}')
+                    # Encoded before anything is written, an unsupported result is reported as error
+                    reply = _pack({'result': result})
+                except Exception as e:
+                    logger.debug('Request {} failed: {}', op, e)
+                    reply = _pack({'error': _encode_exception(e)})
+                sock.sendall(reply)
+        except (OSError, ValueError) as e:
+            logger.debug('Client connection error: {}', e)
+        finally:
+            if entry is not None:
+                entry.prog.on_event = None
+                entry.last_used = time.monotonic()
+                entry.lock.release()
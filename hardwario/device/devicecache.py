@@ -0,0 +1,108 @@
+import os
+import json
+import time
+from loguru import logger
+from pynrfjprog.Parameters import DeviceVersion, DeviceName, DeviceMemory, DeviceRevision, MemoryType
+
+DEFAULT_CACHE_PATH = os.path.expanduser("~/.hardwario/device_cache.json")
+
+# FICR DEVICEID (64 bit), unique per chip
+DEVICE_ID_ADDRESS = {
+    'NRF52': 0x10000060,
+    'NRF53': 0x00FF0204,
+    'NRF91': 0x00FF0204,
+}
+
+DEVICE_INFO_TYPES = (DeviceVersion, DeviceName, DeviceMemory, DeviceRevision)
+
+
+class Descriptor:
+    '''Memory descriptor restored from the cache, same attributes as pynrfjprog MemoryDescription.'''
+
+    def __init__(self, start, size, num_pages, type, access_flags, label):
+        self.start = start
+        self.size = size
+        self.num_pages = num_pages
+        self.type = MemoryType(type)
+        self.access_flags = access_flags
+        self.label = label
+        self.page_repetitions = None
+
+
+def is_enabled():
+    return not os.environ.get('HARDWARIO_NO_DEVICE_CACHE')
+
+
+def _load(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning('Invalid device cache {}: {}', path, e)
+        return {}
+
+
+def _save(path, jlink_sn, entry):
+    # Re-read right before the write, other processes may have updated the file
+    cache = _load(path)
+    if entry is None:
+        if cache.pop(str(jlink_sn), None) is None:
+            return
+    else:
+        cache[str(jlink_sn)] = entry
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    tmp = f'{path}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp, path)
+
+
+def read_device_id(prog, device_family):
+    '''Read hardware ID of the connected device as hex string, None for unknown family.'''
+    address = DEVICE_ID_ADDRESS.get(device_family)
+    if address is None:
+        return None
+    return bytes(prog.read(address, 8)).hex()
+
+
+def lookup(jlink_sn, path=DEFAULT_CACHE_PATH):
+    '''Return metadata cached for the device last seen on probe, None when not cached.'''
+    entry = _load(path).get(str(jlink_sn))
+    if not entry or 'device_id' not in entry or 'device_family' not in entry:
+        return None
+    return entry
+
+
+def forget(jlink_sn, path=DEFAULT_CACHE_PATH):
+    _save(path, jlink_sn, None)
+
+
+def store(jlink_sn, device_id, metadata, path=DEFAULT_CACHE_PATH):
+    '''Store session metadata (device_family, device_info, memory_descriptors) of the device on probe.'''
+    entry = {'device_id': device_id, 'device_family': metadata['device_family'], 'updated_at': time.time()}
+    if 'device_info' in metadata:
+        entry['device_info'] = [int(value) for value in metadata['device_info']]
+    if 'memory_descriptors' in metadata:
+        entry['memory_descriptors'] = [{
+            'start': des.start,
+            'size': des.size,
+            'num_pages': des.num_pages,
+            'type': int(des.type),
+            'access_flags': des.access_flags,
+            'label': des.label,
+        } for des in metadata['memory_descriptors']]
+    _save(path, jlink_sn, entry)
+
+
+def decode(entry):
+    '''Return session metadata from cache entry.'''
+    metadata = {'device_family': entry['device_family'], 'device_id': entry['device_id']}
+    if 'device_info' in entry:
+        metadata['device_info'] = tuple(t(value) for t, value in zip(DEVICE_INFO_TYPES, entry['device_info']))
+    if 'memory_descriptors' in entry:
+        metadata['memory_descriptors'] = [Descriptor(**des) for des in entry['memory_descriptors']]
+    return metadata
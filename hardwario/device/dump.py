@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import click
+from loguru import logger
+from pynrfjprog.Parameters import MemoryType
+from hardwario.common import image
+
+CHUNK_SIZE = 0x10000
+
+SPARSE_PAGE_SIZE = 0x1000
+
+MEMORY_TYPES = {
+    'code': MemoryType.CODE,
+    'uicr': MemoryType.UICR,
+    'ficr': MemoryType.FICR,
+    'ram': MemoryType.DATA_RAM,
+}
+
+
+class DumpException(Exception):
+    pass
+
+
+class AddressType(click.ParamType):
+    '''Integer in decimal or 0x prefixed hexadecimal format.'''
+    name = 'address'
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, int):
+            return value
+        try:
+            value = int(value, 0)
+        except (TypeError, ValueError):
+            self.fail(f'{value!r} is not a valid number', param, ctx)
+        if value < 0:
+            self.fail('Value must not be negative', param, ctx)
+        return value
+
+
+ADDRESS = AddressType()
+
+
+def get_memory_range(prog, memory):
+    '''Return (address, size) of the first memory of type from memory descriptors.'''
+    descriptors = [des for des in prog.read_memory_descriptors(False) if des.type == MEMORY_TYPES[memory]]
+    if not descriptors:
+        raise DumpException(f'Memory {memory} not found on device')
+    des = min(descriptors, key=lambda des: des.start)
+    if len(descriptors) > 1:
+        logger.warning('Device has {} {} memories, using the one at 0x{:08X}', len(descriptors), memory, des.start)
+    return des.start, des.size
+
+
+def _checkpoint_path(path):
+    return f'{path}.checkpoint'
+
+
+def _load_checkpoint(path, address, size, sparse):
+    try:
+        with open(_checkpoint_path(path), 'r') as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return None
+    if (checkpoint.get('address'), checkpoint.get('size'), checkpoint.get('sparse')) != (address, size, sparse):
+        raise DumpException('Checkpoint does not match the requested range, remove it or dump to another file')
+    if not os.path.exists(path) or os.path.getsize(path) < checkpoint['file_size']:
+        raise DumpException('Output file is shorter than the checkpoint')
+    return checkpoint
+
+
+def _save_checkpoint(path, checkpoint):
+    tmp = _checkpoint_path(path) + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp, _checkpoint_path(path))
+
+
+def _sparse_records(address, data):
+    '''Intel HEX records of data without erased (0xFF) pages, w/o end of file record.'''
+    img = image.Image()
+    for offset in range(0, len(data), SPARSE_PAGE_SIZE):
+        page = data[offset:offset + SPARSE_PAGE_SIZE]
+        if page.count(0xff) != len(page):
+            img.add(address + offset, page)
+    if not img:
+        return ''
+    return img.to_ihex().rsplit(':', 1)[0]
+
+
+def dump(prog, path, address, size, sparse=False, resume=False, chunk_size=CHUNK_SIZE, progress=lambda x: None):
+    '''Stream memory range to file in chunks, returns number of bytes read.
+
+    Output is raw binary, or with sparse Intel HEX w/o erased pages. After every chunk
+    a checkpoint is written next to the file, with resume an interrupted dump continues
+    from it. The checkpoint is removed when the dump completes.
+    '''
+    checkpoint = _load_checkpoint(path, address, size, sparse) if resume else None
+    if checkpoint is None:
+        checkpoint = {'address': address, 'size': size, 'sparse': sparse, 'next': address, 'file_size': 0}
+    else:
+        logger.debug('Resuming dump at 0x{:08X}', checkpoint['next'])
+
+    end = address + size
+    done = checkpoint['next'] - address
+    start = time.monotonic()
+
+    with prog.phase('dump', bytes=end - checkpoint['next']):
+        with open(path, 'r+b' if checkpoint['file_size'] else 'wb') as f:
+            f.truncate(checkpoint['file_size'])
+            f.seek(checkpoint['file_size'])
+
+            for addr in range(checkpoint['next'], end, chunk_size):
+                data = bytes(prog.read(addr, min(chunk_size, end - addr)))
+                f.write(_sparse_records(addr, data).encode() if sparse else data)
+                f.flush()
+
+                checkpoint['next'] = addr + len(data)
+                checkpoint['file_size'] = f.tell()
+                _save_checkpoint(path, checkpoint)
+
+                rate = (checkpoint['next'] - address - done) / max(time.monotonic() - start, 1e-6)
+                progress(f'Reading 0x{checkpoint["next"]:08X} {100 * (checkpoint["next"] - address) // size}% {rate / 1024:.1f} KiB/s')
+
+            if sparse:
+                f.write(b':00000001FF\n')
+
+    os.unlink(_checkpoint_path(path))
+    return size - done
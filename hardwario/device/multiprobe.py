@@ -0,0 +1,143 @@
+import os
+import time
+import click
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from loguru import logger
+from pynrfjprog import LowLevel
+from hardwario.common import image
+
+
+class ProbeResult:
+
+    def __init__(self, jlink_sn, result=None, error=None, elapsed=0.0, events=None):
+        self.jlink_sn = jlink_sn
+        self.result = result
+        self.error = error
+        self.elapsed = elapsed
+        self.events = events or []
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+        status = 'OK' if self.ok else 'FAILED'
+        text = self.error if not self.ok else (self.result if isinstance(self.result, str) else '')
+        return f'{self.jlink_sn or "-":>12}  {status:6}  {self.elapsed:6.1f}s  {text}'.rstrip()
+
+
+def enumerate_probes():
+    '''Return sorted serial numbers of all connected J-Links.'''
+    with LowLevel.API(LowLevel.DeviceFamily.UNKNOWN) as api:
+        return sorted(api.enum_emu_snr() or [])
+
+
+def _run_probe(factory, jlink_sn, operation, args, timings=False):
+    # Every probe in its own process with its own DLL, sessions of the daemon would run them in one
+    os.environ['HARDWARIO_NO_DAEMON'] = '1'
+    start = time.monotonic()
+    events = []
+    prog = factory(jlink_sn=jlink_sn)
+    if timings:
+        prog.on_event = events.append
+    try:
+        with prog as prog:
+            result = operation(prog, *args)
+    except Exception as e:
+        logger.debug('J-Link {} failed: {}', jlink_sn, e)
+        return ProbeResult(jlink_sn, error=str(e) or e.__class__.__name__, elapsed=time.monotonic() - start, events=events)
+    return ProbeResult(jlink_sn, result=result, elapsed=time.monotonic() - start, events=events)
+
+
+def run(prog, probes, operation, args=(), probe_args=None):
+    '''Run operation(prog, *args, *probe_args[i]) against every probe concurrently.
+
+    Each probe gets its own process and its own copy of prog (the nrfjprog DLL cannot be shared),
+    the probe daemon is not used by the workers. A failing probe does not stop the others. Returns list of ProbeResult in probes order.
+    '''
+    factory = partial(type(prog), prog.device_family, jlink_speed=prog._jlink_speed, log=prog._log)
+    if probe_args is None:
+        probe_args = [()] * len(probes)
+
+    # spawn, the parent may have the nrfjprog DLL loaded already (probe enumeration)
+    mp_context = multiprocessing.get_context('spawn')
+    start = time.monotonic()
+    results = []
+    with ProcessPoolExecutor(max_workers=len(probes), mp_context=mp_context) as executor:
+        futures = [executor.submit(_run_probe, factory, sn, operation, tuple(args) + tuple(extra), prog.on_event is not None)
+                   for sn, extra in zip(probes, probe_args)]
+        for sn, future in zip(probes, futures):
+            # A crashed worker (BrokenProcessPool) or unpicklable result fails only its probe
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.debug('J-Link {} worker failed: {!r}', sn, e)
+                results.append(ProbeResult(sn, error=f'{e.__class__.__name__}: {e}', elapsed=time.monotonic() - start))
+
+    # Phase events of the workers go to the timing recorder of prog
+    if prog.on_event is not None:
+        for result in results:
+            for event in result.events:
+                prog.on_event(event)
+    return results
+
+
+def flash(prog, hex_file, halt=False, delta=False, verify=None):
+    if delta:
+        result = prog.program_delta(hex_file, halt, verify=verify or 'fast')
+        return f'pages written: {result["written"]}, skipped: {result["skipped"]}, verify: {result["verify"]}'
+    return f'verify: {prog.program(hex_file, halt, verify=verify or "full")}'
+
+
+def erase(prog, all=False, hex_file=None, allow_erase_all=False):
+    if all:
+        prog.erase_all()
+        return 'erase all'
+    return f'erase {prog.erase_flash(image.load(hex_file) if hex_file else None, allow_erase_all)}'
+
+
+def reset(prog, halt=False):
+    prog.reset()
+    if halt:
+        prog.halt()
+
+
+def read_uicr_pib(prog):
+    return prog.read_uicr_pib()
+
+
+def write_uicr_pib(prog, buffer, halt=False, incremental=False, disable_ap_protect_file=None, force_recover=False):
+    if disable_ap_protect_file:
+        prog.disable_ap_protect(disable_ap_protect_file, buffer, force=force_recover)
+    result = prog.write_uicr_pib(buffer, halt=halt, incremental=incremental)
+    prog.verify_uicr_pib(buffer)
+    return result
+
+
+def select_probes(jlink_sn, all_probes=False):
+    '''Return list of probes from repeated --jlink-sn or all connected J-Links for --all-probes.'''
+    if all_probes:
+        if jlink_sn:
+            raise click.UsageError('Option --all-probes cannot be used with --jlink-sn.')
+        probes = enumerate_probes()
+        if not probes:
+            raise click.ClickException('No J-Link found (check USB cable)')
+        return probes
+    return list(dict.fromkeys(jlink_sn))
+
+
+def require_single_probe(ctx):
+    if ctx.obj.get('probes'):
+        raise click.UsageError('Command supports only a single J-Link.')
+
+
+def echo_results(results):
+    '''Print per-probe status and timing, fail when any probe failed.'''
+    for result in results:
+        click.echo(str(result))
+    failed = sum(1 for result in results if not result.ok)
+    if failed:
+        raise click.ClickException(f'{failed} of {len(results)} probes failed')
+    click.echo('Successfully completed')
@@ -1,11 +1,44 @@
+import os
 import time
+import tempfile
+from bisect import bisect_right
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 import logging
 from pynrfjprog import APIError, LowLevel
-from pynrfjprog.Parameters import EraseAction, MemoryType, ReadbackProtection
+from pynrfjprog.Parameters import CoProcessor, EraseAction, MemoryType, ReadbackProtection, VerifyAction
+from hardwario.common import image
+from hardwario.common.pib import PIB
+from hardwario.device import daemon, devicecache, speedtune
 
 DEFAULT_JLINK_SPEED_KHZ = LowLevel.API._DEFAULT_JLINK_SPEED_KHZ
 
+READ_BLOCK_SIZE = 0x10000
+
+VERIFY_STRATEGIES = ('full', 'fast', 'crc', 'none')
+
+# Initial erase planning estimates: NVMC page erase (~85 ms) and erase all (~170 ms) of the nRF52
+# datasheets plus SWD overhead, replaced per session by the times measured in execute_erase.
+# Sector erase runs the page erases inside nrfjprog, w/o a round trip per page.
+ERASE_PAGE_TIME_S = 0.09
+ERASE_SECTOR_TIME_S = 0.086
+ERASE_ALL_TIME_S = 0.3
+
+# Cores programmable in one session of multi-core devices
+CORES = {
+    'app': CoProcessor.CP_APPLICATION,
+    'net': CoProcessor.CP_NETWORK,
+}
+
+MULTI_CORE_FAMILIES = ('nRF53', 'nRF54H')
+
+UICR_WRITE_RESULT_TEXT = {
+    'skip': 'UICR content unchanged, write skipped',
+    'write': 'UICR written without erase',
+    'erase': 'UICR erased and written',
+}
+
 
 class NRFJProgException(Exception):
     pass
@@ -23,6 +56,44 @@ class NRFJProgRTTNoChannels(NRFJProgException):
     pass
 
 
+def diff_words(old, new):
+    '''Return list of (offset, bytes) runs of 32-bit words that differ between the buffers.'''
+    runs = []
+    start = None
+    for offset in range(0, len(new), 4):
+        if old[offset:offset + 4] != new[offset:offset + 4]:
+            if start is None:
+                start = offset
+        elif start is not None:
+            runs.append((start, bytes(new[start:offset])))
+            start = None
+    if start is not None:
+        runs.append((start, bytes(new[start:])))
+    return runs
+
+
+def can_write_without_erase(old, new):
+    '''Flash bits can only be cleared (1 -> 0) without an erase.'''
+    return all((o & n) == n for o, n in zip(old, new))
+
+
+class ErasePlan:
+    '''Erase strategy 'pages' (erase_page for each page), 'sector' (nrfjprog sector erase of the pages)
+    or 'all' (erase_all and restore UICR).'''
+
+    def __init__(self, strategy, pages, estimated_time):
+        self.strategy = strategy
+        self.pages = pages
+        self.estimated_time = estimated_time
+        self.actual_time = None
+
+    def __str__(self):
+        text = f'strategy: {self.strategy}, pages: {len(self.pages)}, estimated: {self.estimated_time:.1f}s'
+        if self.actual_time is not None:
+            text += f', actual: {self.actual_time:.1f}s'
+        return text
+
+
 class NRFJProg(LowLevel.API):
 
     def __init__(self, device_family=None, jlink_sn=None, jlink_speed=DEFAULT_JLINK_SPEED_KHZ, log=False):
@@ -30,6 +101,14 @@ class NRFJProg(LowLevel.API):
         self._log = log
         self._rtt_channels = None
         self._jlink_ip = None
+        self._session = None
+        self._metadata = {}
+        self._metadata_dirty = False
+        self._coprocessor = None
+        self._erase_page_time = ERASE_PAGE_TIME_S
+        self._erase_sector_time = ERASE_SECTOR_TIME_S
+        self._erase_all_time = ERASE_ALL_TIME_S
+        self.on_event = None
         self.set_serial_number(jlink_sn)
         self.set_speed(jlink_speed)
         self.is_opened = False
@@ -38,7 +117,11 @@ class NRFJProg(LowLevel.API):
         self._jlink_sn = int(serial_number) if serial_number is not None else None
 
     def set_speed(self, speed):
-        self._jlink_speed = int(speed) if speed is not None else DEFAULT_JLINK_SPEED_KHZ
+        '''Set J-Link clock speed in kHz, 'auto' uses the tuned speed cached for the probe.'''
+        if speed == 'auto':
+            self._jlink_speed = speed
+        else:
+            self._jlink_speed = int(speed) if speed is not None else DEFAULT_JLINK_SPEED_KHZ
 
     def set_remote(self, host):
         if host is None:
@@ -63,28 +146,79 @@ class NRFJProg(LowLevel.API):
         return self._jlink_sn
 
     def get_speed(self):
+        if self._jlink_speed == 'auto':
+            return speedtune.lookup(self._jlink_sn, self.device_family) or 'auto'
         return self._jlink_speed
 
+    @contextmanager
+    def phase(self, name, bytes=None):
+        '''Emit start/end timing events of a phase to on_event, the yielded dict can update 'bytes'.'''
+        if self.on_event is None:
+            yield {}
+            return
+        info = {'bytes': bytes}
+        start = time.monotonic()
+        self._emit(name, 'start', start, bytes=bytes)
+        try:
+            yield info
+        except BaseException as e:
+            end = time.monotonic()
+            self._emit(name, 'end', end, bytes=info['bytes'], duration=end - start, error=str(e) or e.__class__.__name__)
+            raise
+        end = time.monotonic()
+        self._emit(name, 'end', end, bytes=info['bytes'], duration=end - start)
+
+    def _emit(self, phase, event, monotonic, **fields):
+        record = {'phase': phase, 'event': event, 'monotonic': monotonic, 'timestamp': time.time(), 'jlink_sn': self._jlink_sn}
+        record.update((k, v) for k, v in fields.items() if v is not None)
+        self.on_event(record)
+
     def dbg(self, record):
         logger.debug(record.getMessage())
 
     def open(self):
+        if self._jlink_speed == 'auto':
+            if self._jlink_ip:
+                self._jlink_speed = DEFAULT_JLINK_SPEED_KHZ
+            else:
+                jlink_sn, chip, self._jlink_speed = speedtune.resolve(self)
+                try:
+                    self._open()
+                    if chip is None or self.get_chip_name() == chip:
+                        return
+                    # Speed was tuned for another chip on this probe
+                    logger.warning('Cached speed {} kHz was tuned for {}, tuning again', self._jlink_speed, chip)
+                except (APIError.APIError, NRFJProgOpenException) as e:
+                    if chip is None:
+                        raise
+                    # Cached speed no longer works with this probe and fixture, tune again
+                    logger.warning('Connection at cached speed {} kHz failed: {}', self._jlink_speed, e)
+                try:
+                    self.close()
+                except Exception:
+                    pass
+                speedtune.forget(jlink_sn, chip)
+                self._jlink_speed = speedtune.tune(self, jlink_sn)
+        self._open()
+
+    def _open(self):
         logger.debug('Opening')
         try:
-            if self._log:
-                logging.getLogger('pynrfjprog.LowLevel').setLevel(logging.DEBUG)
-            super().__init__(LowLevel.DeviceFamily.UNKNOWN, log=self._log, log_str_cb=self.dbg)
-            super().open()
+            with self.phase('connect'):
+                if self._log:
+                    logging.getLogger('pynrfjprog.LowLevel').setLevel(logging.DEBUG)
+                super().__init__(LowLevel.DeviceFamily.UNKNOWN, log=self._log, log_str_cb=self.dbg)
+                super().open()
 
-            if self._jlink_ip:
-                logger.debug('Connecting to J-Link at {}:{}', *self._jlink_ip)
-                self.connect_to_emu_with_ip(self._jlink_ip[0], self._jlink_ip[1], jlink_speed_khz=self._jlink_speed)
+                if self._jlink_ip:
+                    logger.debug('Connecting to J-Link at {}:{}', *self._jlink_ip)
+                    self.connect_to_emu_with_ip(self._jlink_ip[0], self._jlink_ip[1], jlink_speed_khz=self._jlink_speed)
 
-            elif self._jlink_sn:
-                self.connect_to_emu_with_snr(self._jlink_sn, jlink_speed_khz=self._jlink_speed)
+                elif self._jlink_sn:
+                    self.connect_to_emu_with_snr(self._jlink_sn, jlink_speed_khz=self._jlink_speed)
 
-            else:
-                self.connect_to_emu_without_snr(jlink_speed_khz=self._jlink_speed)
+                else:
+                    self.connect_to_emu_without_snr(jlink_speed_khz=self._jlink_speed)
 
         except APIError.APIError as e:
             if e.err_code == APIError.NrfjprogdllErr.NO_EMULATOR_CONNECTED:
@@ -95,6 +229,15 @@ class NRFJProg(LowLevel.API):
                     'Detected low voltage on J-Link (check power supply and cable)')
             raise NRFJProgOpenException(str(e))
 
+        with self.phase('family'):
+            self._load_metadata()
+            self._check_family()
+        self.is_opened = True
+
+        # print(self.read_device_info())
+        logger.debug('Opened')
+
+    def _check_family(self):
         device_family = self.read_device_family()
 
         if self.device_family:
@@ -111,13 +254,94 @@ class NRFJProg(LowLevel.API):
                     f'An incorrect MCU was detected. The expected device family is {self.device_family.upper()} but {device_family} was detected')
 
         self.select_family(device_family)
-        self.is_opened = True
 
-        # print(self.read_device_info())
-        logger.debug('Opened')
+    def _cached(self, key, read):
+        # Facts that cannot change while the session is open, read once per session
+        if key not in self._metadata:
+            self._metadata[key] = read()
+            self._metadata_dirty = True
+        return self._metadata[key]
+
+    def read_device_family(self):
+        return self._cached('device_family', super().read_device_family)
+
+    def is_same_device(self):
+        '''Re-read the hardware ID, False when the device differs from the one the session metadata belongs to.
+
+        The first call records the ID when it is not known yet (metadata not from the device cache).
+        '''
+        device_id = devicecache.read_device_id(self, self.read_device_family())
+        if device_id is None:
+            return True
+        return self._metadata.setdefault('device_id', device_id) == device_id
+
+    def read_device_info(self):
+        return self._cached('device_info', super().read_device_info)
+
+    def read_memory_descriptors(self, read_page_sizes=True):
+        key = 'memory_descriptors_pages' if read_page_sizes else 'memory_descriptors'
+        if self._coprocessor not in (None, CoProcessor.CP_APPLICATION):
+            # Descriptors of other cores are cached for the session only
+            key = f'{key}_{self._coprocessor.name}'
+        return self._cached(key, lambda: super(NRFJProg, self).read_memory_descriptors(read_page_sizes))
+
+    def select_coprocessor(self, coprocessor):
+        coprocessor = CoProcessor(coprocessor) if isinstance(coprocessor, int) else CoProcessor[coprocessor]
+        if coprocessor != self._coprocessor:
+            super().select_coprocessor(coprocessor)
+            self._coprocessor = coprocessor
+
+    def _metadata_serial_number(self):
+        if self._jlink_ip or not devicecache.is_enabled():
+            return None
+        return self._jlink_sn or self.read_connected_emu_snr()
+
+    def _load_metadata(self):
+        '''Restore metadata cached on disk when the hardware ID of the connected device matches.'''
+        self._metadata = {}
+        self._metadata_dirty = False
+
+        jlink_sn = self._metadata_serial_number()
+        entry = devicecache.lookup(jlink_sn) if jlink_sn else None
+        if entry is None:
+            return
+
+        try:
+            self.select_family(entry['device_family'])
+            device_id = devicecache.read_device_id(self, entry['device_family'])
+        except APIError.APIError as e:
+            logger.debug('Reading device ID failed: {}', e)
+            device_id = None
+
+        if device_id is not None and device_id == entry['device_id']:
+            logger.debug('Using cached metadata of device {} on J-Link {}', device_id, jlink_sn)
+            self._metadata = devicecache.decode(entry)
+            return
+
+        logger.debug('Device on J-Link {} changed, dropping cached metadata', jlink_sn)
+        devicecache.forget(jlink_sn)
+        self.select_family(LowLevel.DeviceFamily.UNKNOWN)
+
+    def _save_metadata(self):
+        if not self._metadata_dirty or 'device_family' not in self._metadata:
+            return
+        self._metadata_dirty = False
+        try:
+            jlink_sn = self._metadata_serial_number()
+            if not jlink_sn:
+                return
+            device_id = self._metadata.get('device_id') or devicecache.read_device_id(self, self._metadata['device_family'])
+            if device_id is not None:
+                devicecache.store(jlink_sn, device_id, self._metadata)
+        except Exception as e:
+            logger.debug('Storing device metadata failed: {}', e)
 
     def close(self):
         logger.debug('Closing')
+        if self.is_opened:
+            self._save_metadata()
+        self._metadata = {}
+        self._coprocessor = None
         super().close()
         self.is_opened = False
         logger.debug('Closed')
@@ -125,44 +349,410 @@ class NRFJProg(LowLevel.API):
     def reset(self):
         self.sys_reset()
 
-    def erase_flash(self):
-        self.disable_bprot()
-        for des in self.read_memory_descriptors(False):
+    def plan_erase(self, img=None, allow_erase_all=False):
+        '''Plan erase of application flash (w/o UICR), whole CODE or only the pages covered by image.
+
+        Pages of an image are erased one by one, the whole CODE with a single sector erase of all
+        pages. With allow_erase_all the whole CODE may be erased with erase all when estimated faster,
+        UICR is erased too and written back (lost when interrupted).
+        '''
+        descriptors = self.read_memory_descriptors(False)
+
+        if img is not None:
+            pages = [(addr, size) for addr, size, type in self.get_image_pages(img, descriptors) if type == MemoryType.CODE]
+            return ErasePlan('pages', pages, len(pages) * self._erase_page_time)
+
+        pages = []
+        for des in descriptors:
             if des.type == MemoryType.CODE:
                 page_size = des.size // des.num_pages
-                for addr in range(0, des.size, page_size):
+                pages.extend((des.start + addr, page_size) for addr in range(0, des.size, page_size))
+
+        sector_time = len(pages) * self._erase_sector_time
+        if allow_erase_all and sector_time > self._erase_all_time:
+            return ErasePlan('all', pages, self._erase_all_time)
+        return ErasePlan('sector', pages, sector_time)
+
+    def execute_erase(self, plan):
+        start = time.monotonic()
+        with self.phase('erase', bytes=sum(size for _, size in plan.pages)):
+            self.disable_bprot()
+
+            if plan.strategy == 'all':
+                des = self.get_uicr_descriptor()
+                uicr = bytes(self.read(des.start, des.size))
+                super().erase_all()
+                self._restore_uicr(des, uicr)
+            elif plan.strategy == 'sector':
+                self._erase_sectors(plan.pages)
+            else:
+                for addr, _ in plan.pages:
                     self.erase_page(addr)
 
-    def program(self, file_path, halt=False, progress=lambda x: None):
-        self.reset()
-        self.halt()
+        plan.actual_time = time.monotonic() - start
+        if plan.strategy == 'all':
+            self._erase_all_time = plan.actual_time
+        elif plan.strategy == 'sector' and plan.pages:
+            self._erase_sector_time = plan.actual_time / len(plan.pages)
+        elif plan.pages:
+            self._erase_page_time = plan.actual_time / len(plan.pages)
+        logger.debug('Erase {}', plan)
+        return plan
+
+    def _erase_sectors(self, pages):
+        # nrfjprog sector erase covers the pages with data in the file, one byte per page is enough
+        img = image.Image()
+        for addr, _ in pages:
+            img.add(addr, b'\xff')
+        fd, path = tempfile.mkstemp(prefix='hardwario-erase-', suffix='.hex')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(img.to_ihex())
+            self.erase_file(path, chip_erase_mode=EraseAction.ERASE_SECTOR)
+        finally:
+            os.remove(path)
+
+    def _restore_uicr(self, des, uicr):
+        # Written words are read back, a failed restore is retried once before giving up
+        for attempt in range(2):
+            for offset, data in diff_words(bytes(self.read(des.start, des.size)), uicr):
+                self.write(des.start + offset, data, True)
+            current = bytes(self.read(des.start, des.size))
+            if current == uicr:
+                return
+            logger.warning('UICR restore mismatch (attempt {})', attempt + 1)
+        raise NRFJProgException(f'UICR restore failed, original content: {uicr.hex()}')
+
+    def erase_all(self):
+        with self.phase('erase'):
+            super().erase_all()
+
+    def recover(self):
+        with self.phase('recover'):
+            super().recover()
+
+    def is_ap_protected(self):
+        return self.readback_status() != 'NONE'
+
+    def disable_ap_protect(self, file_path, buffer=None, force=False, progress=lambda x: None):
+        '''Recover and program the image keeping the debug access port open (nRF91).
+
+        Recover is the only UICR erase on nRF91, so it is skipped only when the access port is
+        already open and the PIB buffer about to be written (if any) fits over the current PIB
+        without erase (erased, equal or only 1 -> 0 bits). Returns True when recovered.
+        '''
+        if not force and not self.is_ap_protected():
+            if buffer is None:
+                logger.debug('AP-protect already disabled, recover skipped')
+                return False
+            current = self.read_uicr_pib()
+            if can_write_without_erase(current, buffer):
+                logger.debug('AP-protect already disabled and PIB writable without erase, recover skipped')
+                return False
+            logger.debug('PIB differs from UICR content, recover needed to erase UICR')
+        progress('Recovering device (This operation might take 30s.)')
+        self.recover()
+        progress('Writing image to disable ap protect.')
+        self.program_file(file_path)
+        return True
+
+    def erase_flash(self, img=None, allow_erase_all=False):
+        '''Erase application flash w/o UICR area, or only the pages needed by image (see plan_erase).'''
+        return self.execute_erase(self.plan_erase(img, allow_erase_all))
+
+    def get_erase_action(self, file_path):
+        '''Sector erase, on NRF52 incl. UICR when the HEX file has data in the UICR area.'''
+        if not file_path.lower().endswith('.hex') or self.read_device_family() != 'NRF52':
+            return EraseAction.ERASE_SECTOR
+        des = self.get_uicr_descriptor()
+        if image.load(file_path).overlaps(des.start, des.size):
+            logger.debug('Image contains UICR data')
+            return EraseAction.ERASE_SECTOR_AND_UICR
+        return EraseAction.ERASE_SECTOR
+
+    def verify_image(self, img):
+        '''Read back image segments in large blocks, raise on the first mismatch.'''
+        for start, data in img.segments():
+            for offset in range(0, len(data), READ_BLOCK_SIZE):
+                expected = data[offset:offset + READ_BLOCK_SIZE]
+                actual = bytes(self.read(start + offset, len(expected)))
+                if actual != expected:
+                    i = next(i for i in range(len(expected)) if actual[i] != expected[i])
+                    raise NRFJProgException(
+                        f'Verify failed at 0x{start + offset + i:08X}: expected 0x{expected[i]:02X}, read 0x{actual[i]:02X}')
+
+    def verify(self, file_path, strategy='full'):
+        '''Verify file with strategy full (nrfjprog readback), fast (image readback), crc (hash) or none.
+
+        Returns the strategy that ran, fast falls back to full for non HEX files.
+        '''
+        if strategy not in VERIFY_STRATEGIES:
+            raise NRFJProgException(f'Unknown verify strategy: {strategy}')
+        if strategy == 'fast' and not file_path.lower().endswith('.hex'):
+            strategy = 'full'
+
+        if strategy == 'full':
+            self.verify_file(file_path)
+        elif strategy == 'crc':
+            self.verify_file(file_path, VerifyAction.VERIFY_HASH)
+        elif strategy == 'fast':
+            self.verify_image(image.load(file_path))
+
+        logger.debug('Verify {}: {}', file_path, strategy)
+        return strategy
+
+    def get_file_size(self, file_path):
+        '''Return number of programmed bytes of HEX file, or the file size.'''
+        if file_path.lower().endswith('.hex'):
+            return len(image.load(file_path))
+        return os.path.getsize(file_path)
+
+    def _reset_after(self, halt, progress):
+        with self.phase('reset'):
+            if halt:
+                progress('Resetting (HALT)...')
+                self.reset()
+                self.halt()
+            else:
+                progress('Resetting (GO)...')
+                self.reset()
+                self.go()
+
+    def program(self, file_path, halt=False, progress=lambda x: None, verify='full', reset=True):
+        '''Erase, program and verify file, returns the verify strategy that ran.
+
+        With reset=False the target must already be halted and is left halted (batching several steps).
+        '''
+        size = self.get_file_size(file_path) if self.on_event else None
+
+        if reset:
+            self.reset()
+            self.halt()
 
         progress('Erasing...')
-        self.erase_file(file_path, chip_erase_mode=EraseAction.ERASE_SECTOR)
+        with self.phase('erase'):
+            self.erase_file(file_path, chip_erase_mode=self.get_erase_action(file_path))
 
         progress('Flashing...')
-        self.program_file(file_path)
+        with self.phase('program', bytes=size):
+            self.program_file(file_path)
+
+        if verify != 'none':
+            progress(f'Verifying ({verify})...')
+        with self.phase('verify', bytes=size if verify != 'none' else 0):
+            verify = self.verify(file_path, verify)
 
-        progress('Verifying...')
-        self.verify_file(file_path)
+        if reset:
+            self._reset_after(halt, progress)
+
+        progress('Successfully completed')
+
+        return verify
+
+    def get_image_core(self, img, cores=CORES):
+        '''Return name of the core whose CODE memory contains the start of image.'''
+        for name, coprocessor in cores.items():
+            self.select_coprocessor(coprocessor)
+            for des in self.read_memory_descriptors(False):
+                if des.type == MemoryType.CODE and des.start <= img.start < des.start + des.size:
+                    return name
+        raise NRFJProgException(f'No core has flash at 0x{img.start:08X}')
+
+    def program_cores(self, images, halt=False, progress=lambda x: None, verify='full'):
+        '''Erase, program and verify images of several cores in one session.
+
+        images is a list of (core name or None to detect it from the image address, HEX file path).
+        HEX files are parsed in the background while the previous images are programmed.
+        Returns list of dicts (core, file, bytes, verify, duration) in images order.
+        '''
+        report = []
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            loading = [executor.submit(image.load, file_path) for _, file_path in images]
 
-        if halt:
-            progress('Resetting (HALT)...')
             self.reset()
-            self.halt()
-        else:
-            progress('Resetting (GO)...')
+            for (core, file_path), future in zip(images, loading):
+                img = future.result()
+                if core is None:
+                    core = self.get_image_core(img)
+                if core not in CORES:
+                    raise NRFJProgException(f'Unknown core: {core}')
+                self.select_coprocessor(CORES[core])
+                self.halt()
+
+                def core_progress(text):
+                    if text != 'Successfully completed':
+                        progress(f'{core}: {text}')
+
+                start = time.monotonic()
+                strategy = self.program(file_path, verify=verify, progress=core_progress, reset=False)
+                report.append({'core': core, 'file': file_path, 'bytes': len(img), 'verify': strategy, 'duration': time.monotonic() - start})
+
+        self.select_coprocessor(CoProcessor.CP_APPLICATION)
+        self._reset_after(halt, progress)
+        progress('Successfully completed')
+        return report
+
+    def get_image_pages(self, img, descriptors=None):
+        '''Return sorted list of (address, size, memory type) of CODE and UICR pages covered by image.'''
+        if descriptors is None:
+            descriptors = self.read_memory_descriptors(False)
+        pages = set()
+        covered = 0
+        for des in descriptors:
+            if des.type not in (MemoryType.CODE, MemoryType.UICR):
+                continue
+            page_size = des.size // des.num_pages
+            for start, data in img.segments():
+                lo = max(start, des.start)
+                hi = min(start + len(data), des.start + des.size)
+                if lo >= hi:
+                    continue
+                covered += hi - lo
+                addr = des.start + (lo - des.start) // page_size * page_size
+                while addr < hi:
+                    pages.add((addr, page_size, des.type))
+                    addr += page_size
+        if covered != len(img):
+            raise NRFJProgException('Image contains data outside of CODE and UICR memory')
+        return sorted(pages)
+
+    def read_ranges(self, ranges):
+        '''Read list of (address, size) ranges, contiguous ranges are joined into large reads.'''
+        result = []
+        span_start = span_end = None
+        spans = []
+        for address, size in sorted(ranges):
+            if span_end == address:
+                span_end += size
+            else:
+                if span_start is not None:
+                    spans.append((span_start, span_end))
+                span_start, span_end = address, address + size
+        if span_start is not None:
+            spans.append((span_start, span_end))
+
+        memory = {}
+        for start, end in spans:
+            buf = bytearray()
+            for addr in range(start, end, READ_BLOCK_SIZE):
+                buf += bytes(self.read(addr, min(READ_BLOCK_SIZE, end - addr)))
+            memory[start] = buf
+
+        starts = sorted(memory)
+        for address, size in ranges:
+            start = starts[bisect_right(starts, address) - 1]
+            offset = address - start
+            result.append(bytes(memory[start][offset:offset + size]))
+        return result
+
+    def program_delta(self, file_path, halt=False, progress=lambda x: None, verify='fast', reset=True):
+        '''Erase and program only the flash pages whose content differs from the HEX file.
+
+        Fast verify reads back only the written pages.
+        Returns dict with number of 'written' and 'skipped' pages and the 'verify' strategy.
+        '''
+        if verify not in VERIFY_STRATEGIES:
+            raise NRFJProgException(f'Unknown verify strategy: {verify}')
+        img = image.load(file_path)
+
+        if reset:
             self.reset()
-            self.go()
+            self.halt()
+
+        progress('Comparing...')
+        with self.phase('compare') as info:
+            pages = self.get_image_pages(img)
+            current = self.read_ranges([(addr, size) for addr, size, _ in pages])
+            info['bytes'] = sum(size for _, size, _ in pages)
+            changed = []
+            expected = {}
+            for (addr, size, type), data in zip(pages, current):
+                # UICR words the image does not contain (e.g. PIB) are kept
+                expected[addr] = self._overlay_image(img, addr, data) if type == MemoryType.UICR else img.read(addr, size)
+                if data != expected[addr]:
+                    changed.append((addr, size, type))
+
+        logger.debug('Delta pages: {} changed of {}', len(changed), len(pages))
+
+        if changed:
+            changed_size = sum(size for _, size, _ in changed)
+            uicr = None
+
+            progress('Erasing...')
+            with self.phase('erase', bytes=changed_size):
+                self.disable_bprot()
+                for addr, size, type in changed:
+                    if type == MemoryType.CODE:
+                        self.erase_page(addr)
+                if any(type == MemoryType.UICR for _, _, type in changed):
+                    # UICR can only be erased as a whole, read all of it and write it back merged with the image
+                    des = self.get_uicr_descriptor()
+                    uicr = self._overlay_image(img, des.start, bytes(self.read(des.start, des.size)))
+                    self.erase_uicr()
+
+            progress('Flashing...')
+            with self.phase('program') as info:
+                info['bytes'] = 0
+                if uicr is not None:
+                    for offset, data in diff_words(b'\xff' * len(uicr), uicr):
+                        self.write(des.start + offset, data, True)
+                        info['bytes'] += len(data)
+                for addr, size, type in changed:
+                    if type != MemoryType.CODE:
+                        continue
+                    data = expected[addr].rstrip(b'\xff')
+                    skip = (len(data) - len(data.lstrip(b'\xff'))) & ~3
+                    data = data[skip:]
+                    if data:
+                        data += b'\xff' * (-len(data) % 4)
+                        self.write(addr + skip, data, True)
+                        info['bytes'] += len(data)
+
+            if verify == 'fast':
+                progress('Verifying (fast)...')
+                with self.phase('verify', bytes=changed_size):
+                    readback = self.read_ranges([(addr, size) for addr, size, _ in changed])
+                    for (addr, size, _), data in zip(changed, readback):
+                        if data != expected[addr]:
+                            i = next(i for i in range(0, size, 4) if data[i:i + 4] != expected[addr][i:i + 4])
+                            raise NRFJProgException(
+                                f'Verify failed at 0x{addr + i:08X}: expected 0x{int.from_bytes(expected[addr][i:i + 4], "little"):08X}, '
+                                f'read 0x{int.from_bytes(data[i:i + 4], "little"):08X}')
+            elif verify != 'none':
+                progress(f'Verifying ({verify})...')
+                with self.phase('verify', bytes=len(img)):
+                    self.verify(file_path, verify)
+
+        if reset:
+            self._reset_after(halt, progress)
 
         progress('Successfully completed')
 
-    def get_uicr_address(self):
+        if not changed:
+            verify = 'none'
+
+        return {'written': len(changed), 'skipped': len(pages) - len(changed), 'verify': verify}
+
+    @staticmethod
+    def _overlay_image(img, address, data):
+        '''Return data (memory content at address) with the bytes contained in image replaced.'''
+        data = bytearray(data)
+        for start, segment in img.segments():
+            lo = max(start, address)
+            hi = min(start + len(segment), address + len(data))
+            if lo < hi:
+                data[lo - address:hi - address] = segment[lo - start:hi - start]
+        return bytes(data)
+
+    def get_uicr_descriptor(self):
         for des in self.read_memory_descriptors(False):
             if des.type == MemoryType.UICR:
-                return des.start
+                return des
         raise NRFJProgException('UICR descriptor not found.')
 
+    def get_uicr_address(self):
+        return self.get_uicr_descriptor().start
+
     def get_chip_name(self):
         device_info = self.read_device_info()
         logger.debug(f'device info: {device_info}')
@@ -190,27 +780,98 @@ class NRFJProg(LowLevel.API):
         addr = self.get_uicr_pib_address()
         return bytes(self.read(addr, 128))
 
-    def write_uicr_pib(self, buffer: bytes, halt=False):
+    def verify_uicr_pib(self, buffer: bytes):
+        '''Read back PIB from UICR, raise when it differs from buffer or fails the integrity check.'''
+        current = self.read_uicr_pib()
+        if current[:len(buffer)] != bytes(buffer):
+            i = next(i for i in range(len(buffer)) if current[i] != buffer[i])
+            raise NRFJProgException(
+                f'PIB verify failed at 0x{self.get_uicr_pib_address() + i:08X}: expected 0x{buffer[i]:02X}, read 0x{current[i]:02X}')
+        try:
+            PIB(2, current, nrf=True)
+        except Exception as e:
+            raise NRFJProgException(f'PIB verify failed: {e}')
+        return current
+
+    def write_uicr_pib(self, buffer: bytes, halt=False, incremental=False, reset=True):
+        '''Write PIB to UICR, returns the path taken: 'skip', 'write' (no erase) or 'erase'.
+
+        In incremental mode the current content is read first, the write is skipped when equal,
+        only changed words are written when no bit goes 0 -> 1, and otherwise the rest
+        of UICR is preserved across the erase (NRF52 only, other families raise as UICR
+        is erased only by recover). With reset=False the target must already be halted.
+        '''
+        with self.phase('uicr_write', bytes=len(buffer)):
+            return self._write_uicr_pib(buffer, halt, incremental, reset)
+
+    def _write_uicr_pib(self, buffer, halt, incremental, reset):
         addr = self.get_uicr_pib_address()
 
-        self.reset()
-        self.halt()
+        if incremental:
+            size = (len(buffer) + 3) & ~3
+            current = bytes(self.read(addr, size))
+            buffer = bytes(buffer) + current[len(buffer):]
+            if current == buffer:
+                logger.debug('UICR PIB unchanged')
+                if halt and reset:
+                    self.reset()
+                    self.halt()
+                return 'skip'
+
+        if reset:
+            self.reset()
+            self.halt()
 
         family = self.read_device_family()
-        if family == 'NRF52':
-            self.erase_uicr()
 
-        self.write(addr, buffer, True)
+        if not incremental:
+            result = 'write'
+            if family == 'NRF52':
+                self.erase_uicr()
+                result = 'erase'
+            self.write(addr, buffer, True)
+
+        elif can_write_without_erase(current, buffer):
+            for offset, data in diff_words(current, buffer):
+                logger.debug('UICR write 0x{:08X} {}', addr + offset, data.hex())
+                self.write(addr + offset, data, True)
+            result = 'write'
+
+        elif family != 'NRF52':
+            # UICR of nRF91/nRF53 is erased only by recover, which also erases the application
+            raise NRFJProgException('UICR PIB cannot be written without erase (bits 0 -> 1), recover the device first.')
 
-        self.reset()
-        if halt:
-            self.halt()
         else:
-            self.go()
+            des = self.get_uicr_descriptor()
+            uicr = bytearray(self.read(des.start, des.size))
+            uicr[addr - des.start:addr - des.start + len(buffer)] = buffer
+            self.erase_uicr()
+            for offset, data in diff_words(b'\xff' * len(uicr), uicr):
+                self.write(des.start + offset, data, True)
+            result = 'erase'
+
+        logger.debug('UICR PIB write: {}', result)
+
+        if reset:
+            self.reset()
+            if halt:
+                self.halt()
+            else:
+                self.go()
+
+        return result
 
     def __enter__(self):
+        # Reuse an opened session of the probe daemon when it is running
+        self._session = daemon.connect(self)
+        if self._session is not None:
+            return self._session
         self.open()
         return self
 
     def __exit__(self, type, value, traceback):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+            return
         self.close()
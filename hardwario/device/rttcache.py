@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import struct
+import hashlib
+from loguru import logger
+from hardwario.common.utils import get_file_hash
+
+DEFAULT_CACHE_PATH = os.path.expanduser("~/.hardwario/rtt_cache.json")
+
+# Entries kept in the cache, the least recently updated are dropped
+MAX_ENTRIES = 64
+
+SYMBOL = '_SEGGER_RTT'
+
+CONTROL_BLOCK_ID = b'SEGGER RTT\0'
+
+# acID[16], MaxNumUpBuffers, MaxNumDownBuffers, followed by the buffer descriptors
+# (sName, pBuffer, SizeOfBuffer, WrOff, RdOff, Flags) of the up and down buffers
+CONTROL_BLOCK_HEADER_SIZE = 24
+BUFFER_DESCRIPTOR_SIZE = 24
+MAX_BUFFERS = 32
+
+# Start of flash hashed as firmware key when no ELF is known
+FINGERPRINT_ADDRESS = 0x0
+FINGERPRINT_SIZE = 0x1000
+
+# RAM searched for the control block, same for nRF52840 and nRF9160
+RAM_START = 0x20000000
+RAM_SIZE = 0x40000
+
+
+class RTTCacheException(Exception):
+    pass
+
+
+def is_enabled():
+    return not os.environ.get('HARDWARIO_NO_RTT_CACHE')
+
+
+def fingerprint(data):
+    '''Return firmware key of the flash start read from the device.
+
+    On devices with a bootloader the start of flash does not change with the application,
+    entries are therefore only used after read_control_block() matches them.
+    '''
+    return hashlib.sha256(bytes(data)).hexdigest()
+
+
+def elf_hash(path):
+    return get_file_hash(path)
+
+
+def read_control_block(read, address):
+    '''Read control block at address, read(address, size) returns bytes.
+
+    Returns list of [sName, pBuffer, SizeOfBuffer] of the up and down buffers (in this order),
+    None when there is no control block at address.
+    '''
+    header = bytes(read(address, CONTROL_BLOCK_HEADER_SIZE))
+    if not header.startswith(CONTROL_BLOCK_ID):
+        return None
+    num_up, num_down = struct.unpack_from('<II', header, 16)
+    if num_up + num_down > MAX_BUFFERS:
+        return None
+    table = bytes(read(address + CONTROL_BLOCK_HEADER_SIZE, (num_up + num_down) * BUFFER_DESCRIPTOR_SIZE))
+    return [list(struct.unpack_from('<III', table, i * BUFFER_DESCRIPTOR_SIZE)) for i in range(num_up + num_down)]
+
+
+def read_elf_symbol(path, name=SYMBOL):
+    '''Return address of symbol from the ELF symbol table, None when not found.'''
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if data[:4] != b'\x7fELF':
+        raise RTTCacheException(f'Not an ELF file: {path}')
+
+    is64 = data[4] == 2
+    endian = '<' if data[5] == 1 else '>'
+    if is64:
+        shoff, = struct.unpack_from(endian + 'Q', data, 0x28)
+        shentsize, shnum = struct.unpack_from(endian + 'HH', data, 0x3A)
+        section_format, symbol_format = endian + 'IIQQQQIIQQ', endian + 'IBBHQQ'
+    else:
+        shoff, = struct.unpack_from(endian + 'I', data, 0x20)
+        shentsize, shnum = struct.unpack_from(endian + 'HH', data, 0x2E)
+        section_format, symbol_format = endian + 'IIIIIIIIII', endian + 'IIIBBH'
+
+    sections = [struct.unpack_from(section_format, data, shoff + i * shentsize) for i in range(shnum)]
+    key = name.encode() + b'\0'
+
+    for _, sh_type, _, _, offset, size, link, _, _, entsize in sections:
+        if sh_type != 2 or not entsize:  # SHT_SYMTAB
+            continue
+        strtab = sections[link][4]
+        for pos in range(offset, offset + size, entsize):
+            symbol = struct.unpack_from(symbol_format, data, pos)
+            if data.startswith(key, strtab + symbol[0]):
+                return symbol[4] if is64 else symbol[1]
+    return None
+
+
+def find_control_block(read, start=RAM_START, size=RAM_SIZE, chunk_size=0x4000):
+    '''Search RAM for the control block ID, read(address, size) returns bytes. Returns address or None.'''
+    overlap = len(CONTROL_BLOCK_ID) - 1
+    tail = b''
+    for address in range(start, start + size, chunk_size):
+        data = tail + bytes(read(address, min(chunk_size, start + size - address)))
+        index = data.find(CONTROL_BLOCK_ID)
+        if index >= 0:
+            return address - len(tail) + index
+        tail = data[-overlap:]
+    return None
+
+
+def resolve(read, block_address=None, elf_path=None):
+    '''Find the control block before RTT start, read(address, size) returns bytes.
+
+    The firmware is keyed by the ELF hash, or by the flash start w/o ELF. An explicit block_address
+    is used as is, the cached address and the _SEGGER_RTT symbol of elf_path only when the control
+    block is there (so the probe is never started at a stale address).
+    Returns (firmware_hash, cached layout, address or None to scan, descriptors at address).
+    '''
+    firmware_hash = None
+    layout = None
+    if is_enabled():
+        try:
+            firmware_hash = elf_hash(elf_path) if elf_path else fingerprint(read(FINGERPRINT_ADDRESS, FINGERPRINT_SIZE))
+            layout = lookup(firmware_hash)
+        except OSError as e:
+            logger.warning('Reading firmware hash failed: {}', e)
+
+    if block_address:
+        return firmware_hash, layout, block_address, read_control_block(read, block_address)
+
+    candidates = []
+    if layout and layout['address']:
+        candidates.append(layout['address'])
+    if elf_path:
+        try:
+            candidates.append(read_elf_symbol(elf_path))
+        except (OSError, struct.error, RTTCacheException) as e:
+            logger.warning('Reading {} from {} failed: {}', SYMBOL, elf_path, e)
+
+    for address in candidates:
+        if not address:
+            continue
+        descriptors = read_control_block(read, address)
+        if descriptors is not None:
+            return firmware_hash, layout, address, descriptors
+        logger.debug('RTT control block not found at 0x{:08X}', address)
+
+    return firmware_hash, layout, None, None
+
+
+def is_valid(layout, address, descriptors):
+    '''Cached layout matches the control block read from the device (same address and buffers).'''
+    return layout is not None and descriptors is not None and layout['address'] == address and layout.get('descriptors') == descriptors
+
+
+def _load(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning('Invalid RTT cache {}: {}', path, e)
+        return {}
+
+
+def _save(path, cache):
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    tmp = f'{path}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp, path)
+
+
+def lookup(firmware_hash, path=DEFAULT_CACHE_PATH):
+    '''Return layout cached for the firmware, None when not cached.
+
+    Layout is a dict with the control block address, the up and down channels as lists
+    of [name, size] in index order and the buffer descriptors from read_control_block().
+    '''
+    entry = _load(path).get(firmware_hash)
+    if not entry or 'up' not in entry or 'down' not in entry:
+        return None
+    return {'address': entry.get('address'), 'up': entry['up'], 'down': entry['down'], 'descriptors': entry.get('descriptors')}
+
+
+def store(firmware_hash, layout, path=DEFAULT_CACHE_PATH):
+    # Re-read right before the write, other processes may have updated the file
+    cache = _load(path)
+    cache[firmware_hash] = {
+        'address': layout['address'],
+        'up': [list(channel) for channel in layout['up']],
+        'down': [list(channel) for channel in layout['down']],
+        'descriptors': layout['descriptors'],
+        'updated_at': time.time(),
+    }
+    for key in sorted(cache, key=lambda key: cache[key].get('updated_at', 0))[:-MAX_ENTRIES]:
+        del cache[key]
+    _save(path, cache)
+
+
+def forget(firmware_hash, path=DEFAULT_CACHE_PATH):
+    cache = _load(path)
+    if cache.pop(firmware_hash, None) is not None:
+        _save(path, cache)
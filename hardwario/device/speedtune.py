@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import click
+from loguru import logger
+from pynrfjprog.Parameters import MemoryType
+from hardwario.device.multiprobe import enumerate_probes
+
+DEFAULT_CACHE_PATH = os.path.expanduser("~/.hardwario/jlink_speed.json")
+
+# Candidate SWD clock speeds in kHz, probed in increasing order
+SPEEDS = (1000, 2000, 4000, 8000, 12000, 15000, 20000, 25000, 30000, 50000)
+
+BURST_SIZE = 0x1000
+BURST_COUNT = 4
+
+
+class SpeedType(click.ParamType):
+    '''J-Link clock speed in kHz or 'auto'.'''
+    name = 'speed'
+
+    def convert(self, value, param, ctx):
+        if value == 'auto' or (isinstance(value, int) and value > 0):
+            return value
+        try:
+            speed = int(value)
+        except (TypeError, ValueError):
+            self.fail(f'{value!r} is not a valid speed (integer in kHz or auto)', param, ctx)
+        if speed < 1:
+            self.fail('Speed must be positive', param, ctx)
+        return speed
+
+
+JLINK_SPEED = SpeedType()
+
+
+def _load(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.warning('Invalid speed cache {}: {}', path, e)
+        return {}
+
+
+def _save(path, update, remove=None, chip=None):
+    # Re-read right before the write, other processes (parallel probes) may have updated the file
+    cache = _load(path)
+    if remove and chip:
+        cache.get(remove, {}).pop(chip, None)
+    elif remove:
+        cache.pop(remove, None)
+    for sn, chips in update.items():
+        cache.setdefault(sn, {}).update(chips)
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    tmp = f'{path}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp, path)
+
+
+def lookup_chip(jlink_sn, device_family, path=DEFAULT_CACHE_PATH):
+    '''Return (chip name, speed) most recently tuned for probe and target family, (None, None) when not tuned yet.
+
+    The chip is known only after connecting, the caller checks it matches the connected one.
+    '''
+    if jlink_sn is None:
+        return None, None
+    entries = [(entry.get('tuned_at', 0), chip, entry['speed']) for chip, entry in _load(path).get(str(jlink_sn), {}).items()
+               if entry.get('device_family') == device_family]
+    if not entries:
+        return None, None
+    _, chip, speed = max(entries)
+    return chip, speed
+
+
+def lookup(jlink_sn, device_family, path=DEFAULT_CACHE_PATH):
+    '''Return cached speed for probe and target family, None when not tuned yet.'''
+    return lookup_chip(jlink_sn, device_family, path)[1]
+
+
+def forget(jlink_sn, chip=None, path=DEFAULT_CACHE_PATH):
+    '''Drop speeds tuned for probe, only the one of chip when given.'''
+    if jlink_sn is not None:
+        _save(path, {}, remove=str(jlink_sn), chip=chip)
+
+
+def _burst(prog):
+    '''Repeatedly read the start of CODE, raise when reads disagree.'''
+    des = next(d for d in prog.read_memory_descriptors(False) if d.type == MemoryType.CODE)
+    first = None
+    for _ in range(BURST_COUNT):
+        data = bytes(prog.read(des.start, BURST_SIZE))
+        if first is None:
+            first = data
+        elif data != first:
+            raise Exception('Inconsistent readback')
+
+
+def _try_speed(prog, jlink_sn, speed, bursts=1):
+    '''Return chip name when the target is stable at speed, raise otherwise.'''
+    p = type(prog)(prog.device_family, jlink_sn=jlink_sn, jlink_speed=speed, log=prog._log)
+    try:
+        p.open()
+        chip = p.get_chip_name()
+        for _ in range(bursts):
+            _burst(p)
+        return chip
+    finally:
+        if p.is_opened:
+            p.close()
+
+
+def tune(prog, jlink_sn=None, path=DEFAULT_CACHE_PATH):
+    '''Find the highest stable speed for probe and target, cache it when the probe is known.
+
+    Speeds are probed upwards until the first error, then the best one is confirmed
+    with a longer burst, stepping down on errors.
+    '''
+    from hardwario.device.nrfjprog import NRFJProgOpenException, DEFAULT_JLINK_SPEED_KHZ
+
+    start = time.monotonic()
+    passed = []
+    chip = None
+    for speed in SPEEDS:
+        try:
+            chip = _try_speed(prog, jlink_sn, speed)
+        except NRFJProgOpenException:
+            if not passed:
+                raise
+            break
+        except Exception as e:
+            logger.debug('Speed {} kHz failed: {}', speed, e)
+            if not passed:
+                # Target is not readable (e.g. AP-protect), nothing to tune against
+                logger.warning('Speed tuning not possible: {}', e)
+                return DEFAULT_JLINK_SPEED_KHZ
+            break
+        passed.append(speed)
+
+    for speed in reversed(passed):
+        try:
+            _try_speed(prog, jlink_sn, speed, bursts=4)
+            break
+        except Exception as e:
+            logger.debug('Speed {} kHz not stable: {}', speed, e)
+    else:
+        speed = SPEEDS[0]
+
+    logger.info('Tuned J-Link {} ({}) to {} kHz in {:.1f}s', jlink_sn, chip, speed, time.monotonic() - start)
+
+    if jlink_sn is not None:
+        _save(path, {str(jlink_sn): {chip: {'device_family': prog.device_family, 'speed': speed, 'tuned_at': time.time()}}})
+    return speed
+
+
+def resolve(prog, path=DEFAULT_CACHE_PATH):
+    '''Resolve 'auto' speed for prog from the cache, tune when not cached yet.
+
+    Returns tuple (probe serial number, chip the cached speed was tuned for or None when tuned now, speed).
+    '''
+    jlink_sn = prog.get_serial_number()
+    if jlink_sn is None:
+        probes = enumerate_probes()
+        if len(probes) == 1:
+            jlink_sn = probes[0]
+
+    chip, speed = lookup_chip(jlink_sn, prog.device_family, path)
+    if speed is not None:
+        logger.debug('Using cached speed {} kHz of {} for J-Link {}', speed, chip, jlink_sn)
+        return jlink_sn, chip, speed
+    return jlink_sn, None, tune(prog, jlink_sn, path)
+
+
+def get_speed(prog, path=DEFAULT_CACHE_PATH):
+    return resolve(prog, path)[2]
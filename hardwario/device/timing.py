@@ -0,0 +1,36 @@
+import json
+import click
+
+TIMINGS_FORMATS = ('json', )
+
+
+class TimingRecorder:
+    '''Collects phase events from NRFJProg.on_event, writes them as JSON lines.'''
+
+    def __init__(self, file=None):
+        self.file = file
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def write(self):
+        if not self.records:
+            return
+        text = ''.join(json.dumps(record) + '\n' for record in self.records)
+        if self.file:
+            with open(self.file, 'a') as f:
+                f.write(text)
+        else:
+            click.echo(text, nl=False, err=True)
+        self.records = []
+
+
+def attach(ctx, timings, timings_file):
+    '''Record phase events of ctx prog when --timings or --timings-file is used, written when the command ends.'''
+    if not timings and not timings_file:
+        return None
+    recorder = TimingRecorder(timings_file)
+    ctx.obj['prog'].on_event = recorder
+    ctx.call_on_close(recorder.write)
+    return recorder
@@ -0,0 +1,42 @@
+from hardwario.chester.connector import LineFramer
+
+
+def test_many_lines_in_one_chunk():
+    framer = LineFramer()
+    assert framer.feed(b'a\nbb\n\nccc\nd') == ['a', 'bb', '', 'ccc']
+    assert framer.feed(b'd\n') == ['dd']
+
+
+def test_crlf():
+    framer = LineFramer()
+    assert framer.feed(b'one\r\ntwo\r') == ['one']
+    assert framer.feed(b'\nthree\r\r\n') == ['two', 'three\r']
+
+
+def test_utf8_split_across_feeds():
+    data = 'žluťoučký kůň\n'.encode()
+    framer = LineFramer()
+    lines = []
+    for i in range(len(data)):
+        lines += framer.feed(data[i:i + 1])
+    assert lines == ['žluťoučký kůň']
+
+
+def test_long_pending_line():
+    framer = LineFramer(8)
+    assert framer.feed(b'0123456789abcdefg') == ['01234567', '89abcdef']
+    assert framer.feed(b'h\n') == ['gh']
+
+
+def test_long_complete_line():
+    framer = LineFramer(8)
+    assert framer.feed(b'xyz') == []
+    assert framer.feed(b'0123456789\n') == ['xyz01234', '56789']
+    assert framer.feed(b'01234567\r\n') == ['01234567']
+    assert framer.feed(b'01234567\r') == []
+    assert framer.feed(b'\n') == ['01234567']
+
+
+def test_long_line_utf8():
+    framer = LineFramer(4)
+    assert ''.join(framer.feed('ččč\n'.encode())) == 'ččč'
@@ -0,0 +1,148 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import pytest
+from pynrfjprog import APIError
+from pynrfjprog.Parameters import MemoryType
+from hardwario.common.pib import PIBException
+from hardwario.device import daemon, devicecache
+from hardwario.device.nrfjprog import ErasePlan, NRFJProg, NRFJProgException
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason='Unix domain sockets required')
+
+FAKE_CLASS = f'{__name__}.FakeProg'
+
+
+class FakeProg(NRFJProg):
+    opened = []
+
+    def open(self):
+        self.is_opened = True
+        FakeProg.opened.append(self)
+
+    def close(self):
+        self.is_opened = False
+
+    def is_same_device(self):
+        return True
+
+    def read(self, address, size):
+        return list(range(size))
+
+    def read_uicr_pib(self):
+        return b'\x01\x02'
+
+    def plan_erase(self, img=None, allow_erase_all=False):
+        return ErasePlan('sector', [(0x0, 0x1000), (0x1000, 0x1000)], 0.2)
+
+    def read_memory_descriptors(self, read_page_sizes=True):
+        return [devicecache.Descriptor(0x0, 0x1000, 1, int(MemoryType.CODE), 7, 'CODE')]
+
+    def verify_uicr_pib(self, buffer):
+        raise NRFJProgException(f'PIB verify failed: {buffer.hex()}')
+
+    def erase_all(self):
+        raise APIError.APIError(-11, 'no target')
+
+    def halt(self):
+        raise RuntimeError('secret')
+
+
+def round_trip(value):
+    return daemon._decode(daemon.json.loads(daemon.json.dumps(daemon._encode(value))))
+
+
+def test_codec_round_trip():
+    value = {'a': b'\x00\xff', 'b': (1, [2, (3, 'x')]), 'c': None, 'd': 1.5}
+    assert round_trip(value) == value
+    plan = ErasePlan('pages', [(0x1000, 0x1000)], 0.09)
+    plan.actual_time = 0.1
+    decoded = round_trip(plan)
+    assert (decoded.strategy, decoded.pages, decoded.estimated_time, decoded.actual_time) == ('pages', [(0x1000, 0x1000)], 0.09, 0.1)
+    des, = round_trip([devicecache.Descriptor(0x10001000, 0x1000, 1, int(MemoryType.UICR), 3, 'UICR')])
+    assert (des.start, des.size, des.num_pages, des.type, des.label) == (0x10001000, 0x1000, 1, MemoryType.UICR, 'UICR')
+    with pytest.raises(daemon.DaemonException):
+        daemon._encode(object())
+
+
+def test_exception_mapping():
+    e = daemon._decode_exception(daemon._encode_exception(APIError.APIError(-11, 'no target')))
+    assert isinstance(e, APIError.APIError) and e.err_code == -11
+    e = daemon._decode_exception(daemon._encode_exception(PIBException('bad')))
+    assert type(e) is PIBException and str(e) == 'bad'
+    e = daemon._decode_exception(daemon._encode_exception(KeyError('x')))
+    assert type(e) is daemon.DaemonException and str(e) == "KeyError: 'x'"
+    # Classes not listed are never imported
+    e = daemon._decode_exception({'class': 'os.system', 'message': 'x'})
+    assert type(e) is daemon.DaemonException
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(daemon, 'CLASSES', daemon.CLASSES + (FAKE_CLASS,))
+    FakeProg.opened.clear()
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'd.sock')
+    instance = daemon.Daemon(path, idle_timeout=0)
+    thread = threading.Thread(target=instance.run, daemon=True)
+    thread.start()
+    while not os.path.exists(path):
+        time.sleep(0.01)
+    # Daemon.run disables the daemon for its own process
+    monkeypatch.delenv('HARDWARIO_NO_DAEMON', raising=False)
+    yield instance
+    instance.stop()
+    thread.join(5)
+    shutil.rmtree(directory)
+
+
+def test_session_calls(server):
+    session = daemon.connect(FakeProg(jlink_sn=123), server.path)
+    try:
+        assert session.read(0x0, 4) == [0, 1, 2, 3]
+        assert session.read_uicr_pib() == b'\x01\x02'
+        assert session.plan_erase().pages == [(0x0, 0x1000), (0x1000, 0x1000)]
+        assert session.read_memory_descriptors()[0].type == MemoryType.CODE
+        with pytest.raises(NRFJProgException, match='0102'):
+            session.verify_uicr_pib(b'\x01\x02')
+        with pytest.raises(daemon.DaemonException, match='RuntimeError: secret'):
+            session.halt()
+        with pytest.raises(APIError.APIError):
+            session.erase_all()
+        # The probe error closed the session
+        with pytest.raises(daemon.DaemonException, match='closed'):
+            session.read(0x0, 4)
+    finally:
+        session.close()
+    assert server.status() == []
+
+
+def test_release(server):
+    session = daemon.connect(FakeProg(jlink_sn=123), server.path)
+    session.read(0x0, 4)
+    session.close()
+    assert [s['jlink_sn'] for s in server.status()] == [123]
+    assert daemon.release(456, server.path) == 0
+    assert daemon.release(123, server.path) == 1
+    assert server.status() == []
+    assert not FakeProg.opened[0].is_opened
+
+
+def test_waiter_skips_closed_entry(server):
+    request = {'class': FAKE_CLASS, 'device_family': None, 'jlink_sn': 123, 'jlink_speed': 1000, 'log': False}
+    entry = server._acquire(request, None)
+    acquired = []
+    waiter = threading.Thread(target=lambda: acquired.append(server._acquire(request, None)))
+    waiter.start()
+    time.sleep(0.1)
+    with server._lock:
+        server._close(entry)
+    entry.lock.release()
+    waiter.join(5)
+    other, = acquired
+    assert other is not entry and not other.closed
+    assert other.prog.is_opened and not entry.prog.is_opened
+    assert server._entries[other.key] is other
@@ -0,0 +1,62 @@
+from hardwario.common import image
+from hardwario.common.image import Image
+
+
+def test_add_joins_and_overwrites():
+    img = Image()
+    img.add(0x100, b'\x01' * 4)
+    img.add(0x108, b'\x03' * 4)
+    img.add(0x104, b'\x02' * 4)
+    assert [(start, bytes(data)) for start, data in img.segments()] == [(0x100, b'\x01' * 4 + b'\x02' * 4 + b'\x03' * 4)]
+    img.add(0x0fe, b'\xaa' * 4)
+    assert img.start == 0x0fe and img.end == 0x10c
+    assert img.read(0x0fc, 8) == b'\xff\xff\xaa\xaa\xaa\xaa\x01\x01'
+
+
+def test_merge_other_wins():
+    img = Image().add(0x0, b'\x00' * 8).add(0x20, b'\x00' * 4)
+    img.merge(Image().add(0x4, b'\x11' * 8))
+    assert img.read(0x0, 12) == b'\x00' * 4 + b'\x11' * 8
+    assert len(img.segments()) == 2
+
+
+def test_overlaps_and_contains():
+    img = Image().add(0x1000, b'\x00' * 0x10).add(0x2000, b'\x00' * 0x10)
+    assert img.overlaps(0x0ff0, 0x11)
+    assert not img.overlaps(0x0ff0, 0x10)
+    assert img.overlaps(0x100f, 0x1000)
+    assert not img.overlaps(0x1010, 0xff0)
+    assert img.contains(0x200f) and not img.contains(0x2010)
+
+
+def test_ihex_round_trip():
+    img = Image().add(0x0fff8, bytes(range(32))).add(0x10001080, b'\x12\x34\x56\x78')
+    text = img.to_ihex()
+    assert Image.from_ihex(text) == img
+    assert Image.from_cache(img.to_cache()) == img
+
+
+def test_diff():
+    ours = Image().add(0x0, bytes(range(256)) * 4).add(0x1000, b'\x00' * 8)
+    theirs = ours.copy()
+    assert ours.diff(theirs) == []
+    theirs.add(0x1, b'\xaa').add(0x2, b'\x02')
+    theirs.add(0x301, b'\xbb\xbb\xbb\xbb\xbb')
+    theirs = Image().merge(Image().add(0x0, theirs.read(0x0, 0x400))).add(0x1000, b'\x00' * 4)
+    assert ours.diff(theirs) == [(0x1, 1), (0x301, 5), (0x1004, 4)]
+    assert Image().add(0x0, b'\xff' * 4).diff(Image()) == []
+
+
+def test_load_memory_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(image, '_memory_cache', image.OrderedDict())
+    paths = []
+    for i in range(image.MEMORY_CACHE_SIZE + 2):
+        path = tmp_path / f'{i}.bin'
+        path.write_bytes(bytes([i]) * 16)
+        paths.append(str(path))
+    first = image.load(paths[0])
+    for path in paths[1:]:
+        assert image.load(path).read(0, 1) == bytes([paths.index(path)])
+        image.load(paths[0])
+    assert len(image._memory_cache) == image.MEMORY_CACHE_SIZE
+    assert image.load(paths[0]) is first
@@ -0,0 +1,32 @@
+import os
+from hardwario.device import multiprobe
+from hardwario.device.nrfjprog import NRFJProg
+
+
+class FakeProg(NRFJProg):
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def operation(prog, crash_sn):
+    if prog.get_serial_number() == crash_sn:
+        os._exit(1)
+    if prog.get_serial_number() == 3:
+        raise Exception('no target')
+    return f'ok {prog.get_serial_number()}'
+
+
+def test_run_collects_failures():
+    results = multiprobe.run(FakeProg(), [1, 2, 3], operation, (None,))
+    assert [(r.jlink_sn, r.result, r.error) for r in results] == [(1, 'ok 1', None), (2, 'ok 2', None), (3, None, 'no target')]
+
+
+def test_run_survives_crashed_worker():
+    results = multiprobe.run(FakeProg(), [1, 2], operation, (2,))
+    assert [r.jlink_sn for r in results] == [1, 2]
+    assert not results[1].ok
+    assert results[1].error.startswith('BrokenProcessPool')
@@ -0,0 +1,211 @@
+from functools import partial
+from types import SimpleNamespace
+import pytest
+from pynrfjprog import LowLevel
+from pynrfjprog.Parameters import EraseAction, MemoryType
+from hardwario.common import image
+from hardwario.common.image import Image
+from hardwario.device import nrfjprog
+from hardwario.device.nrfjprog import NRFJProg, NRFJProgException
+
+UICR_START = 0x10001000
+PAGE_SIZE = 0x1000
+
+
+class FakeProg(NRFJProg):
+    '''Device over bytearrays, writes only clear bits like the flash.'''
+
+    def __init__(self, family='NRF52', flash_size=0x20000):
+        super().__init__()
+        self.family = family
+        self.flash = bytearray(b'\xff' * flash_size)
+        self.uicr = bytearray(b'\xff' * PAGE_SIZE)
+        self.calls = []
+
+    def _region(self, address):
+        if address >= UICR_START:
+            return self.uicr, address - UICR_START
+        return self.flash, address
+
+    def read_memory_descriptors(self, read_page_sizes=True):
+        return [SimpleNamespace(type=MemoryType.CODE, start=0, size=len(self.flash), num_pages=len(self.flash) // PAGE_SIZE, page_size=PAGE_SIZE),
+                SimpleNamespace(type=MemoryType.UICR, start=UICR_START, size=PAGE_SIZE, num_pages=1, page_size=PAGE_SIZE)]
+
+    def read_device_family(self):
+        return self.family
+
+    def read(self, address, size):
+        region, offset = self._region(address)
+        return list(region[offset:offset + size])
+
+    def write(self, address, data, control=True):
+        self.calls.append(('write', address, len(data)))
+        region, offset = self._region(address)
+        for i, b in enumerate(data):
+            region[offset + i] &= b
+
+    def erase_page(self, address):
+        self.calls.append(('erase_page', address))
+        self.flash[address:address + PAGE_SIZE] = b'\xff' * PAGE_SIZE
+
+    def erase_file(self, path, chip_erase_mode=EraseAction.ERASE_ALL, qspi_erase_mode=EraseAction.ERASE_NONE):
+        assert chip_erase_mode == EraseAction.ERASE_SECTOR
+        self.calls.append(('erase_file',))
+        with open(path) as f:
+            for address, data in Image.from_ihex(f.read()).segments():
+                for page in range(address // PAGE_SIZE * PAGE_SIZE, address + len(data), PAGE_SIZE):
+                    self.flash[page:page + PAGE_SIZE] = b'\xff' * PAGE_SIZE
+
+    def erase_chip(self):
+        self.calls.append(('erase_all',))
+        self.flash[:] = b'\xff' * len(self.flash)
+        self.uicr[:] = b'\xff' * PAGE_SIZE
+
+    def erase_uicr(self):
+        self.calls.append(('erase_uicr',))
+        self.uicr[:] = b'\xff' * PAGE_SIZE
+
+    def disable_bprot(self):
+        pass
+
+    def sys_reset(self):
+        pass
+
+    def halt(self):
+        pass
+
+    def go(self):
+        pass
+
+
+def test_write_uicr_pib_incremental_nrf52():
+    prog = FakeProg('NRF52')
+    prog.uicr[0x10:0x14] = b'\x12\x34\x56\x78'
+    pib = prog.get_uicr_pib_address() - UICR_START
+    assert prog.write_uicr_pib(b'\x0f' * 8, incremental=True) == 'write'
+    assert prog.write_uicr_pib(b'\x0f' * 8, incremental=True) == 'skip'
+    assert prog.write_uicr_pib(b'\xf0' * 8, incremental=True) == 'erase'
+    assert prog.uicr[pib:pib + 8] == b'\xf0' * 8
+    assert prog.uicr[0x10:0x14] == b'\x12\x34\x56\x78'
+
+
+def test_write_uicr_pib_incremental_nrf91_needs_erase():
+    prog = FakeProg('NRF91')
+    pib = prog.get_uicr_pib_address() - UICR_START
+    assert prog.write_uicr_pib(b'\x0f' * 8, incremental=True) == 'write'
+    with pytest.raises(NRFJProgException, match='recover'):
+        prog.write_uicr_pib(b'\xf0' * 8, incremental=True)
+    assert prog.uicr[pib:pib + 8] == b'\x0f' * 8
+    assert ('erase_uicr',) not in prog.calls
+
+
+@pytest.fixture
+def hex_file(tmp_path, monkeypatch):
+    # Keep parsed images out of the user cache directory
+    monkeypatch.setattr(nrfjprog.image, 'load', partial(image.load, cache_path=None))
+
+    def save(img, name='app.hex'):
+        path = str(tmp_path / name)
+        img.save_ihex(path)
+        return path
+    return save
+
+
+def erased_pages(prog):
+    return [call[1] for call in prog.calls if call[0] == 'erase_page']
+
+
+def test_program_delta_skips_unchanged_pages(hex_file):
+    prog = FakeProg()
+    img = Image().add(0x0, bytes(range(256)) * 32).add(0x3000, b'\x55' * 0x10)
+    result = prog.program_delta(hex_file(img))
+    assert result == {'written': 3, 'skipped': 0, 'verify': 'fast'}
+    assert erased_pages(prog) == [0x0000, 0x1000, 0x3000]
+    assert bytes(prog.flash[:0x2000]) == bytes(range(256)) * 32
+
+    prog.calls.clear()
+    assert prog.program_delta(hex_file(img)) == {'written': 0, 'skipped': 3, 'verify': 'none'}
+    assert prog.calls == []
+
+    img.add(0x1004, b'\x00')
+    assert prog.program_delta(hex_file(img, 'app2.hex')) == {'written': 1, 'skipped': 2, 'verify': 'fast'}
+    assert erased_pages(prog) == [0x1000]
+    assert prog.flash[0x1004] == 0x00 and prog.flash[0x1005] == 0x05
+
+
+def test_program_delta_keeps_uicr_outside_image(hex_file):
+    prog = FakeProg()
+    pib = prog.get_uicr_pib_address()
+    prog.uicr[pib - UICR_START:pib - UICR_START + 8] = b'PIBPIBPI'
+    prog.uicr[0x200:0x204] = b'\x00\x00\x00\x00'
+    img = Image().add(0x0, b'\x11' * 0x10).add(UICR_START + 0x200, b'\x12\x34\x56\x78')
+    assert prog.program_delta(hex_file(img)) == {'written': 2, 'skipped': 0, 'verify': 'fast'}
+    assert ('erase_uicr',) in prog.calls
+    assert prog.uicr[0x200:0x204] == b'\x12\x34\x56\x78'
+    assert prog.uicr[pib - UICR_START:pib - UICR_START + 8] == b'PIBPIBPI'
+    assert prog.uicr[:0x80] == b'\xff' * 0x80
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # execute_erase takes the start and the end time
+    times = []
+    monkeypatch.setattr(nrfjprog.time, 'monotonic', lambda: times.pop(0))
+    return times
+
+
+def test_plan_erase_image_pages():
+    prog = FakeProg()
+    img = Image().add(0x0, b'\x00' * 0x10).add(0x1ff0, b'\x00' * 0x20).add(UICR_START, b'\x00' * 4)
+    plan = prog.plan_erase(img)
+    assert plan.strategy == 'pages'
+    assert plan.pages == [(0x0000, PAGE_SIZE), (0x1000, PAGE_SIZE), (0x2000, PAGE_SIZE)]
+    assert plan.estimated_time == pytest.approx(3 * nrfjprog.ERASE_PAGE_TIME_S)
+    prog.flash[:] = b'\x00' * len(prog.flash)
+    prog.execute_erase(plan)
+    assert erased_pages(prog) == [0x0000, 0x1000, 0x2000]
+    assert prog.flash[0x3000] == 0x00
+
+
+def test_plan_erase_whole_code_keeps_uicr(clock):
+    prog = FakeProg()
+    prog.flash[:] = b'\x00' * len(prog.flash)
+    prog.uicr[:4] = b'\x00' * 4
+    plan = prog.plan_erase()
+    assert plan.strategy == 'sector'
+    assert len(plan.pages) == 32
+    assert plan.estimated_time == pytest.approx(32 * nrfjprog.ERASE_SECTOR_TIME_S)
+    clock.extend([10.0, 11.6])
+    prog.execute_erase(plan)
+    assert prog.calls == [('erase_file',)]
+    assert prog.flash == b'\xff' * len(prog.flash)
+    assert prog.uicr[:4] == b'\x00' * 4
+    assert plan.actual_time == pytest.approx(1.6)
+    assert prog.plan_erase().estimated_time == pytest.approx(1.6)
+
+
+def test_plan_erase_allow_erase_all_restores_uicr(clock, monkeypatch):
+    monkeypatch.setattr(LowLevel.API, 'erase_all', FakeProg.erase_chip)
+    prog = FakeProg()
+    prog.flash[:] = b'\x00' * len(prog.flash)
+    prog.uicr[0x80:0x88] = b'PIBPIBPI'
+    plan = prog.plan_erase(allow_erase_all=True)
+    assert plan.strategy == 'all'
+    assert plan.estimated_time == nrfjprog.ERASE_ALL_TIME_S
+    clock.extend([0.0, 0.2])
+    prog.execute_erase(plan)
+    assert prog.flash == b'\xff' * len(prog.flash)
+    assert prog.uicr[0x80:0x88] == b'PIBPIBPI'
+    assert prog.plan_erase(allow_erase_all=True).estimated_time == pytest.approx(0.2)
+
+    # Not worth it for a small CODE region
+    assert FakeProg(flash_size=0x2000).plan_erase(allow_erase_all=True).strategy == 'sector'
+
+
+def test_erase_all_restore_failure(monkeypatch):
+    monkeypatch.setattr(LowLevel.API, 'erase_all', FakeProg.erase_chip)
+    prog = FakeProg()
+    prog.uicr[0x80:0x84] = b'\x12\x34\x56\x78'
+    monkeypatch.setattr(prog, 'write', lambda address, data, control=True: None)
+    with pytest.raises(NRFJProgException, match='12345678'):
+        prog.erase_flash(allow_erase_all=True)
@@ -0,0 +1,146 @@
+import pytest
+from hardwario.common.pib import PIB, PIBView
+
+# Records written by the bitwise CRC implementation the zlib one replaced
+V1_RECORD = bytes.fromhex(
+    'fecabeba01ffffff5c00ffff050010820401ffff0300000048415244574152494f000000000000000000000000000000'
+    '000000000000000053656e736f72204d6f64756c6500000000000000000000000000000000000000477aaf1affffffff'
+    'ffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffffff')
+V1_CRC = 0x1aaf7a47
+
+V2_RECORD = bytes.fromhex(
+    'babecafe027b48415244574152494f0000000000000000434845535445522d4d000000000000000043474c5300000000'
+    '00000052332e320000003231353930313739383500303132333435363738396162636465663031323334353637383961'
+    '626364656600313233343536000000000000000000000049f10ed9ffffffffff')
+V2_CRC = 0x49f10ed9
+
+
+def make_v1():
+    pib = PIB(1)
+    pib.set_vendor_name('HARDWARIO')
+    pib.set_product_name('Sensor Module')
+    pib.set_serial_number(0x80000000 | (0x21 << 20) | 5)
+    pib.set_hw_revision(0x0104)
+    pib.set_hw_variant(3)
+    return pib
+
+
+def make_v2():
+    pib = PIB(2, nrf=True)
+    pib.set_vendor_name('HARDWARIO')
+    pib.set_product_name('CHESTER-M')
+    pib.set_hw_variant('CGLS')
+    pib.set_hw_revision('R3.2')
+    pib.set_serial_number('2159017985')
+    pib.set_claim_token('0123456789abcdef0123456789abcdef')
+    pib.set_ble_passkey('123456')
+    return pib
+
+
+def test_calc_crc_v1():
+    pib = make_v1()
+    assert pib.calc_crc() == V1_CRC
+    assert pib.get_buffer() == V1_RECORD
+
+
+def test_calc_crc_v2():
+    pib = make_v2()
+    assert pib.calc_crc() == V2_CRC
+    assert pib.get_buffer() == V2_RECORD
+
+
+def test_load_known_records():
+    assert PIB(1, V1_RECORD).get_crc() == V1_CRC
+    assert PIB(2, V2_RECORD, nrf=True).get_crc() == V2_CRC
+
+
+def bad_records():
+    bad_crc = bytearray(V2_RECORD)
+    bad_crc[0x10] ^= 0x01
+    bad_signature = bytearray(V2_RECORD)
+    bad_signature[0] = 0x00
+    return [V2_RECORD, bytes(bad_crc), bytes(bad_signature), V2_RECORD[:100]]
+
+
+EXPECTED = [
+    None,
+    'Integrity check for PIB failed crc',
+    'Integrity check for PIB failed signature',
+    'Integrity check for PIB failed length',
+]
+
+
+def test_verify_many_list():
+    assert PIB.verify_many(bad_records(), version=2, nrf=True) == EXPECTED
+
+
+def test_verify_many_concatenated():
+    # The short record can only be the trailing one of a concatenated dump
+    assert PIB.verify_many(b''.join(bad_records()), version=2, nrf=True) == EXPECTED
+    assert PIB.verify_many(V2_RECORD * 3, version=2, nrf=True) == [None] * 3
+
+
+def test_view_round_trip_v1():
+    pib = make_v1()
+    buf = pib.get_buffer()
+    assert PIBView(buf).get_dict() == PIB(1, buf).get_dict()
+    assert PIBView(buf).get_serial_number() == 0x80000000 | (0x21 << 20) | 5
+
+
+def test_view_round_trip_v1_core():
+    pib = PIB(1)
+    pib.set_serial_number(0x80000000 | (0x101 << 20) | 1)
+    pib.set_rf_offset(-12)
+    buf = pib.get_buffer()
+    payload = PIBView(buf).get_dict()
+    assert payload['rf_offset'] == -12
+    assert payload == PIB(1, buf).get_dict()
+
+
+def test_view_round_trip_v1_sticker():
+    pib = PIB(1)
+    pib.set_serial_number(0x80000000 | (0x009 << 20) | 1)
+    pib.set_rf_correction(0x12345678)
+    buf = pib.get_buffer()
+    payload = PIBView(buf).get_dict()
+    assert payload['rf_correction'] == 0x12345678
+    assert payload == PIB(1, buf).get_dict()
+
+
+def test_view_round_trip_v2():
+    buf = make_v2().get_buffer()
+    payload = PIBView(buf, nrf=True).get_dict()
+    assert payload['serial_number'] == '2159017985'
+    assert payload['claim_token'] == '0123456789abcdef0123456789abcdef'
+    assert payload == PIB(2, buf, nrf=True).get_dict()
+
+
+def test_iter_records():
+    records = []
+    for sn in range(2159017985, 2159017988):
+        pib = make_v2()
+        pib.set_serial_number(str(sn))
+        records.append(pib.get_buffer())
+    dump = b''.join(records) + b'\xff' * 50
+    assert [view.get_serial_number() for view in PIBView.iter_records(dump, nrf=True)] == ['2159017985', '2159017986', '2159017987']
+
+
+def test_iter_records_unchecked():
+    bad_crc = bytearray(V2_RECORD)
+    bad_crc[0x10] ^= 0x01
+    dump = V2_RECORD + bytes(bad_crc)
+    views = list(PIBView.iter_records(dump, nrf=True, check=False))
+    assert [view.get_serial_number() for view in views] == ['2159017985'] * 2
+    with pytest.raises(Exception, match='crc'):
+        list(PIBView.iter_records(dump, nrf=True))
+
+
+def test_load_unknown_version_keeps_layout():
+    pib = make_v2()
+    bad = bytearray(V2_RECORD)
+    bad[4] = 0x7f
+    with pytest.raises(Exception, match='version'):
+        pib.load(bytes(bad))
+    assert pib.get_vendor_name() == 'HARDWARIO'
+    pib.load(V2_RECORD)
+    assert pib.get_serial_number() == '2159017985'
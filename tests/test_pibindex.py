@@ -0,0 +1,67 @@
+import os
+import sqlite3
+from hardwario.common.pib import PIB
+from hardwario.common.pibindex import PIBIndex
+
+
+def record(serial_number):
+    pib = PIB(2, nrf=True)
+    pib.set_vendor_name('HARDWARIO')
+    pib.set_product_name('CHESTER-M')
+    pib.set_hw_variant('CGLS')
+    pib.set_hw_revision('R3.2')
+    pib.set_serial_number(str(serial_number))
+    pib.set_claim_token('0123456789abcdef0123456789abcdef')
+    pib.set_ble_passkey('123456')
+    buf = pib.get_buffer()
+    return buf + b'\xff' * (128 - len(buf))
+
+
+def test_add_and_query(tmp_path):
+    dumps = tmp_path / 'dumps'
+    dumps.mkdir()
+    (dumps / 'a.bin').write_bytes(record(2159017985) + record(2159017986))
+    (dumps / 'b.bin').write_bytes(b'\x00' * 128)
+    with PIBIndex(str(tmp_path / 'index.db')) as index:
+        assert index.add_path(str(dumps)) == (2, 1)
+        assert index.add_path(str(dumps)) == (0, 0)
+        rows = index.query(serial_number=2159017986)
+        assert [(os.path.basename(r['source']), r['offset']) for r in rows] == [('a.bin', 128)]
+        assert index.get_buffer(2159017985) == record(2159017985)
+
+
+def test_duplicates_are_kept(tmp_path):
+    (tmp_path / 'a.bin').write_bytes(record(2159017985))
+    (tmp_path / 'b.bin').write_bytes(record(2159017985) + record(2159017986))
+    with PIBIndex(str(tmp_path / 'index.db')) as index:
+        assert index.add_path(str(tmp_path / 'a.bin')) == (1, 0)
+        assert index.add_path(str(tmp_path / 'b.bin')) == (2, 0)
+        assert index.count() == 3
+        assert len(index.query(serial_number=2159017985)) == 2
+        assert index.duplicates() == {2159017985: 2}
+
+
+def test_prune_removed_files(tmp_path):
+    (tmp_path / 'a.bin').write_bytes(record(2159017985))
+    (tmp_path / 'b.bin').write_bytes(record(2159017986))
+    with PIBIndex(str(tmp_path / 'index.db')) as index:
+        index.add_path(str(tmp_path))
+        assert index.count() == 2
+        os.remove(tmp_path / 'a.bin')
+        index.add_path(str(tmp_path / 'b.bin'))
+        assert [r['serial_number'] for r in index.query()] == [2159017986]
+
+
+def test_old_schema_is_rebuilt(tmp_path):
+    path = str(tmp_path / 'index.db')
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE pib (serial_number INTEGER PRIMARY KEY)')
+    db.execute('CREATE TABLE source (path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime INTEGER NOT NULL)')
+    db.execute('INSERT INTO source VALUES (?, 128, 0)', (str(tmp_path / 'a.bin'),))
+    db.commit()
+    db.close()
+    (tmp_path / 'a.bin').write_bytes(record(2159017985))
+    with PIBIndex(path) as index:
+        assert index.add_path(str(tmp_path / 'a.bin')) == (1, 0)
+    with PIBIndex(path) as index:
+        assert index.count() == 1
@@ -0,0 +1,30 @@
+import json
+import pytest
+from hardwario.chester.recipe import Recipe, RecipeException
+
+
+def make_recipe(tmp_path, *steps):
+    path = tmp_path / 'recipe.json'
+    path.write_text(json.dumps({'steps': list(steps)}))
+    return Recipe(str(path))
+
+
+def test_validate_invalid_uicr_hex(tmp_path):
+    (tmp_path / 'uicr.txt').write_text('01020xyz')
+    recipe = make_recipe(tmp_path, {'target': 'app', 'action': 'uicr', 'file': 'uicr.txt', 'format': 'hex'})
+    with pytest.raises(RecipeException, match=r'^Step 1\. app uicr: non-hexadecimal'):
+        recipe.validate()
+
+
+def test_validate_missing_file(tmp_path):
+    recipe = make_recipe(tmp_path, {'target': 'app', 'action': 'erase'}, {'target': 'app', 'action': 'flash', 'file': 'app.hex'})
+    with pytest.raises(RecipeException) as e:
+        recipe.validate()
+    assert str(e.value) == 'Step 2. app flash: file app.hex does not exist'
+
+
+def test_validate_uicr(tmp_path):
+    (tmp_path / 'uicr.txt').write_text('01020304\n')
+    recipe = make_recipe(tmp_path, {'target': 'app', 'action': 'uicr', 'file': 'uicr.txt', 'format': 'hex'})
+    recipe.validate()
+    assert recipe.steps[0].buffer == b'\x01\x02\x03\x04'
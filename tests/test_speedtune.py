@@ -0,0 +1,58 @@
+from hardwario.device import speedtune
+from hardwario.device.nrfjprog import NRFJProg
+
+
+def test_lookup_and_forget_chip(tmp_path):
+    path = str(tmp_path / 'speed.json')
+    speedtune._save(path, {'123': {'NRF52832_xxAA': {'device_family': 'NRF52', 'speed': 8000, 'tuned_at': 1}}})
+    speedtune._save(path, {'123': {'NRF52840_xxAA': {'device_family': 'NRF52', 'speed': 4000, 'tuned_at': 2}}})
+    speedtune._save(path, {'123': {'NRF9160_xxAA': {'device_family': 'NRF91', 'speed': 2000, 'tuned_at': 3}}})
+    assert speedtune.lookup_chip(123, 'NRF52', path) == ('NRF52840_xxAA', 4000)
+    assert speedtune.lookup(123, 'NRF91', path) == 2000
+    assert speedtune.lookup(456, 'NRF52', path) is None
+    speedtune.forget(123, 'NRF52840_xxAA', path)
+    assert speedtune.lookup_chip(123, 'NRF52', path) == ('NRF52832_xxAA', 8000)
+    speedtune.forget(123, path=path)
+    assert speedtune.lookup(123, 'NRF91', path) is None
+
+
+class FakeProg(NRFJProg):
+
+    def __init__(self, chip):
+        super().__init__('NRF52', jlink_speed='auto')
+        self.chip = chip
+        self.speeds = []
+
+    def _open(self):
+        self.speeds.append(self._jlink_speed)
+        self.is_opened = True
+
+    def close(self):
+        self.is_opened = False
+
+    def get_chip_name(self):
+        return self.chip
+
+
+def fake_speedtune(monkeypatch, cached_chip):
+    calls = []
+    monkeypatch.setattr(speedtune, 'resolve', lambda prog: (123, cached_chip, 8000))
+    monkeypatch.setattr(speedtune, 'forget', lambda jlink_sn, chip=None: calls.append(('forget', jlink_sn, chip)))
+    monkeypatch.setattr(speedtune, 'tune', lambda prog, jlink_sn: calls.append(('tune', jlink_sn)) or 4000)
+    return calls
+
+
+def test_open_uses_speed_of_same_chip(monkeypatch):
+    calls = fake_speedtune(monkeypatch, 'NRF52840_xxAA')
+    prog = FakeProg('NRF52840_xxAA')
+    prog.open()
+    assert prog.speeds == [8000] and calls == []
+
+
+def test_open_tunes_again_for_other_chip(monkeypatch):
+    calls = fake_speedtune(monkeypatch, 'NRF52832_xxAA')
+    prog = FakeProg('NRF52840_xxAA')
+    prog.open()
+    assert prog.speeds == [8000, 4000]
+    assert calls == [('forget', 123, 'NRF52832_xxAA'), ('tune', 123)]
+    assert prog.is_opened